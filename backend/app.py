@@ -2,27 +2,118 @@ from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 import subprocess
 import threading
+import atexit
 import psycopg2
+from psycopg2 import pool as pg_pool
+from contextlib import closing, contextmanager
 import datetime
 import os
 import redis
 import time
 import uuid
 import signal
-import psutil
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+try:
+    import zstandard
+except ImportError:  # zstd is optional; logs fall back to zlib from the standard library
+    zstandard = None
+import selectors
+import codecs
+import base64
+import collections
+import hashlib
+import json
 import queue
+import re
+import shlex
+import tempfile
+import zlib
+from urllib.parse import urlencode
 
 repo_name = "ls-prime"
 marklogic_path = "ls-prime/marklogic"
+ML_MODULES_PATH = 'src/main/ml-modules'  # module code inside marklogic_path; other changes need a full mlDeploy
+WORKTREE_ROOT = os.path.abspath(os.environ.get('WORKTREE_ROOT', 'worktrees'))  # one git worktree of repo_name per branch
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Cursor', 'Link', 'X-Build-Id', 'X-Total-Lines', 'X-Start-Line', 'X-Run-Id'])
+
+# Prometheus metrics, served by /metrics
+RUN_DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+LOCK_WAIT_BUCKETS = (0.01, 0.1, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+RUNS_STARTED = Counter('deploy_runs_started_total', 'Runs started', ['type', 'environment'])
+RUNS_FINISHED = Counter('deploy_runs_finished_total', 'Runs finished, by outcome', ['type', 'environment', 'outcome'])
+RUNS_IN_PROGRESS = Gauge('deploy_runs_in_progress', 'Runs executing on this server', ['type'])
+RUN_DURATION = Histogram('deploy_run_duration_seconds', 'Wall time of finished runs', ['type', 'environment', 'outcome'],
+                         buckets=RUN_DURATION_BUCKETS)
+STEP_DURATION = Histogram('deploy_step_duration_seconds', 'Wall time of pipeline steps', ['type', 'step', 'outcome'],
+                          buckets=RUN_DURATION_BUCKETS)
+LOCK_WAIT = Histogram('deploy_lock_wait_seconds', 'Time from a run request until it held its lock, including time queued',
+                      ['type'], buckets=LOCK_WAIT_BUCKETS)
+ACTIVE_STREAMS = Gauge('deploy_active_streams', 'Open streaming responses', ['stream'])
+STREAMED_BYTES = Counter('deploy_streamed_bytes', 'Bytes sent on streaming responses', ['stream'])
+REDIS_LATENCY = Histogram('deploy_redis_command_seconds', 'Redis command latency; blocking reads are not observed', ['command'],
+                          buckets=LATENCY_BUCKETS)
+DB_LATENCY = Histogram('deploy_db_query_seconds', 'PostgreSQL statement latency', ['operation'], buckets=LATENCY_BUCKETS)
+LOG_SPILLED_BYTES = Counter('deploy_log_spilled_bytes', 'Run output buffered on disk because it could not be persisted fast enough')
+ABORT_EXIT = Histogram('deploy_abort_exit_seconds', "Time from an abort until the aborted command's process group exited",
+                       ['type'], buckets=LATENCY_BUCKETS)
+DB_POOL_WAIT = Histogram('deploy_db_pool_wait_seconds', 'Time waiting for a pooled PostgreSQL connection', buckets=LATENCY_BUCKETS)
+
+def sql_operation(query):
+    """Metric label of a SQL statement: its first keyword."""
+    words = query.split(None, 1) if isinstance(query, str) else None
+    return words[0].upper() if words else 'OTHER'
+
+def tracked_stream(stream, output):
+    """Yield from `output`, counting the open stream and its bytes in the stream metrics."""
+    ACTIVE_STREAMS.labels(stream).inc()
+    try:
+        for text in output:
+            STREAMED_BYTES.labels(stream).inc(len(text.encode('utf-8')))
+            yield text
+    finally:
+        ACTIVE_STREAMS.labels(stream).dec()
+
+class TimedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            REDIS_LATENCY.labels('PIPELINE').observe(time.perf_counter() - start)
+
+class TimedRedis(redis.Redis):
+    """redis.Redis recording the latency of each command (and pipeline) in REDIS_LATENCY."""
+
+    def execute_command(self, *args, **options):
+        if 'BLOCK' in args:  # XREAD BLOCK waits for data; its duration is not a latency
+            return super().execute_command(*args, **options)
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            REDIS_LATENCY.labels(str(args[0]).upper()).observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor recording the latency of each statement in DB_LATENCY."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            DB_LATENCY.labels(sql_operation(query)).observe(time.perf_counter() - start)
 
 # Redis configuration
-REDIS_HOST = 'redis.agentic-ai.lifesciences-dev.casinternal'
-REDIS_PORT = 6379
-REDIS_DB = 0
-r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+REDIS_HOST = os.getenv('REDIS_HOST', 'redis.agentic-ai.lifesciences-dev.casinternal')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+REDIS_DB = int(os.getenv('REDIS_DB', '0'))
+r = TimedRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
 
 # Database configuration
 DB_HOST = os.getenv('DB_HOST', 'postgres.agentic-ai.lifesciences-dev.casinternal')
@@ -30,138 +121,1827 @@ DB_NAME = os.getenv('DB_NAME', 'deploymentdashboard')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASS = os.getenv('DB_PASS', 'postgres')
 
+# Connection pool settings
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))  # seconds to wait for a free connection
+DB_POOL_PING_AFTER = float(os.getenv('DB_POOL_PING_AFTER', '30'))  # ping connections idle longer than this
+
 # Lock settings
 LOCK_TIMEOUT = 300  # 5 minutes timeout
-HEARTBEAT_INTERVAL = 0.1  # 100ms for immediate abort detection
+LOCK_RENEW_INTERVAL = 60  # seconds between lease renewals; aborts arrive via pub/sub
+CORB_JOB_LOCKS = os.getenv('CORB_JOB_LOCKS', 'false').lower() in ('1', 'true', 'yes')  # lock corb jobs per (environment, job)
+ABORT_CHANNEL = 'deploy_abort'  # pub/sub channel carrying the abort key of the run to stop
+ABORT_KEY_TTL = 2 * LOCK_RENEW_INTERVAL  # abort keys back up pub/sub and are checked on renewal
 SERVER_ID = str(uuid.uuid4())  # Unique server identifier
+SERVER_HEARTBEAT_INTERVAL = 15  # seconds between renewals of this server's liveness key
+SERVER_HEARTBEAT_TTL = 4 * SERVER_HEARTBEAT_INTERVAL  # a server silent this long is dead; its locks are freed
+REAP_INTERVAL = 60  # seconds between sweeps for the runs of dead servers
+
+# Command output settings
+READ_CHUNK_SIZE = 64 * 1024  # bytes read from a command's pipe per wakeup
+OUTPUT_FLUSH_BYTES = int(os.getenv('OUTPUT_FLUSH_BYTES', str(16 * 1024)))  # coalesced output yielded once this large
+OUTPUT_FLUSH_INTERVAL = float(os.getenv('OUTPUT_FLUSH_INTERVAL', '0.05'))  # ...or once the oldest line is this old
+ABORT_POLL_INTERVAL = 0.1  # only used for abort events that cannot wake a selector
+# Signals sent to an aborted command's process group, each with the longest wait for the group to exit
+TERMINATE_STAGES = (
+    (signal.SIGINT, float(os.getenv('ABORT_INTERRUPT_GRACE', '1'))),
+    (signal.SIGTERM, float(os.getenv('ABORT_TERMINATE_GRACE', '1'))),
+    (signal.SIGKILL, 0.5),
+)
+GROUP_EXIT_POLL = 0.02  # seconds between checks for group members that outlive the command's shell
+
+# Log persistence settings
+LOG_FLUSH_BYTES = int(os.getenv('LOG_FLUSH_BYTES', str(64 * 1024)))  # flush once this much output is buffered
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', '2'))  # ...or once buffered output is this old
+LOG_MEMORY_LIMIT = int(os.getenv('LOG_MEMORY_LIMIT', str(1024 * 1024)))  # unpersisted output a run keeps in memory before spilling to disk
+LOG_SPILL_DIR = os.getenv('LOG_SPILL_DIR') or None  # directory of spill files (default: the system temp directory)
+LOG_CODEC = 'zstd' if zstandard is not None else 'zlib'  # codec for newly written log chunks
+LOG_MIGRATION_BATCH = 100  # builds re-chunked per transaction when migrating legacy logs
+LOG_PAGE_CHUNKS = 16  # chunks read per query when streaming a stored log
+
+# Live output fan-out settings
+STREAM_MAX_BYTES = int(os.getenv('STREAM_MAX_BYTES', str(16 * 1024 * 1024)))  # newest output bytes kept per run stream
+STREAM_TTL = int(os.getenv('STREAM_TTL', '3600'))  # seconds a finished run stays attachable
+ATTACH_BLOCK_MS = 5000  # how long an attach request blocks on XREAD before re-checking the run
+ATTACH_READ_COUNT = 500  # stream entries a viewer reads at once
+STREAM_LAG_LIMIT = int(os.getenv('STREAM_LAG_LIMIT', str(4 * 1024 * 1024)))  # characters a viewer may trail a run's output (0: no limit)
+STREAM_LAG_POLICY = os.getenv('STREAM_LAG_POLICY', 'skip')  # a viewer beyond the limit skips ahead ('skip') or is disconnected ('drop')
+
+# Gradle daemon settings
+GRADLE_HOME_ROOT = os.path.abspath(os.getenv('GRADLE_HOME_ROOT', 'gradle-homes'))  # one GRADLE_USER_HOME per environment
+GRADLE_RO_DEP_CACHE = os.getenv('GRADLE_RO_DEP_CACHE', os.path.expanduser('~/.gradle/caches'))  # shared dependency cache
+GRADLE_MAX_DAEMONS = int(os.getenv('GRADLE_MAX_DAEMONS', '3'))  # environments that keep a live daemon
+GRADLE_IDLE_TIMEOUT = int(os.getenv('GRADLE_IDLE_TIMEOUT', '1800'))  # seconds unused before a daemon is stopped
+GRADLE_WARM_ENVIRONMENTS = [e for e in os.getenv('GRADLE_WARM_ENVIRONMENTS', '').split(',') if e]  # kept warm from startup
+GRADLE_HEALTH_INTERVAL = 60  # seconds between daemon health checks
+
+# Deployment queue settings
+QUEUE_WORKERS = int(os.getenv('QUEUE_WORKERS', '2'))  # queued runs this server executes at once
+QUEUE_POLL_INTERVAL = float(os.getenv('QUEUE_POLL_INTERVAL', '1'))  # seconds between queue checks by idle workers and waiting clients
+QUEUE_STATS_WINDOW = 24 * 3600  # seconds of started runs covered by the queue-wait statistics
+QUEUE_RETENTION_DAYS = int(os.getenv('QUEUE_RETENTION_DAYS', '7'))  # days ended queue entries are kept
+QUEUE_PRUNE_INTERVAL = 3600  # seconds between deletions of expired queue entries
+QUEUE_PRUNE_BATCH = 1000  # queue entries deleted per statement
+
+# Corb job batch settings
+CORB_BATCH_CONCURRENCY = int(os.getenv('CORB_BATCH_CONCURRENCY', '4'))  # most jobs of one batch running at once
+CORB_BATCH_MAX_JOBS = 50  # jobs accepted in one batch
+CORB_JOB_NAME_RE = re.compile(r'^[A-Za-z0-9_.:-]+$')  # corb job (Gradle task) names accepted
+VERSION_RE = re.compile(r'^[A-Za-z0-9._-]+$')  # frontend and structure search versions accepted
+RUN_TYPES = {'fr': 'frontend deployment', 'ml': 'MarkLogic deployment', 'cj': 'corb job run'}
+
+class DBPool:
+    """Bounded, thread-safe PostgreSQL connection pool with health checks and wait stats."""
+
+    def __init__(self, minconn, maxconn, timeout, ping_after, **conn_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.conn_kwargs = conn_kwargs
+        self._pool = None
+        self._init_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'acquired': 0,
+            'timeouts': 0,
+            'replaced': 0,
+            'in_use': 0,
+            'wait_total_ms': 0.0,
+            'wait_max_ms': 0.0,
+        }
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._init_lock:
+                if self._pool is None:
+                    self._pool = pg_pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self.conn_kwargs)
+        return self._pool
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        pool = self._get_pool()
+        conn = pool.getconn()
+        if not self._is_healthy(conn):
+            self._last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+            with self._stats_lock:
+                self._stats['replaced'] += 1
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection, waiting up to `timeout` seconds for a free slot."""
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._stats_lock:
+                self._stats['timeouts'] += 1
+            raise pg_pool.PoolError(f"Timed out after {self.timeout}s waiting for a database connection")
+        waited_ms = (time.monotonic() - start) * 1000
+        DB_POOL_WAIT.observe(waited_ms / 1000)
+        with self._stats_lock:
+            self._stats['acquired'] += 1
+            self._stats['in_use'] += 1
+            self._stats['wait_total_ms'] += waited_ms
+            self._stats['wait_max_ms'] = max(self._stats['wait_max_ms'], waited_ms)
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        finally:
+            if conn is not None:
+                broken = bool(conn.closed)
+                if broken:
+                    self._last_used.pop(id(conn), None)
+                else:
+                    self._last_used[id(conn)] = time.monotonic()
+                # putconn rolls back any open transaction before the connection is reused
+                self._pool.putconn(conn, close=broken)
+            with self._stats_lock:
+                self._stats['in_use'] -= 1
+            self._slots.release()
+
+    def stats(self):
+        """Return a snapshot of pool usage and acquire-wait instrumentation."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['min'] = self.minconn
+        stats['max'] = self.maxconn
+        stats['wait_avg_ms'] = stats['wait_total_ms'] / stats['acquired'] if stats['acquired'] else 0.0
+        return stats
+
+db_pool = DBPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_PING_AFTER,
+                 host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS, cursor_factory=TimedCursor)
 
 def create_tables():
     """Create tables for deployment history if they don't exist."""
-    conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS deploy_fr_history (
-            build_id INTEGER PRIMARY KEY,
-            deploy_datetime TIMESTAMP,
-            output_log TEXT,
-            status BOOLEAN,
-            fr_version VARCHAR(50),
-            structure_search_version VARCHAR(50),
-            aborted BOOLEAN DEFAULT FALSE
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS deploy_ml_history (
-            build_id INTEGER PRIMARY KEY,
-            deploy_datetime TIMESTAMP,
-            output_log TEXT,
-            status BOOLEAN,
-            branch_name VARCHAR(100),
-            environment_type VARCHAR(100),
-            aborted BOOLEAN DEFAULT FALSE
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS deploy_cj_history (
-            build_id INTEGER PRIMARY KEY,
-            deploy_datetime TIMESTAMP,
-            output_log TEXT,
-            status BOOLEAN,
-            job_name VARCHAR(100),
-            branch_name VARCHAR(100),
-            environment_type VARCHAR(100),
-            aborted BOOLEAN DEFAULT FALSE
-        )
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def get_next_fr_build_id():
-    """Get the next build ID for frontend deployments."""
-    conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS)
-    cur = conn.cursor()
-    cur.execute("SELECT MAX(build_id) FROM deploy_fr_history")
-    max_id = cur.fetchone()[0]
-    cur.close()
-    conn.close()
-    return 1 if max_id is None else max_id + 1
-
-def get_next_ml_build_id():
-    """Get the next build ID for MarkLogic deployments."""
-    conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS)
-    cur = conn.cursor()
-    cur.execute("SELECT MAX(build_id) FROM deploy_ml_history")
-    max_id = cur.fetchone()[0]
-    cur.close()
-    conn.close()
-    return 1 if max_id is None else max_id + 1
-
-def get_next_cj_build_id():
-    """Get the next build ID for corb job deployments."""
-    conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS)
-    cur = conn.cursor()
-    cur.execute("SELECT MAX(build_id) FROM deploy_cj_history")
-    max_id = cur.fetchone()[0]
-    cur.close()
-    conn.close()
-    return 1 if max_id is None else max_id + 1
-
-def insert_fr_log(build_id, dt, log, status, fr_version, structure_search_version, aborted=False):
-    """Insert frontend deployment log into the database."""
-    conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS)
-    cur = conn.cursor()
-    cur.execute("INSERT INTO deploy_fr_history (build_id, deploy_datetime, output_log, status, fr_version, structure_search_version, aborted) VALUES (%s, %s, %s, %s, %s, %s, %s)", 
-                (build_id, dt, log, status, fr_version, structure_search_version, aborted))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def insert_ml_log(build_id, dt, log, status, branch_name, environment_type, aborted=False):
-    """Insert MarkLogic deployment log into the database."""
-    conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS)
-    cur = conn.cursor()
-    cur.execute("INSERT INTO deploy_ml_history (build_id, deploy_datetime, output_log, status, branch_name, environment_type, aborted) VALUES (%s, %s, %s, %s, %s, %s, %s)", 
-                (build_id, dt, log, status, branch_name, environment_type, aborted))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def insert_cj_log(build_id, dt, log, status, job_name, branch_name, environment_type, aborted=False):
-    """Insert corb job deployment log into the database."""
-    conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS)
-    cur = conn.cursor()
-    cur.execute("INSERT INTO deploy_cj_history (build_id, deploy_datetime, output_log, status, job_name, branch_name, environment_type, aborted) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", 
-                (build_id, dt, log, status, job_name, branch_name, environment_type, aborted))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS deploy_fr_history (
+                build_id INTEGER PRIMARY KEY,
+                deploy_datetime TIMESTAMP,
+                output_log TEXT,
+                status BOOLEAN,
+                fr_version VARCHAR(50),
+                structure_search_version VARCHAR(50),
+                aborted BOOLEAN DEFAULT FALSE
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS deploy_ml_history (
+                build_id INTEGER PRIMARY KEY,
+                deploy_datetime TIMESTAMP,
+                output_log TEXT,
+                status BOOLEAN,
+                branch_name VARCHAR(100),
+                environment_type VARCHAR(100),
+                aborted BOOLEAN DEFAULT FALSE
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS deploy_cj_history (
+                build_id INTEGER PRIMARY KEY,
+                deploy_datetime TIMESTAMP,
+                output_log TEXT,
+                status BOOLEAN,
+                job_name VARCHAR(100),
+                branch_name VARCHAR(100),
+                environment_type VARCHAR(100),
+                aborted BOOLEAN DEFAULT FALSE
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS deploy_log_chunks (
+                run_type VARCHAR(2),
+                build_id INTEGER,
+                seq INTEGER,
+                content TEXT,
+                created_at TIMESTAMP DEFAULT now(),
+                PRIMARY KEY (run_type, build_id, seq)
+            )
+        """)
+        # Compressed storage: content is only kept for chunks written before compression
+        cur.execute("ALTER TABLE deploy_log_chunks ADD COLUMN IF NOT EXISTS content_z BYTEA")
+        cur.execute("ALTER TABLE deploy_log_chunks ADD COLUMN IF NOT EXISTS codec VARCHAR(10)")
+        cur.execute("ALTER TABLE deploy_log_chunks ADD COLUMN IF NOT EXISTS line_start INTEGER")
+        cur.execute("ALTER TABLE deploy_log_chunks ADD COLUMN IF NOT EXISTS line_count INTEGER")
+        cur.execute("ALTER TABLE deploy_log_chunks ADD COLUMN IF NOT EXISTS search_vector TSVECTOR")
+        cur.execute("CREATE INDEX IF NOT EXISTS deploy_log_chunks_search_idx ON deploy_log_chunks USING GIN (search_vector)")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS deploy_run_steps (
+                run_type VARCHAR(2) NOT NULL,
+                build_id INTEGER NOT NULL,
+                seq SMALLINT NOT NULL,
+                name VARCHAR(50) NOT NULL,
+                command TEXT,
+                started_at TIMESTAMP NOT NULL,
+                finished_at TIMESTAMP,
+                duration_ms INTEGER,
+                exit_code INTEGER,
+                output_bytes BIGINT NOT NULL DEFAULT 0,
+                outcome VARCHAR(20) NOT NULL DEFAULT 'running',
+                PRIMARY KEY (run_type, build_id, seq)
+            )
+        """)
+        cur.execute("ALTER TABLE deploy_run_steps ADD COLUMN IF NOT EXISTS startup_ms INTEGER")
+        cur.execute("ALTER TABLE deploy_run_steps ADD COLUMN IF NOT EXISTS execution_ms INTEGER")
+        cur.execute("ALTER TABLE deploy_run_steps ADD COLUMN IF NOT EXISTS abort_exit_ms INTEGER")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS deploy_queue (
+                run_id SERIAL PRIMARY KEY,
+                run_type VARCHAR(2) NOT NULL,
+                params JSONB NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                scope_key VARCHAR(255) NOT NULL,
+                state VARCHAR(20) NOT NULL DEFAULT 'queued',
+                enqueued_at TIMESTAMP NOT NULL DEFAULT localtimestamp,
+                started_at TIMESTAMP,
+                build_id INTEGER
+            )
+        """)
+        cur.execute("ALTER TABLE deploy_queue ADD COLUMN IF NOT EXISTS error TEXT")
+        # Only queued and running entries are scanned by state; ended ones are pruned (prune_queue)
+        cur.execute("DROP INDEX IF EXISTS deploy_queue_queued_idx")
+        cur.execute("CREATE INDEX IF NOT EXISTS deploy_queue_active_idx ON deploy_queue (priority DESC, run_id) "
+                    "WHERE state IN ('queued', 'running')")
+        cur.execute("CREATE INDEX IF NOT EXISTS deploy_queue_started_idx ON deploy_queue (started_at)")
+        for table in ['deploy_fr_history', 'deploy_ml_history', 'deploy_cj_history']:
+            seq = f"{table}_build_id_seq"
+            # In-place migration: back build_id with a sequence starting after the existing rows
+            cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {seq} OWNED BY {table}.build_id")
+            cur.execute(f"""
+                SELECT setval('{seq}', m + 1, false)
+                FROM (SELECT COALESCE(MAX(build_id), 0) AS m FROM {table}) t
+                WHERE m + 1 > (SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END FROM {seq})
+            """)
+            cur.execute(f"ALTER TABLE {table} ALTER COLUMN build_id SET DEFAULT nextval('{seq}')")
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS run_state VARCHAR(20) NOT NULL DEFAULT 'finished'")
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS commit_sha VARCHAR(40)")
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS reused_build_id INTEGER")
+        # Indexes backing keyset pagination and the history filters
+        for run_type, (table, fields) in HISTORY_TABLES.items():
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_dt_idx ON {table} (deploy_datetime DESC, build_id DESC)")
+            for column, _, _ in fields:
+                cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_{column}_idx ON {table} ({column}, deploy_datetime DESC, build_id DESC)")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_failed_idx ON {table} (deploy_datetime DESC, build_id DESC) WHERE status = FALSE")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_aborted_idx ON {table} (deploy_datetime DESC, build_id DESC) WHERE aborted")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_running_idx ON {table} (deploy_datetime DESC, build_id DESC) WHERE run_state <> 'finished'")
+        conn.commit()
+        cur.close()
+
+# run type -> (history table, [(column, list key, detail key), ...])
+HISTORY_TABLES = {
+    'fr': ('deploy_fr_history', [('fr_version', 'fr-version', 'fr-version'),
+                                 ('structure_search_version', 'structure-search-version', 'structure-search-version')]),
+    'ml': ('deploy_ml_history', [('branch_name', 'branchName', 'branchName'),
+                                 ('environment_type', 'environmentType', 'environmentType')]),
+    'cj': ('deploy_cj_history', [('job_name', 'jobName', 'job-name'),
+                                 ('branch_name', 'branchName', 'branchName'),
+                                 ('environment_type', 'environmentType', 'environmentType')]),
+}
+
+# Extra history list filters per run type: query parameter -> columns (matched with OR)
+HISTORY_FILTERS = {
+    'fr': {'fr-version': ['fr_version'], 'structure-search-version': ['structure_search_version'],
+           'version': ['fr_version', 'structure_search_version']},
+    'ml': {'branchName': ['branch_name'], 'environmentType': ['environment_type']},
+    'cj': {'job-name': ['job_name'], 'branchName': ['branch_name'], 'environmentType': ['environment_type']},
+}
+HISTORY_CACHE_TTL = int(os.getenv('HISTORY_CACHE_TTL', '300'))  # seconds a cached history page is kept
+HISTORY_PAGE_SIZE = 10
+HISTORY_MAX_PAGE_SIZE = 100
+SEARCH_CONFIG = 'simple'  # text search configuration; no stemming, so error tokens match as written
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_SNIPPET_LINES = 5  # matching lines returned per build
+SEARCH_SNIPPET_WIDTH = 300  # characters kept of each matching line
+
+INSERT_LOG_CHUNK_SQL = ("INSERT INTO deploy_log_chunks (run_type, build_id, seq, content_z, codec, line_start, line_count, search_vector) "
+                        f"VALUES (%s, %s, %s, %s, %s, %s, %s, to_tsvector('{SEARCH_CONFIG}', %s))")
+LOG_CHUNKS_SQL = "SELECT line_start, codec, content_z, content FROM deploy_log_chunks WHERE run_type = %s AND build_id = %s ORDER BY seq"
+LOG_CHUNKS_PAGE_SQL = ("SELECT seq, line_start, codec, content_z, content FROM deploy_log_chunks "
+                       "WHERE run_type = %s AND build_id = %s AND seq > %s ORDER BY seq LIMIT %s")
+LOG_RANGE_PAGE_SQL = ("SELECT seq, line_start, codec, content_z, content FROM deploy_log_chunks "
+                      "WHERE run_type = %s AND build_id = %s AND line_start < %s AND line_start + line_count > %s "
+                      "AND seq > %s ORDER BY seq LIMIT %s")
+LOG_STATS_SQL = ("SELECT COALESCE(MAX(line_start + line_count), 0), COUNT(*), COUNT(*) FILTER (WHERE content_z IS NULL) "
+                 "FROM deploy_log_chunks WHERE run_type = %s AND build_id = %s")
+
+def compress_log(text):
+    """Compress a log chunk with LOG_CODEC; returns (codec, bytes)."""
+    data = text.encode('utf-8')
+    if LOG_CODEC == 'zstd':
+        return 'zstd', zstandard.ZstdCompressor(level=3).compress(data)
+    return 'zlib', zlib.compress(data, 6)
+
+def decompress_log(codec, data, content=None):
+    """Return the text of a stored chunk; `content` is the plain text of uncompressed legacy chunks."""
+    if data is None:
+        return content or ''
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(bytes(data)).decode('utf-8')
+    return zlib.decompress(bytes(data)).decode('utf-8')
+
+def count_log_lines(text):
+    """Number of lines in a chunk; an unterminated last line counts as a line."""
+    return text.count('\n') + (1 if text and not text.endswith('\n') else 0)
+
+def search_text(text):
+    """Text as it is indexed for search: punctuation becomes spaces, so the parts of
+    dotted names, paths and task names (com.marklogic..., :mlDeploy) are separate words."""
+    return re.sub(r'[^\w\s]+', ' ', text)
+
+def log_chunk_params(run_type, build_id, seq, line_start, content):
+    codec, data = compress_log(content)
+    return (run_type, build_id, seq, data, codec, line_start, count_log_lines(content), search_text(content))
+
+def split_log_chunks(text, size=LOG_FLUSH_BYTES):
+    """Split a whole log into line-aligned pieces of about `size` characters: yields (line_start, piece)."""
+    line_start = 0
+    pos = 0
+    while pos < len(text):
+        cut = text.rfind('\n', pos, pos + size) + 1
+        if cut <= pos:
+            cut = text.find('\n', pos + size) + 1 or len(text)
+        piece = text[pos:cut]
+        yield line_start, piece
+        line_start += count_log_lines(piece)
+        pos = cut
+
+def assemble_log(rows, legacy_log=None):
+    """Join LOG_CHUNKS_SQL rows into the full log text, falling back to a legacy output_log."""
+    if not rows:
+        return legacy_log
+    return ''.join(decompress_log(codec, data, content) for _, codec, data, content in rows)
+
+def resolve_log_range(total, start, end, tail):
+    """Turn start/end/tail request parameters into a [start, end) line range."""
+    if tail is not None:
+        return max(0, total - tail), total
+    start = max(0, start or 0)
+    end = total if end is None else min(end, total)
+    return start, max(start, end)
+
+def slice_log_lines(line_start, text, start, end):
+    """Return the lines of a chunk (whose first line is `line_start`) that fall in [start, end)."""
+    lines = text.split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+    first = max(0, start - line_start)
+    last = min(len(lines), end - line_start)
+    if first >= last:
+        return ''
+    return '\n'.join(lines[first:last]) + '\n'
+
+def insert_run_sql(run_type):
+    table, fields = HISTORY_TABLES[run_type]
+    columns = ', '.join(f[0] for f in fields)
+    placeholders = ', '.join(['%s'] * len(fields))
+    return f"INSERT INTO {table} (deploy_datetime, {columns}, run_state) VALUES (%s, {placeholders}, 'running') RETURNING build_id"
+
+def record_commit_sql(run_type):
+    return f"UPDATE {HISTORY_TABLES[run_type][0]} SET commit_sha = %s WHERE build_id = %s"
+
+def record_reused_build_sql(run_type):
+    return f"UPDATE {HISTORY_TABLES[run_type][0]} SET reused_build_id = %s WHERE build_id = %s"
+
+def finish_run_sql(run_type):
+    table = HISTORY_TABLES[run_type][0]
+    return f"UPDATE {table} SET status = %s, aborted = %s, run_state = 'finished' WHERE build_id = %s"
+
+def parse_bool_param(name, value):
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    raise ValueError(f"{name} must be true or false")
+
+def encode_history_cursor(dt, build_id):
+    return base64.urlsafe_b64encode(f"{dt.isoformat()}|{build_id}".encode()).decode()
+
+def decode_history_cursor(cursor):
+    try:
+        dt, build_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.datetime.fromisoformat(dt), int(build_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("cursor is invalid")
+
+def history_list_query(run_type, args):
+    """Build the keyset-paginated history query for the request's filters.
+
+    Returns (sql, params, limit); the query fetches limit + 1 rows so the caller can
+    tell whether there is a next page. Raises ValueError for malformed parameters.
+    """
+    table, fields = HISTORY_TABLES[run_type]
+    columns = ', '.join(f[0] for f in fields)
+    conditions = []
+    params = []
+    for name, column in [('status', 'status'), ('aborted', 'aborted')]:
+        if args.get(name):
+            conditions.append(f"{column} = %s")
+            params.append(parse_bool_param(name, args.get(name)))
+    if args.get('state'):
+        conditions.append("run_state = %s")
+        params.append(args.get('state'))
+    for name, filter_columns in HISTORY_FILTERS[run_type].items():
+        if args.get(name):
+            conditions.append('(' + ' OR '.join(f"{column} = %s" for column in filter_columns) + ')')
+            params.extend([args.get(name)] * len(filter_columns))
+    for name, op in [('from', '>='), ('to', '<')]:
+        if args.get(name):
+            try:
+                params.append(datetime.datetime.fromisoformat(args.get(name)))
+            except ValueError:
+                raise ValueError(f"{name} must be an ISO 8601 date or datetime")
+            conditions.append(f"deploy_datetime {op} %s")
+    if args.get('cursor'):
+        conditions.append("(deploy_datetime, build_id) < (%s, %s)")
+        params.extend(decode_history_cursor(args.get('cursor')))
+    try:
+        limit = int(args.get('limit', HISTORY_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ''
+    sql = (f"SELECT build_id, deploy_datetime, status, {columns}, aborted, run_state, commit_sha, reused_build_id FROM {table} {where}"
+           f"ORDER BY deploy_datetime DESC, build_id DESC LIMIT {limit + 1}")
+    return sql, params, limit
+
+def history_page(run_type, rows, limit, path, args):
+    """Format one page of history rows; returns (items, pagination headers)."""
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encode_history_cursor(rows[-1][1], rows[-1][0])
+        query = {k: v for k, v in args.items() if k != 'cursor'}
+        query['cursor'] = cursor
+        headers['X-Next-Cursor'] = cursor
+        headers['Link'] = f'<{path}?{urlencode(query)}>; rel="next"'
+    return [format_history_item(run_type, row) for row in rows], headers
+
+def history_detail_sql(run_type):
+    table, fields = HISTORY_TABLES[run_type]
+    columns = ', '.join(f[0] for f in fields)
+    return f"SELECT deploy_datetime, output_log, status, {columns}, aborted, run_state, commit_sha, reused_build_id FROM {table} WHERE build_id = %s"
+
+def format_history_item(run_type, row):
+    fields = HISTORY_TABLES[run_type][1]
+    item = {'buildId': str(row[0]), 'datetime': row[1].isoformat(), 'status': row[2]}
+    for i, field in enumerate(fields):
+        item[field[1]] = row[3 + i]
+    item['aborted'] = row[3 + len(fields)]
+    item['state'] = row[4 + len(fields)]
+    item['commit'] = row[5 + len(fields)]
+    item['reusedBuildId'] = row[6 + len(fields)]
+    return item
+
+def format_history_detail(run_type, build_id, row):
+    fields = HISTORY_TABLES[run_type][1]
+    item = {'buildId': str(build_id), 'datetime': row[0].isoformat(), 'output_log': row[1], 'status': row[2]}
+    for i, field in enumerate(fields):
+        item[field[2]] = row[3 + i]
+    item['aborted'] = row[3 + len(fields)]
+    item['state'] = row[4 + len(fields)]
+    item['commit'] = row[5 + len(fields)]
+    item['reusedBuildId'] = row[6 + len(fields)]
+    return item
+
+def history_detail_json(item):
+    """The JSON of a history detail as (head, tail) around the inside of its output_log string.
+
+    The log is streamed between the two, chunk by chunk (each JSON-escaped), so
+    a run's log never has to be assembled in memory.
+    """
+    head, tail = json.dumps({**item, 'output_log': ''}).split('"output_log": ""', 1)
+    return head + '"output_log": "', '"' + tail
+
+INSERT_STEP_SQL = "INSERT INTO deploy_run_steps (run_type, build_id, seq, name, command, started_at) VALUES (%s, %s, %s, %s, %s, %s)"
+FINISH_STEP_SQL = ("UPDATE deploy_run_steps SET finished_at = %s, duration_ms = %s, exit_code = %s, output_bytes = %s, outcome = %s, "
+                   "startup_ms = %s, execution_ms = %s, abort_exit_ms = %s WHERE run_type = %s AND build_id = %s AND seq = %s")
+RUN_STEPS_SQL = ("SELECT build_id, name, started_at, finished_at, duration_ms, exit_code, output_bytes, outcome, startup_ms, execution_ms, "
+                 "abort_exit_ms "
+                 "FROM deploy_run_steps WHERE run_type = %s AND build_id = ANY(%s) ORDER BY build_id, seq")
+
+def format_run_step(row):
+    return {
+        'name': row[1],
+        'startedAt': row[2].isoformat(),
+        'finishedAt': row[3].isoformat() if row[3] else None,
+        'durationMs': row[4],
+        'exitCode': row[5],
+        'bytes': row[6],
+        'outcome': row[7],
+        'startupMs': row[8],
+        'executionMs': row[9],
+        'abortExitMs': row[10],
+    }
+
+def add_run_steps(items, rows):
+    """Attach RUN_STEPS_SQL rows to formatted history items as their `steps` list."""
+    steps = {}
+    for row in rows:
+        steps.setdefault(str(row[0]), []).append(format_run_step(row))
+    for item in items:
+        item['steps'] = steps.get(item['buildId'], [])
+    return items
+
+# Deployment queue. Every run gets a deploy_queue row; runs that find their lock scope
+# busy wait in state 'queued' until a worker starts them. scope_key is the
+# environment lock of the run, and positions count runs waiting for the same one.
+ENQUEUE_SQL = ("INSERT INTO deploy_queue (run_type, params, priority, scope_key, state, started_at) "
+               "VALUES (%s, %s, %s, %s, %s, CASE WHEN %s THEN localtimestamp END) RETURNING run_id")
+QUEUE_WAITING_SQL = "SELECT EXISTS (SELECT 1 FROM deploy_queue WHERE state = 'queued' AND scope_key = %s)"
+QUEUE_CANDIDATES_SQL = ("SELECT run_id, run_type, params, scope_key, EXTRACT(EPOCH FROM localtimestamp - enqueued_at) "
+                        "FROM deploy_queue WHERE state = 'queued' "
+                        "ORDER BY priority DESC, run_id FOR UPDATE SKIP LOCKED")
+QUEUE_START_SQL = "UPDATE deploy_queue SET state = 'running', started_at = localtimestamp WHERE run_id = %s"
+QUEUE_BUILD_SQL = "UPDATE deploy_queue SET build_id = %s WHERE run_id = %s"
+QUEUE_FINISH_SQL = "UPDATE deploy_queue SET state = 'finished' WHERE run_id = %s AND state = 'running'"
+QUEUE_ERROR_SQL = "UPDATE deploy_queue SET error = %s WHERE run_id = %s"
+QUEUE_CANCEL_SQL = "UPDATE deploy_queue SET state = 'cancelled' WHERE run_id = %s AND state = 'queued' RETURNING run_id"
+QUEUE_COLUMNS = ("run_id, run_type, params, priority, state, enqueued_at, started_at, build_id, "
+                 "EXTRACT(EPOCH FROM COALESCE(started_at, localtimestamp) - enqueued_at) * 1000, error")
+QUEUE_RUN_SQL = f"""
+    SELECT {QUEUE_COLUMNS},
+           CASE WHEN state = 'queued' THEN (
+               SELECT count(*) + 1 FROM deploy_queue a
+               WHERE a.state = 'queued' AND a.scope_key = q.scope_key
+                 AND (a.priority > q.priority OR (a.priority = q.priority AND a.run_id < q.run_id))
+           ) END
+    FROM deploy_queue q WHERE run_id = %s
+"""
+QUEUE_LIST_SQL = f"""
+    SELECT {QUEUE_COLUMNS},
+           CASE WHEN state = 'queued' THEN row_number() OVER (PARTITION BY scope_key, state ORDER BY priority DESC, run_id) END
+    FROM deploy_queue WHERE state IN ('queued', 'running')
+    ORDER BY state = 'queued', priority DESC, run_id
+"""
+QUEUE_PRUNE_SQL = """
+    DELETE FROM deploy_queue WHERE run_id IN (
+        SELECT run_id FROM deploy_queue
+        WHERE state NOT IN ('queued', 'running') AND enqueued_at < localtimestamp - %s * interval '1 day'
+        LIMIT %s)
+"""
+QUEUE_WAIT_STATS_SQL = """
+    SELECT count(*), avg(wait_ms), percentile_cont(0.5) WITHIN GROUP (ORDER BY wait_ms),
+           percentile_cont(0.95) WITHIN GROUP (ORDER BY wait_ms), max(wait_ms)
+    FROM (SELECT EXTRACT(EPOCH FROM started_at - enqueued_at) * 1000 AS wait_ms FROM deploy_queue
+          WHERE started_at > localtimestamp - %s * interval '1 second') w
+"""
+
+def queue_params(args):
+    """(priority, queue) of a run request; raises ValueError for invalid values."""
+    try:
+        priority = int(args.get('priority') or '0')
+    except ValueError:
+        raise ValueError("priority must be an integer")
+    return priority, parse_bool_param('queue', args.get('queue') or 'true')
+
+def batch_params(args):
+    """(job names, concurrency) of a corb job batch request; raises ValueError for invalid values."""
+    jobs = list(dict.fromkeys(job.strip() for job in (args.get('jobs') or '').split(',') if job.strip()))
+    if not jobs:
+        raise ValueError("jobs must list at least one corb job")
+    if len(jobs) > CORB_BATCH_MAX_JOBS:
+        raise ValueError(f"jobs may list at most {CORB_BATCH_MAX_JOBS} corb jobs")
+    invalid = [job for job in jobs if not CORB_JOB_NAME_RE.match(job)]
+    if invalid:
+        raise ValueError(f"Invalid corb job names: {', '.join(invalid)}")
+    try:
+        concurrency = int(args.get('concurrency') or '1')
+    except ValueError:
+        raise ValueError("concurrency must be an integer")
+    if not 1 <= concurrency <= CORB_BATCH_CONCURRENCY:
+        raise ValueError(f"concurrency must be between 1 and {CORB_BATCH_CONCURRENCY}")
+    return jobs, concurrency
+
+def batch_stream_id(run_id):
+    """RunStream id of the combined output of the corb job batch queued as `run_id`."""
+    return f"batch-{run_id}"
+
+def prefix_lines(name, text):
+    return ''.join(f"[{name}] {line}" if line.strip() else line for line in text.splitlines(True))
+
+def enqueue_params(run_type, args, scope, priority, running):
+    """ENQUEUE_SQL parameters; running runs start right away instead of waiting."""
+    params = json.dumps({key: args.get(key) for key in args})
+    return (run_type, params, priority, scope.env_key, 'running' if running else 'queued', running)
+
+def format_queue_entry(row):
+    return {
+        'runId': row[0],
+        'type': row[1],
+        'params': row[2],
+        'priority': row[3],
+        'state': row[4],
+        'position': row[10],
+        'enqueuedAt': row[5].isoformat(),
+        'startedAt': row[6].isoformat() if row[6] else None,
+        'buildId': str(row[7]) if row[7] is not None else None,
+        'waitMs': int(row[8]),
+        'error': row[9],
+    }
+
+def format_queue_wait_stats(row):
+    count, avg, p50, p95, longest = row
+    return {'window': QUEUE_STATS_WINDOW, 'started': count,
+            'avgMs': int(avg) if avg is not None else None, 'p50Ms': int(p50) if p50 is not None else None,
+            'p95Ms': int(p95) if p95 is not None else None, 'maxMs': int(longest) if longest is not None else None}
+
+SEARCH_BUILDS_SQL = f"""
+    SELECT run_type, build_id, MAX(ts_rank_cd(search_vector, query)) AS rank
+    FROM deploy_log_chunks, websearch_to_tsquery('{SEARCH_CONFIG}', %s) query
+    WHERE search_vector @@ query AND run_type = ANY(%s)
+    GROUP BY run_type, build_id
+    ORDER BY rank DESC, build_id DESC
+    LIMIT %s
+"""
+SEARCH_CHUNKS_SQL = f"""
+    SELECT build_id, line_start, codec, content_z, content
+    FROM deploy_log_chunks, websearch_to_tsquery('{SEARCH_CONFIG}', %s) query
+    WHERE run_type = %s AND build_id = ANY(%s) AND search_vector @@ query
+    ORDER BY build_id, seq
+"""
+
+def search_params(args):
+    """Parse /api/v1/search parameters into (query, run types, limit); raises ValueError."""
+    # Split words joined by punctuation the same way search_text does; quotes and a leading - keep their meaning
+    query = re.sub(r'(?<=\w)[^\w\s"]+(?=\w)', ' ', (args.get('q') or '').strip())
+    if not query:
+        raise ValueError("q is required")
+    run_types = [t for t in (args.get('type') or ','.join(RUN_TYPES)).split(',') if t]
+    unknown = [t for t in run_types if t not in RUN_TYPES]
+    if unknown:
+        raise ValueError(f"Unknown run type '{unknown[0]}'")
+    try:
+        limit = int(args.get('limit', SEARCH_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    return query, run_types, max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+
+def search_terms(query):
+    """Lower-cased words a log line must contain to be shown as a snippet (negated terms are skipped)."""
+    terms = []
+    for token in re.findall(r'-?"[^"]*"|\S+', query):
+        if token.startswith('-') or token.lower() == 'or':
+            continue
+        terms.extend(word.lower() for word in re.findall(r'\w+', token))
+    return terms
+
+def search_snippets(line_start, text, terms, limit):
+    """Up to `limit` lines of a chunk that contain one of `terms`, with their line numbers."""
+    snippets = []
+    for i, line in enumerate(text.split('\n')):
+        lowered = line.lower()
+        if any(term in lowered for term in terms):
+            snippets.append({'line': line_start + i, 'text': line[:SEARCH_SNIPPET_WIDTH]})
+            if len(snippets) >= limit:
+                break
+    return snippets
+
+def add_search_snippets(snippets, run_type, rows, terms):
+    """Collect snippets from SEARCH_CHUNKS_SQL rows into `snippets`, keyed by (run type, build id)."""
+    for build_id, line_start, codec, data, content in rows:
+        found = snippets.setdefault((run_type, build_id), [])
+        if len(found) < SEARCH_SNIPPET_LINES:
+            text = decompress_log(codec, data, content)
+            found.extend(search_snippets(line_start or 0, text, terms, SEARCH_SNIPPET_LINES - len(found)))
+
+def history_rows_sql(run_type):
+    """History list columns of the given build ids, in the row layout format_history_item expects."""
+    table, fields = HISTORY_TABLES[run_type]
+    columns = ', '.join(f[0] for f in fields)
+    return f"SELECT build_id, deploy_datetime, status, {columns}, aborted, run_state, commit_sha, reused_build_id FROM {table} WHERE build_id = ANY(%s)"
+
+def format_search_hit(run_type, build_id, rank, history_row, snippets):
+    item = format_history_item(run_type, history_row) if history_row else {'buildId': str(build_id)}
+    item['type'] = run_type
+    item['rank'] = round(float(rank), 4)
+    item['snippets'] = snippets
+    return item
+
+def history_version_key(run_type):
+    return f"history_version:{run_type}"
+
+def history_cache_key(run_type, args):
+    """Return (cache key, digest) for a history listing request's query parameters."""
+    digest = hashlib.sha1(urlencode(sorted(args.items())).encode()).hexdigest()[:16]
+    return f"history_cache:{run_type}:{digest}", digest
+
+def history_etag(run_type, version, digest):
+    return f'W/"{run_type}-{version}-{digest}"'
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or etag[2:] in tags
+
+stale_history_versions = set()  # run types whose version could be neither bumped nor deleted after a write
+
+def bump_history_version(run_type):
+    """Invalidate every cached history page of `run_type` after a write.
+
+    When the version can't be incremented it is deleted instead. If that fails
+    too, this process serves the listing without ETag or cache until a bump succeeds.
+    """
+    key = history_version_key(run_type)
+    try:
+        r.incr(key)
+        stale_history_versions.discard(run_type)
+        return
+    except redis.RedisError as e:
+        print(f"Error invalidating {run_type} history cache: {str(e)}")
+    try:
+        r.delete(key)
+        stale_history_versions.discard(run_type)
+    except redis.RedisError as e:
+        print(f"Error deleting {run_type} history version: {str(e)}")
+        stale_history_versions.add(run_type)
+
+def new_history_version():
+    # Replaces a lost version key; no ETag or cached page was issued for it
+    return time.time_ns()
+
+def read_history_cache(run_type, cache_key):
+    """(version, cached page) of a history listing, or (None, None) when the version can't be trusted."""
+    if run_type in stale_history_versions:
+        bump_history_version(run_type)
+        if run_type in stale_history_versions:
+            return None, None
+    key = history_version_key(run_type)
+    try:
+        version, cached = r.mget(key, cache_key)
+        if version is None:
+            r.set(key, new_history_version(), nx=True)
+            version, cached = r.get(key), None
+    except redis.RedisError as e:
+        print(f"Error reading {run_type} history cache: {str(e)}")
+        return None, None
+    return int(version), cached
+
+def insert_run(run_type, dt, *values):
+    """Insert a running history row for `run_type` and return its build ID."""
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(insert_run_sql(run_type), (dt, *values))
+        build_id = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+    bump_history_version(run_type)
+    return build_id
+
+def finish_run(run_type, build_id, sink, status, aborted=False):
+    """Flush the remaining log output and store the outcome of a run."""
+    sink.close()
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(finish_run_sql(run_type), (status, aborted, build_id))
+        conn.commit()
+        cur.close()
+    bump_history_version(run_type)
+
+class SpillBuffer:
+    """Run output waiting to be persisted: in memory up to LOG_MEMORY_LIMIT, then in a temporary file.
+
+    Output leaves oldest first in chunks of whole lines of at most 4 *
+    LOG_FLUSH_BYTES (peek, then consume once the chunk is stored), so a run's memory stays flat
+    however much it prints and however long the database is unavailable. While
+    the file exists all new output is appended to it; it is deleted once drained.
+    """
+
+    def __init__(self):
+        self.size = 0  # bytes waiting
+        self.since = None  # monotonic time the oldest waiting output arrived
+        self._memory = []
+        self._file = None
+        self._read = 0  # offset of the first waiting byte in _file
+
+    def append(self, text):
+        data = text.encode('utf-8')
+        if self.since is None:
+            self.since = time.monotonic()
+        if self._file is None and self.size + len(data) > LOG_MEMORY_LIMIT:
+            self._file = tempfile.TemporaryFile(prefix='deploy-log-', dir=LOG_SPILL_DIR)
+            self._read = 0
+            self._file.write(b''.join(self._memory))
+            LOG_SPILLED_BYTES.inc(self.size)
+            self._memory = []
+        if self._file is not None:
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(data)
+            LOG_SPILLED_BYTES.inc(len(data))
+        else:
+            self._memory.append(data)
+        self.size += len(data)
+
+    def peek(self, final=False):
+        """The next chunk as (text, bytes), or None when there is none yet.
+
+        A trailing partial line is held back unless `final`, or unless it
+        outgrows 4 * LOG_FLUSH_BYTES (a single enormous line).
+        """
+        if not self.size:
+            return None
+        if self._file is not None:
+            self._file.seek(self._read)
+            data = self._file.read(4 * LOG_FLUSH_BYTES)
+        else:
+            self._memory = [b''.join(self._memory)]
+            data = self._memory[0][:4 * LOG_FLUSH_BYTES]
+        complete = len(data) == self.size
+        cut = data.rfind(b'\n') + 1
+        if cut == 0:
+            if complete and not final:
+                return None
+            cut = len(data)
+        # Never split a multi-byte character
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        text = decoder.decode(data[:cut], final=complete and cut == len(data))
+        return text, cut - len(decoder.getstate()[0])
+
+    def consume(self, size):
+        """Drop the first `size` bytes, once they are persisted."""
+        self.size -= size
+        if self._file is not None:
+            self._read += size
+            if not self.size:
+                self.close()
+        else:
+            self._memory = [self._memory[0][size:]] if self.size else []
+        self.since = time.monotonic() if self.size else None
+
+    def close(self):
+        """Discard whatever is still waiting."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._memory = []
+        self.size = 0
+        self.since = None
+
+class LogSink:
+    """Buffer run output and persist it as numbered, compressed chunks in deploy_log_chunks.
+
+    Buffered output (a SpillBuffer) is flushed once it reaches LOG_FLUSH_BYTES,
+    or once it is older than LOG_FLUSH_INTERVAL (checked on write and by a
+    background flusher so quiet steps are persisted too). Chunks end on a line
+    boundary so line ranges can be served from the chunks that contain them.
+    """
+
+    _open_sinks = set()
+    _registry_lock = threading.Lock()
+    _flusher = None
+
+    def __init__(self, run_type, build_id, stream=None):
+        self.run_type = run_type
+        self.build_id = build_id
+        self.stream = stream
+        self.seq = 0
+        self.lines = 0
+        self.bytes_written = 0
+        self._buffer = SpillBuffer()
+        self._lock = threading.Lock()
+        self._closed = False
+        with LogSink._registry_lock:
+            LogSink._open_sinks.add(self)
+            if LogSink._flusher is None:
+                LogSink._flusher = threading.Thread(target=LogSink._flush_loop, daemon=True)
+                LogSink._flusher.start()
+
+    def write(self, text):
+        if not text:
+            return
+        if self.stream is not None:
+            self.stream.publish(text)
+        with self._lock:
+            self._buffer.append(text)
+            if self._buffer.size >= LOG_FLUSH_BYTES or self._is_stale():
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        """Flush everything still buffered; safe to call more than once."""
+        with self._lock:
+            self._flush_locked(final=True)
+            if self._buffer.size:
+                print(f"Dropping {self._buffer.size} unpersisted bytes of {self.run_type} build {self.build_id}")
+                self._buffer.close()
+            already_closed = self._closed
+            self._closed = True
+        with LogSink._registry_lock:
+            LogSink._open_sinks.discard(self)
+        if self.stream is not None and not already_closed:
+            self.stream.finish()
+
+    def _is_stale(self):
+        return self._buffer.since is not None and time.monotonic() - self._buffer.since >= LOG_FLUSH_INTERVAL
+
+    def _flush_locked(self, final=False):
+        while True:
+            chunk = self._buffer.peek(final)
+            if chunk is None:
+                return
+            content, size = chunk
+            try:
+                with db_pool.connection() as conn:
+                    cur = conn.cursor()
+                    cur.execute(INSERT_LOG_CHUNK_SQL, log_chunk_params(self.run_type, self.build_id, self.seq, self.lines, content))
+                    conn.commit()
+                    cur.close()
+            except Exception as e:
+                # Keep the output buffered so the next flush retries it
+                print(f"Error flushing log chunk {self.seq} for {self.run_type} build {self.build_id}: {str(e)}")
+                return
+            self.seq += 1
+            self.lines += count_log_lines(content)
+            self.bytes_written += len(content)
+            self._buffer.consume(size)
+
+    @staticmethod
+    def _flush_loop():
+        while True:
+            time.sleep(LOG_FLUSH_INTERVAL)
+            with LogSink._registry_lock:
+                sinks = list(LogSink._open_sinks)
+            for sink in sinks:
+                with sink._lock:
+                    if not sink._closed and sink._is_stale():
+                        sink._flush_locked()
+
+def fail_run(run_type, build_id, sink, error):
+    """Store a run that stopped on an error of the dashboard itself as failed, with the error as its last output."""
+    msg = f"❌ {RUN_NOUNS[run_type]} Failed: {error}\n\n"
+    sink.write(msg)
+    finish_run(run_type, build_id, sink, False, False)
+    return msg
+
+def run_stream_key(run_type, build_id):
+    return f"run_stream:{run_type}:{build_id}"
+
+class RunStream:
+    """Publish a run's output once to a Redis Stream that any number of viewers can tail.
+
+    Entry ids are `<character offset>-1`, so viewers can resume from the number of
+    characters they already received. The final entry carries an `end` marker.
+    Only the newest STREAM_MAX_BYTES of output are kept; older entries are
+    trimmed by id, and viewers read that output from the stored log instead.
+    """
+
+    def __init__(self, run_type, build_id, register=True):
+        self.run_type = run_type
+        self.build_id = build_id
+        self.key = run_stream_key(run_type, build_id)
+        self.offset = 0
+        self.entries = collections.deque()  # (offset, bytes) of the entries kept in the stream
+        self.size = 0  # bytes of output kept in the stream
+        if not register:  # not a build (a batch's combined output): not listed in active_runs
+            return
+        try:
+            r.hset(f"active_runs:{run_type}", build_id, datetime.datetime.now().isoformat())
+        except redis.RedisError as e:
+            print(f"Error registering active {run_type} run {build_id}: {str(e)}")
+
+    def publish(self, text):
+        size = len(text.encode())
+        self.entries.append((self.offset, size))
+        self.size += size
+        trimmed = False
+        while self.size > STREAM_MAX_BYTES and len(self.entries) > 1:
+            self.size -= self.entries.popleft()[1]
+            trimmed = True
+        try:
+            pipe = r.pipeline(transaction=False)
+            pipe.xadd(self.key, {'d': text}, id=f"{self.offset}-1")
+            if trimmed:
+                pipe.xtrim(self.key, minid=f"{self.entries[0][0]}-0", approximate=False)
+            pipe.expire(self.key, STREAM_TTL)  # a stream outlives its run by STREAM_TTL even if the run never finishes
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Error publishing output for {self.run_type} build {self.build_id}: {str(e)}")
+        self.offset += len(text)
+
+    def finish(self):
+        try:
+            pipe = r.pipeline()
+            pipe.xadd(self.key, {'end': '1'}, id=f"{self.offset}-2")
+            pipe.expire(self.key, STREAM_TTL)
+            pipe.hdel(f"active_runs:{self.run_type}", self.build_id)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Error closing output stream for {self.run_type} build {self.build_id}: {str(e)}")
+
+def stream_entry_offset(entry_id):
+    """Character offset at which a RunStream entry starts."""
+    return int(entry_id.decode().split('-')[0])
+
+def close_interrupted_stream(run_type, build_id):
+    """End the output stream of a run that died without finishing it, so its viewers stop waiting."""
+    key = run_stream_key(run_type, build_id)
+    last = r.xrevrange(key, count=1)
+    if not last or b'end' in last[0][1]:
+        return
+    offset = stream_entry_offset(last[0][0]) + len(last[0][1][b'd'].decode())
+    pipe = r.pipeline()
+    pipe.xadd(key, {'end': '1'}, id=f"{offset}-2")
+    pipe.expire(key, STREAM_TTL)
+    pipe.execute()
+
+def lag_resume_entry(position, newest):
+    """The entry a viewer that has received `position` characters skips ahead to, or None.
+
+    `newest` are the stream's last two entries, newest first. A viewer trailing
+    the run by more than STREAM_LAG_LIMIT characters resumes at the newest
+    output entry, so the run's closing message is never skipped.
+    """
+    if not STREAM_LAG_LIMIT or not newest or stream_entry_offset(newest[0][0]) - position <= STREAM_LAG_LIMIT:
+        return None
+    if b'end' in newest[0][1] and len(newest) > 1:
+        return newest[1]
+    return newest[0]
+
+def log_page_query(run_type, build_id, last_seq, lines=None):
+    """(sql, params) of the next LOG_PAGE_CHUNKS chunks of a build's log after seq `last_seq`.
+
+    With `lines` = (start, end), only chunks overlapping lines [start, end) are read.
+    """
+    if lines is None:
+        return LOG_CHUNKS_PAGE_SQL, (run_type, build_id, last_seq, LOG_PAGE_CHUNKS)
+    start, end = lines
+    return LOG_RANGE_PAGE_SQL, (run_type, build_id, end, start, last_seq, LOG_PAGE_CHUNKS)
+
+def log_chunks(run_type, build_id, lines=None):
+    """Yield (line_start, codec, content_z, content) of a build's log chunks in order (see log_page_query).
+
+    Each page is read on a pooled connection that is returned before the page
+    is yielded, so a slow reader never holds a connection.
+    """
+    last_seq = -1
+    while True:
+        sql, params = log_page_query(run_type, build_id, last_seq, lines)
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+            cur.close()
+            conn.rollback()
+        for row in rows:
+            yield row[1:]
+        if len(rows) < LOG_PAGE_CHUNKS:
+            return
+        last_seq = rows[-1][0]
+
+def stored_output(run_type, build_id, start, end):
+    """Yield a build's stored output from character offset `start` up to `end`.
+
+    Viewers read output already trimmed from the run's stream from here. Output
+    not yet stored, and the combined output of a batch, is not yielded.
+    """
+    if not str(build_id).isdigit():
+        return
+    offset = 0
+    for _, codec, data, content in log_chunks(run_type, build_id):
+        if offset >= end:
+            break
+        text = decompress_log(codec, data, content)
+        if offset + len(text) > start:
+            yield text[max(start - offset, 0):end - offset]
+        offset += len(text)
+
+def skipped_output_message(skipped, offset):
+    return f"⏩ Skipped {skipped} characters of output to catch up with the run; resuming at offset {offset}\n\n"
+
+def dropped_viewer_message(run_type, build_id, position):
+    return (f"❌ Stopped streaming: this viewer fell more than {STREAM_LAG_LIMIT} characters behind the run. "
+            f"Attach again with /api/v1/attach/{run_type}?buildId={build_id}&offset={position}\n\n")
+
+def tail_run_stream(run_type, build_id, offset=0):
+    """Yield a run's output from a character offset until the run ends.
+
+    Each viewer reads the stream at its own pace, so a slow one never holds up
+    the run. A viewer more than STREAM_LAG_LIMIT characters behind skips ahead
+    to the newest output, or with STREAM_LAG_POLICY=drop is disconnected; both
+    are announced in the viewer's output. Output trimmed from the stream
+    (STREAM_MAX_BYTES) before it was read comes from the stored log instead.
+    """
+    key = run_stream_key(run_type, build_id)
+    last_id = '0'
+    position = 0 if offset == 0 else None  # characters of the run's output received so far, when known
+    if offset > 0:
+        # Start inside the entry that contains the requested offset
+        entries = r.xrevrange(key, max=f"{offset}-1", min='-', count=1)
+        if entries:
+            entry_id, fields = entries[0]
+            start = stream_entry_offset(entry_id)
+            if b'd' in fields:
+                text = fields[b'd'].decode()
+                position = start + len(text)
+                yield text[offset - start:]
+            elif b'end' in fields:
+                return
+            last_id = entry_id
+        else:
+            position = offset  # the offset was trimmed from the stream
+    while True:
+        result = r.xread({key: last_id}, count=ATTACH_READ_COUNT, block=ATTACH_BLOCK_MS)
+        if not result:
+            if not r.exists(key) and not r.hexists(f"active_runs:{run_type}", build_id):
+                return
+            continue
+        entries = result[0][1]
+        lagging = False
+        if len(entries) == ATTACH_READ_COUNT and position is not None:
+            resume = lag_resume_entry(position, r.xrevrange(key, count=2))
+            if resume is not None:
+                if STREAM_LAG_POLICY == 'drop':
+                    yield dropped_viewer_message(run_type, build_id, position)
+                    return
+                entries = [resume]
+                lagging = True
+        for entry_id, fields in entries:
+            last_id = entry_id
+            start = stream_entry_offset(entry_id)
+            if position is not None and start > position and not lagging:
+                # Trimmed from the stream before this viewer read it
+                for text in stored_output(run_type, build_id, position, start):
+                    position += len(text)
+                    yield text
+            if position is not None and start > position:
+                yield skipped_output_message(start - position, start)
+            if b'end' in fields:
+                return
+            text = fields[b'd'].decode()
+            position = start + len(text)
+            yield text
+
+REQUIRED_PARAMS = {
+    'fr': ['fr-version', 'structure-search-version'],
+    'ml': ['branchName', 'environmentType'],
+    'cj': ['job-name', 'branchName', 'environmentType'],
+    'cj_batch': ['jobs', 'branchName', 'environmentType'],
+}
+
+def missing_params_error(run_type, args):
+    """Return the 400 error body for missing query parameters, or None if all are present."""
+    required = REQUIRED_PARAMS[run_type]
+    missing = [name for name in required if args.get(name) is None]
+    if not missing:
+        return None
+    if len(missing) == 1:
+        message = f"{missing[0]} is missing"
+    elif len(missing) == 2:
+        message = f"{missing[0]} and {missing[1]} are missing"
+    else:
+        message = f"{', '.join(missing[:-1])}, and {missing[-1]} are missing"
+    return {
+        "success": "false",
+        "error": "Missing required parameter",
+        "message": f"{message} in the query string",
+        "required_parameters": required,
+        "status_code": 400
+    }
+
+ENVIRONMENT_NAMES = {
+    'DEV-FULL': 'ls-dev-full-ml',
+    'DEV-SMALL': 'ls-dev-small-ml',
+    'INGESTION': 'ingestion',
+    'TEST': 'test',
+}
 
 def getEnvironmentName(environment_type):
-    if environment_type == 'DEV-FULL':
-        return 'ls-dev-full-ml'
-    if environment_type == 'DEV-SMALL':
-        return 'ls-dev-small-ml'
-    if environment_type == 'INGESTION':
-        return 'ingestion'
-    if environment_type == 'TEST':
-        return 'test'
-
-    
-
-def terminate_process_tree(pid, sig=signal.SIGTERM):
-    """Terminate a process and all its children using psutil."""
+    return ENVIRONMENT_NAMES.get(environment_type)
+
+def valid_branch_name(name):
+    """Whether `git check-ref-format --branch` accepts `name` as it is."""
     try:
-        parent = psutil.Process(pid)
-        children = parent.children(recursive=True)
-        for child in children:
-            child.send_signal(sig)
-        parent.send_signal(sig)
-    except psutil.NoSuchProcess:
+        result = subprocess.run(['git', 'check-ref-format', '--branch', name], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"Error checking branch name {name!r}: {str(e)}")
+        return False
+    # --branch expands @{-N} inside a repository; only names that are used verbatim are valid
+    return result.returncode == 0 and result.stdout.strip() == name
+
+def check_run_params(run_type, args):
+    """Validate the values of a run request (REQUIRED_PARAMS key); raises ValueError for invalid ones."""
+    if run_type == 'fr':
+        for name in REQUIRED_PARAMS['fr']:
+            if not VERSION_RE.match(args.get(name)):
+                raise ValueError(f"{name} may only contain letters, digits, '.', '_' and '-'")
+        parse_bool_param('force', args.get('force') or 'false')
+        return
+    if getEnvironmentName(args.get('environmentType')) is None:
+        raise ValueError(f"environmentType must be one of {', '.join(ENVIRONMENT_NAMES)}")
+    if not valid_branch_name(args.get('branchName')):
+        raise ValueError("branchName is not a valid git branch name")
+    if run_type == 'ml':
+        parse_bool_param('fullDeploy', args.get('fullDeploy') or 'false')
+    elif run_type == 'cj':
+        if not CORB_JOB_NAME_RE.match(args.get('job-name')):
+            raise ValueError("job-name is not a valid corb job name")
+    elif run_type == 'cj_batch':
+        batch_params(args)
+
+GRADLE_TIMING_INIT = """\
+// Installed by the deployment dashboard: reports when each build starts and finishes in the daemon
+println "[gradle-timing] start=${System.currentTimeMillis()}"
+gradle.buildFinished {
+    println "[gradle-timing] finished=${System.currentTimeMillis()}"
+}
+"""
+GRADLE_TIMING_RE = re.compile(r'^\[gradle-timing\] (start|finished)=(\d+)$', re.MULTILINE)
+
+class GradleDaemonPool:
+    """Warm Gradle daemons for MarkLogic deploys and corb jobs, one per environment.
+
+    Each environment gets its own GRADLE_USER_HOME, so its runs attach to that
+    home's daemon instead of paying JVM startup and project configuration again;
+    dependencies still come from the shared read-only cache. At most
+    GRADLE_MAX_DAEMONS environments keep a daemon (the least recently used one is
+    stopped first). A maintenance thread checks daemon health with
+    `gradlew --status`, stops daemons idle for GRADLE_IDLE_TIMEOUT and keeps
+    GRADLE_WARM_ENVIRONMENTS warm.
+    """
+
+    def __init__(self):
+        self._last_used = {}  # environment name -> time.monotonic() of its last lease
+        self._status = {}  # environment name -> daemon status seen by the last health check
+        self._lock = threading.Lock()
+
+    def home(self, env):
+        if not env:
+            raise ValueError("Gradle daemons need an environment name")
+        return os.path.join(GRADLE_HOME_ROOT, re.sub(r'[^A-Za-z0-9._-]+', '_', env))
+
+    def _prepare_home(self, env):
+        # Init scripts in GRADLE_USER_HOME/init.d apply to every build run with that home
+        init_dir = os.path.join(self.home(env), 'init.d')
+        os.makedirs(init_dir, exist_ok=True)
+        path = os.path.join(init_dir, 'dashboard-timing.gradle')
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                f.write(GRADLE_TIMING_INIT)
+
+    def lease(self, env):
+        """Return the shell prefix that runs ./gradlew against the environment's daemon."""
+        if not env:
+            raise ValueError("Gradle daemons need an environment name")
+        self._prepare_home(env)
+        with self._lock:
+            self._last_used[env] = time.monotonic()
+            others = sorted((e for e in self._last_used if e != env), key=self._last_used.get)
+            evicted = others[:max(0, len(self._last_used) - GRADLE_MAX_DAEMONS)]
+            for e in evicted:
+                del self._last_used[e]
+        for e in evicted:
+            threading.Thread(target=self.stop, args=(e,), daemon=True).start()
+        return f"env GRADLE_USER_HOME={shlex.quote(self.home(env))} GRADLE_RO_DEP_CACHE={shlex.quote(GRADLE_RO_DEP_CACHE)} "
+
+    def _gradlew(self, env, *args, timeout=120):
+        environ = {**os.environ, 'GRADLE_USER_HOME': self.home(env), 'GRADLE_RO_DEP_CACHE': GRADLE_RO_DEP_CACHE}
+        return subprocess.run(['./gradlew', *args], cwd=marklogic_path, env=environ,
+                              capture_output=True, text=True, timeout=timeout)
+
+    def status(self, env):
+        """'BUSY' or 'IDLE' for the environment's daemon, or None when it has none."""
+        try:
+            result = self._gradlew(env, '--status')
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Error checking the Gradle daemon for {env}: {str(e)}")
+            return None
+        statuses = re.findall(r'^\s*\d+\s+([A-Z]+)\b', result.stdout, re.MULTILINE)
+        for status in ('BUSY', 'IDLE'):
+            if status in statuses:
+                return status
+        return None
+
+    def stop(self, env):
+        """Stop the environment's daemon unless a build is running on it."""
+        if self.status(env) == 'BUSY':
+            return
+        try:
+            self._gradlew(env, '--stop')
+            print(f"Stopped the Gradle daemon for {env}")
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Error stopping the Gradle daemon for {env}: {str(e)}")
+        self._status.pop(env, None)
+
+    def warm(self, env):
+        """Start the environment's daemon and configure the project once."""
+        self._prepare_home(env)
+        try:
+            self._gradlew(env, '--daemon', 'help', '-q', timeout=600)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Error warming the Gradle daemon for {env}: {str(e)}")
+
+    def maintain(self):
+        """Health-check loop: stop idle daemons and re-warm the pinned environments."""
+        with self._lock:
+            for env in GRADLE_WARM_ENVIRONMENTS:
+                self._last_used.setdefault(env, time.monotonic())
+        while True:
+            with self._lock:
+                leased = dict(self._last_used)
+            for env, last_used in leased.items():
+                status = self.status(env)
+                idle = time.monotonic() - last_used
+                if env in GRADLE_WARM_ENVIRONMENTS:
+                    if status is None:
+                        self.warm(env)
+                        status = self.status(env)
+                elif status != 'BUSY' and idle > GRADLE_IDLE_TIMEOUT:
+                    with self._lock:
+                        if self._last_used.get(env) == last_used:
+                            del self._last_used[env]
+                    self.stop(env)
+                    continue
+                self._status[env] = status
+            time.sleep(GRADLE_HEALTH_INTERVAL)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {env: {'status': self._status.get(env), 'idle_seconds': int(now - last_used)}
+                    for env, last_used in self._last_used.items()}
+
+gradle_daemons = GradleDaemonPool()
+
+def gradle_timing(output, started_at):
+    """(startup ms, execution ms) of the Gradle builds in a step's output, or (None, None).
+
+    Startup runs from the start of the step to the first build starting in the
+    daemon (client JVM, daemon connection or spawn); execution sums the builds.
+    """
+    starts, ends = [], []
+    for kind, millis in GRADLE_TIMING_RE.findall(output):
+        (starts if kind == 'start' else ends).append(int(millis))
+    if not starts:
+        return None, None
+    startup_ms = max(0, starts[0] - int(started_at.timestamp() * 1000))
+    execution_ms = sum(end - start for start, end in zip(starts, ends)) if ends else None
+    return startup_ms, execution_ms
+
+def format_gradle_timing(startup_ms, execution_ms):
+    execution = f"{execution_ms / 1000:.1f}s" if execution_ms is not None else "n/a"
+    return f"\nGradle startup {startup_ms / 1000:.1f}s, execution {execution}\n"
+
+def format_abort_exit(abort_exit_ms):
+    return f"Process tree exited {abort_exit_ms / 1000:.2f}s after the abort\n\n"
+
+# A pipeline step; message-only steps (command None) have no name and are not timed.
+# A step with records_commit reports the commit it checked out on a "Resolved commit <sha>" line;
+# gradle steps report their startup and execution time (see GRADLE_TIMING_INIT).
+PipelineStep = collections.namedtuple('PipelineStep', ['name', 'message', 'command', 'records_commit', 'gradle'],
+                                      defaults=[False, False])
+RESOLVED_COMMIT_RE = re.compile(r'^Resolved commit ([0-9a-f]{40})$', re.MULTILINE)
+
+def step_markers(step, output):
+    """The lines of `output` the step's bookkeeping reads (resolved commit, Gradle timing).
+
+    Only these are kept while a step runs, never the step's whole output.
+    """
+    markers = []
+    if step.records_commit:
+        markers += [m.group(0) for m in RESOLVED_COMMIT_RE.finditer(output)]
+    if step.gradle:
+        markers += [m.group(0) for m in GRADLE_TIMING_RE.finditer(output)]
+    return markers
+
+def worktree_path(workspace, branch_name):
+    """Directory of the worktree used for `branch_name` by runs holding the `workspace` lock scope."""
+    parts = [re.sub(r'[^A-Za-z0-9._-]+', '_', part).lstrip('.') or '_' for part in (*workspace, branch_name)]
+    return os.path.join(WORKTREE_ROOT, *parts)
+
+def workspace_command(workspace, branch_name):
+    """Shell command bringing the branch's worktree to the remote head.
+
+    The remote head is read with `git ls-remote`; when the worktree is already
+    there nothing is fetched or checked out. Otherwise only the branch is
+    fetched and the worktree moves to that commit (a detached checkout, so the
+    same branch can also be checked out in the main clone), touching only the
+    files that differ. A missing worktree is created with `git worktree add`.
+
+    Worktrees belong to a lock scope, so runs that may execute concurrently
+    never share one. Fetches update no refs (and no FETCH_HEAD in the main
+    clone), and worktree creation is serialised with flock, so concurrent runs
+    don't contend on the shared repository.
+    """
+    branch = shlex.quote(branch_name)
+    path = worktree_path(workspace, branch_name)
+    worktree = shlex.quote(path)
+    fetch = f'fetch --no-write-fetch-head --refmap= origin refs/heads/{branch}'
+    # Messages are quoted whole: the branch name must never be expanded by the shell
+    return (
+        f'cd $(pwd)/{repo_name}/ && '
+        f'remote=$(git ls-remote origin refs/heads/{branch} | cut -f1) && '
+        f'if [ -z "$remote" ]; then echo {shlex.quote(f"Branch {branch_name} was not found on origin")}; exit 1; fi && '
+        f'if [ ! -e {worktree}/.git ]; then '
+        f'echo {shlex.quote(f"Creating worktree for {branch_name} at {path}")} && git {fetch} && '
+        f'exec 9>"$(git rev-parse --git-common-dir)/dashboard-worktree.lock" && flock 9 && '
+        f'git worktree prune && git worktree add --detach {worktree} "$remote"; '
+        f'elif [ "$(git -C {worktree} rev-parse HEAD)" = "$remote" ]; then '
+        f'echo {shlex.quote(f"Worktree for {branch_name} is already at the remote head, skipping checkout and pull")}; '
+        f'else echo {shlex.quote(f"Updating worktree for {branch_name} to")} "$remote" && git -C {worktree} {fetch} && '
+        f'git -C {worktree} checkout --detach "$remote"; fi && '
+        f'echo "Resolved commit $(git -C {worktree} rev-parse HEAD)"'
+    )
+
+def worktree_marklogic_path(workspace, branch_name):
+    return os.path.join(worktree_path(workspace, branch_name), os.path.relpath(marklogic_path, repo_name))
+
+RUN_NOUNS = {'fr': 'Deployment', 'ml': 'Deployment', 'cj': 'Job Run'}
+LOCK_CONFLICT_MESSAGES = {
+    'fr': "Deployment is going on for the frontend application.",
+    'ml': "Deployment is going on for the MarkLogic application or a corb job is running in {environment}.",
+    'cj': "corb job is already running or a MarkLogic deployment is in progress in {environment}.",
+}
+
+def frontend_pipeline(args, live_build=None):
+    """Steps deploying the frontend; only messages when `live_build` already deployed these versions."""
+    fr_version = args.get('fr-version')
+    structure_search_version = args.get('structure-search-version')
+    if live_build is not None:
+        return [
+            PipelineStep(None, f"UI/MIDDLEWARE VERSION {fr_version} and STRUCTURE SEARCH VERSION {structure_search_version} "
+                               f"are already deployed to DEV-FULL by build {live_build}\n", None),
+            PipelineStep(None, "Nothing to deploy; pass force=true to deploy them again\n", None),
+        ]
+    return [
+        PipelineStep(None, "Proceeding to deploy FRONTEND in DEV-FULL\n\n", None),
+        PipelineStep(None, f"UI VERSION --> {fr_version}\n", None),
+        PipelineStep(None, f"MIDDLEWARE VERSION --> {fr_version}\n", None),
+        PipelineStep(None, f"STRUCTURE SEARCH VERSION --> {structure_search_version}\n\n", None),
+        PipelineStep('script', None, f'./script.sh {shlex.quote(fr_version)} {shlex.quote(structure_search_version)}'),
+    ]
+
+def module_timestamps_path(EnvironmentName):
+    """ml-gradle's module timestamps file for the environment, kept next to its Gradle home."""
+    return os.path.join(gradle_daemons.home(EnvironmentName), 'module-timestamps.properties')
+
+def marklogic_deploy_command(EnvironmentName, previous_commit, full_deploy):
+    """Shell command deploying MarkLogic from the current worktree HEAD.
+
+    Without a previous commit, or when files outside ML_MODULES_PATH changed
+    since it, this is a full mlDeploy. When only module code changed (or
+    nothing did), mlLoadModules is enough. The decision is printed to the run output.
+
+    Both tasks skip modules whose timestamps file says they are unchanged. The
+    file is kept per environment, and a marker next to it records the worktree
+    and commit of the last successful load. Unless that is this worktree at the
+    previously deployed commit, what the file says is not what the environment
+    has: it is reset, so every module is loaded again.
+    """
+    gradle = gradle_daemons.lease(EnvironmentName)
+    stamps = module_timestamps_path(EnvironmentName)
+    loaded = shlex.quote(stamps + '.loaded')
+    properties = f'-PenvironmentName={EnvironmentName} -PmlModuleTimestampsPath={shlex.quote(stamps)}'
+    record = f'printf "%s %s\\n" "$PWD" "$(git rev-parse HEAD)" > {loaded}'
+    full = f'{gradle}./gradlew --daemon mlDeploy {properties} && {record}'
+    modules = f'{gradle}./gradlew --daemon mlLoadModules {properties} && {record}'
+    prev = shlex.quote(previous_commit or '')
+    lines = [
+        f'if [ "$(cat {loaded} 2>/dev/null)" != "$PWD "{prev} ]; then',
+        f'  rm -f {shlex.quote(stamps)}',
+        '  echo "Module timestamps are not from this worktree at the deployed commit: loading every module"',
+        'fi',
+        f'rm -f {loaded}',
+    ]
+    if full_deploy:
+        return '\n'.join([*lines, 'echo "Full deploy requested: running mlDeploy"', full])
+    if not previous_commit:
+        return '\n'.join([*lines, 'echo "No earlier successful deploy with a known commit: running full mlDeploy"', full])
+    # Exclude the module tree with a literal pathspec instead of matching it with a regex
+    outside = shlex.quote(f':(exclude,literal){ML_MODULES_PATH}')
+    return '\n'.join([
+        *lines,
+        f'if ! git cat-file -e {prev}^{{commit}} 2>/dev/null; then',
+        f'  echo "Previously deployed commit {previous_commit} is not in the repository: running full mlDeploy"',
+        f'  {full}; exit $?',
+        'fi',
+        f'changed=$(git diff --relative --name-only {prev} HEAD -- .) || exit $?',
+        f'other=$(git diff --relative --name-only {prev} HEAD -- . {outside}) || exit $?',
+        'if [ -z "$changed" ]; then',
+        f'  echo "No MarkLogic changes since {previous_commit}: running mlLoadModules only"',
+        f'  {modules}; exit $?',
+        'elif [ -z "$other" ]; then',
+        f'  echo "Only module code changed since {previous_commit} ($(printf "%s\\n" "$changed" | wc -l) files): running mlLoadModules"',
+        f'  {modules}; exit $?',
+        'fi',
+        f'echo "$(printf "%s\\n" "$other" | wc -l) changed files outside {ML_MODULES_PATH} since {previous_commit}: running full mlDeploy"',
+        full,
+    ])
+
+def marklogic_pipeline(args, previous_commit=None):
+    branch_name = args.get('branchName')
+    environment_type = args.get('environmentType')
+    EnvironmentName = getEnvironmentName(environment_type)
+    full_deploy = parse_bool_param('fullDeploy', args.get('fullDeploy') or 'false')
+    scope = lock_scope('ml', args).workspace
+    workspace = shlex.quote(worktree_marklogic_path(scope, branch_name))
+    return [
+        PipelineStep(None, f"Proceeding to deploy MARKLOGIC in {environment_type}\n\n", None),
+        PipelineStep('workspace', f"Preparing the {repo_name} workspace for {branch_name} branch\n", workspace_command(scope, branch_name), True),
+        PipelineStep('deploy', "\nDeploying code\n",
+                     f'cd {workspace} && {marklogic_deploy_command(EnvironmentName, previous_commit, full_deploy)}', gradle=True),
+    ]
+
+def corb_job_step(args, job_name, workspace, message="\nDeploying code\n", daemon=None):
+    """The Gradle step of a corb job; `daemon` names a pool daemon other than the environment's own."""
+    EnvironmentName = getEnvironmentName(args.get('environmentType'))
+    return PipelineStep('corb', message,
+                        f'cd {workspace} && {gradle_daemons.lease(daemon or EnvironmentName)}./gradlew --daemon {shlex.quote(job_name)} -PenvironmentName={EnvironmentName}',
+                        gradle=True)
+
+def corb_job_pipeline(args, previous_commit=None):
+    job_name = args.get('job-name')
+    branch_name = args.get('branchName')
+    environment_type = args.get('environmentType')
+    scope = lock_scope('cj', args).workspace
+    workspace = shlex.quote(worktree_marklogic_path(scope, branch_name))
+    return [
+        PipelineStep(None, f"Proceeding to run corb job {job_name} in {environment_type}\n\n", None),
+        PipelineStep('workspace', f"Preparing the {repo_name} workspace for {branch_name} branch\n", workspace_command(scope, branch_name), True),
+        corb_job_step(args, job_name, workspace),
+    ]
+
+def batch_worker_workspace(environment, slot):
+    """Workspace (lock scope part of worktree_path) of concurrent batch worker `slot` > 0."""
+    return ('batch-workers', environment, str(slot))
+
+def worker_workspaces_command(main_worktree, worktrees):
+    """Shell command bringing extra worktrees to the commit checked out in `main_worktree`.
+
+    The commit is already in the shared object store, so nothing is fetched.
+    """
+    main = shlex.quote(main_worktree)
+    commands = [f'cd $(pwd)/{repo_name}/ && commit=$(git -C {main} rev-parse HEAD)']
+    for path in worktrees:
+        worktree = shlex.quote(path)
+        commands.append(
+            f'if [ ! -e {worktree}/.git ]; then '
+            f'echo {shlex.quote(f"Creating worktree {path}")} && '
+            f'(exec 9>"$(git rev-parse --git-common-dir)/dashboard-worktree.lock" && flock 9 && '
+            f'git worktree prune && git worktree add --detach {worktree} "$commit"); '
+            f'elif [ "$(git -C {worktree} rev-parse HEAD)" != "$commit" ]; then '
+            f'echo {shlex.quote(f"Updating worktree {path} to")} "$commit" && git -C {worktree} checkout --detach "$commit"; fi')
+    return ' && '.join(commands)
+
+def corb_batch_pipeline(args, job_names, workers):
+    """The steps of a corb job batch run by `workers` threads.
+
+    Returns (steps run once for all jobs, function (job, slot) -> the job's own
+    steps when worker `slot` runs it). Worker 0 uses the batch's worktree and
+    the environment's Gradle daemon; every other worker gets a worktree at the
+    same commit and a daemon of its own, so concurrent builds never share a
+    project directory or a GRADLE_USER_HOME. Their daemons count towards
+    GRADLE_MAX_DAEMONS like the environments' own.
+    """
+    branch_name = args.get('branchName')
+    environment_type = args.get('environmentType')
+    EnvironmentName = getEnvironmentName(environment_type)
+    scope = lock_scope('cj', args).workspace
+    workspaces = [scope] + [batch_worker_workspace(EnvironmentName, slot) for slot in range(1, workers)]
+    shared = [
+        PipelineStep(None, f"Proceeding to run {len(job_names)} corb jobs in {environment_type}\n\n", None),
+        PipelineStep('workspace', f"Preparing the {repo_name} workspace for {branch_name} branch\n", workspace_command(scope, branch_name), True),
+    ]
+    if workers > 1:
+        shared.append(PipelineStep('worker_workspaces', f"\nPreparing worktrees for {workers - 1} more concurrent jobs\n",
+                                   worker_workspaces_command(worktree_path(scope, branch_name),
+                                                             [worktree_path(w, branch_name) for w in workspaces[1:]])))
+
+    def job_steps(job, slot):
+        workspace = shlex.quote(worktree_marklogic_path(workspaces[slot], branch_name))
+        daemon = f"{EnvironmentName}-batch-{slot}" if slot else None
+        return [corb_job_step(args, job, workspace, f"\nRunning corb job {job}\n", daemon)]
+
+    return shared, job_steps
+
+PIPELINES = {'fr': frontend_pipeline, 'ml': marklogic_pipeline, 'cj': corb_job_pipeline}
+
+def previous_run_query(run_type, args):
+    """(sql, params) finding what a run builds on, or None if its pipeline doesn't use an earlier run.
+
+    For ml this is the commit of the last successful deploy to the same environment.
+    For fr it is the build that deployed the live frontend, when that build succeeded
+    with the requested versions (the run then deploys nothing), unless force=true.
+    Builds that only found their versions live are skipped, so the reference is the real deploy.
+    """
+    if run_type == 'fr':
+        if parse_bool_param('force', args.get('force') or 'false'):
+            return None
+        table = HISTORY_TABLES['fr'][0]
+        return (f"SELECT build_id FROM (SELECT build_id, status, fr_version, structure_search_version FROM {table} "
+                "WHERE run_state <> 'running' AND reused_build_id IS NULL ORDER BY deploy_datetime DESC, build_id DESC LIMIT 1) live "
+                "WHERE status AND fr_version = %s AND structure_search_version = %s",
+                (args.get('fr-version'), args.get('structure-search-version')))
+    if run_type != 'ml':
+        return None
+    table = HISTORY_TABLES['ml'][0]
+    return (f"SELECT commit_sha FROM {table} WHERE environment_type = %s AND status AND commit_sha IS NOT NULL "
+            "ORDER BY deploy_datetime DESC, build_id DESC LIMIT 1", (args.get('environmentType'),))
+
+def run_values(run_type, args):
+    """The history column values of a run, taken from its request parameters."""
+    return [args.get(field[2]) for field in HISTORY_TABLES[run_type][1]]
+
+
+def drain_output(fd):
+    """Read and discard what is in a non-blocking pipe; returns False at end of file."""
+    try:
+        while True:
+            if not os.read(fd, READ_CHUNK_SIZE):
+                return False
+    except BlockingIOError:
+        return True
+
+def process_group_exited(process):
+    """True once the command (reaped here) and every other process in its group have exited."""
+    if process.poll() is None:
+        return False
+    try:
+        os.killpg(process.pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
         pass
+    return False
+
+def terminate_process_group(process, stdout_fd):
+    """Stop an aborted command by signalling its process group (see run_command) with
+    each of TERMINATE_STAGES until the whole group has exited.
+
+    The group is signalled as a whole, so children started after the abort are
+    reached too. The command's exit is waited on through a pidfd where there is
+    one (Linux), otherwise by polling waitpid, and its output is drained
+    meanwhile so no process blocks on a full pipe. Returns as soon as the group
+    is gone, with the signal that stopped it (None if it survived SIGKILL).
+    """
+    selector = selectors.DefaultSelector()
+    selector.register(stdout_fd, selectors.EVENT_READ, 'output')
+    pidfd = None
+    try:
+        try:
+            pidfd = os.pidfd_open(process.pid)
+            selector.register(pidfd, selectors.EVENT_READ, 'exit')
+        except (AttributeError, OSError):
+            pidfd = None
+        for sig, grace in TERMINATE_STAGES:
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                pass
+            deadline = time.monotonic() + grace
+            while not process_group_exited(process):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(f"Process group {process.pid} still running after {sig.name}")
+                    break
+                # Woken by output or the command's exit; group members outliving the command are polled
+                waiting_on_exit = pidfd is not None and process.returncode is None
+                for key, _ in selector.select(remaining if waiting_on_exit else min(remaining, GROUP_EXIT_POLL)):
+                    if key.data == 'output' and not drain_output(stdout_fd):
+                        selector.unregister(stdout_fd)
+                    elif key.data == 'exit':
+                        # An exited pidfd stays readable; the rest of the group is polled
+                        selector.unregister(pidfd)
+            else:
+                return sig
+        return None
+    finally:
+        selector.close()
+        if pidfd is not None:
+            os.close(pidfd)
+
+def stop_command(process, abort_event):
+    """Terminate a command's process group; when it was aborted, store the abort-to-exit time in abort_event.exit_ms."""
+    aborted_at = getattr(abort_event, 'aborted_at', None) or time.monotonic()
+    print(f"Stopping process group {process.pid}")
+    try:
+        stopped_by = terminate_process_group(process, process.stdout.fileno())
+    except Exception as e:
+        print(f"Error during termination: {str(e)}")
+        return
+    if stopped_by is None:
+        print(f"Warning: Process group {process.pid} could not be terminated")
+        return
+    exit_ms = int((time.monotonic() - aborted_at) * 1000)
+    if abort_event.is_set():
+        abort_event.exit_ms = exit_ms
+    print(f"Process group {process.pid} exited {exit_ms} ms after the abort ({stopped_by.name})")
+
+class AbortEvent(threading.Event):
+    """A threading.Event whose fileno() becomes readable once set, so selectors wake on abort."""
+
+    def __init__(self):
+        super().__init__()
+        self.aborted_at = None  # monotonic time of the first set()
+        self.exit_ms = None  # abort to exit of the aborted command's process group, set by run_command
+        self._fd_lock = threading.Lock()
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._write_fd, False)
+
+    def set(self):
+        if self.aborted_at is None:
+            self.aborted_at = time.monotonic()
+        super().set()
+        with self._fd_lock:
+            if self._write_fd is not None:
+                try:
+                    os.write(self._write_fd, b'x')
+                except OSError:
+                    pass  # pipe already full, it is readable either way
+
+    def fileno(self):
+        return self._read_fd
+
+    def close(self):
+        with self._fd_lock:
+            if self._write_fd is not None:
+                os.close(self._read_fd)
+                os.close(self._write_fd)
+                self._read_fd = self._write_fd = None
+
+class OutputBatcher:
+    """Split raw command output into lines and coalesce them into batches for streaming.
+
+    Newlines are normalised the way text-mode readline does, and each line keeps the
+    blank line the dashboard has always received after it.
+    """
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._partial = ''
+        self._batch = []
+        self._size = 0
+        self._started = None
+
+    def feed(self, data):
+        """Add bytes read from the pipe; empty `data` means end of file."""
+        eof = not data
+        text = self._partial + self._decoder.decode(data, final=eof)
+        # Hold back a trailing CR in case its LF arrives with the next read
+        if text.endswith('\r') and not eof:
+            text, self._partial = text[:-1], '\r'
+        else:
+            self._partial = ''
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+        lines = text.split('\n')
+        self._partial = lines.pop() + self._partial
+        if eof and self._partial:
+            lines.append(self._partial)
+            self._partial = ''
+        for line in lines:
+            self._batch.append(f"{line}\n\n")
+            self._size += len(line) + 2
+        if self._batch and self._started is None:
+            self._started = time.monotonic()
+
+    def deadline(self):
+        """Monotonic time by which the pending batch must be flushed, or None."""
+        return None if self._started is None else self._started + OUTPUT_FLUSH_INTERVAL
+
+    def ready(self):
+        return bool(self._batch) and (self._size >= OUTPUT_FLUSH_BYTES or time.monotonic() >= self.deadline())
+
+    def take(self):
+        text = ''.join(self._batch)
+        self._batch = []
+        self._size = 0
+        self._started = None
+        return text
 
 def run_command(command, abort_event, current_process_holder=None):
-    """Run a command and yield output line by line, checking for abort."""
+    """Run a command and yield its output in batches of whole lines, checking for abort.
+
+    The pipe is read in large non-blocking chunks from a selector that also wakes on
+    `abort_event` (when it is an AbortEvent). Lines are coalesced and yielded once
+    OUTPUT_FLUSH_BYTES are pending or the oldest pending line is OUTPUT_FLUSH_INTERVAL old.
+    The command runs in its own process group, which is terminated on abort and
+    also when the generator is closed early (callers stop reading on abort).
+    """
+    selector = None
+    process = None
     try:
         # Set process group if on Unix, for compatibility
         def preexec_fn():
@@ -173,73 +1953,53 @@ def run_command(command, abort_event, current_process_holder=None):
             shell=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1,
+            bufsize=0,
             preexec_fn=preexec_fn if os.name != 'nt' else None
         )
-        
+
         if current_process_holder is not None:
             current_process_holder[0] = process
 
-        q = queue.Queue()
-        
-        def enqueue_output():
-            for line in iter(process.stdout.readline, ''):
-                q.put(line)
-            process.stdout.close()
-            q.put(None)  # Sentinel to indicate end
+        stdout_fd = process.stdout.fileno()
+        os.set_blocking(stdout_fd, False)
+        selector = selectors.DefaultSelector()
+        selector.register(stdout_fd, selectors.EVENT_READ, 'output')
+        abort_wakeup = isinstance(abort_event, AbortEvent)
+        if abort_wakeup:
+            selector.register(abort_event.fileno(), selectors.EVENT_READ, 'abort')
 
-        t = threading.Thread(target=enqueue_output)
-        t.daemon = True
-        t.start()
+        batcher = OutputBatcher()
+        eof = False
 
-        while True:
+        while not eof:
             if abort_event.is_set():
-                try:
-                    print(f"Aborting process {process.pid}")
-                    terminate_process_tree(process.pid, signal.SIGINT)
-                    time.sleep(1)
-                    if process.poll() is None:
-                        print(f"Process {process.pid} still running, sending SIGTERM")
-                        terminate_process_tree(process.pid, signal.SIGTERM)
-                        time.sleep(1)
-                        if process.poll() is None:
-                            print(f"Process {process.pid} still running, sending SIGKILL")
-                            try:
-                                parent = psutil.Process(process.pid)
-                                children = parent.children(recursive=True)
-                                for child in children:
-                                    child.kill()
-                                parent.kill()
-                            except psutil.NoSuchProcess:
-                                pass
-                            time.sleep(0.5)
-                            if process.poll() is None:
-                                print(f"Warning: Process {process.pid} could not be terminated")
-                except Exception as e:
-                    print(f"Error during termination: {str(e)}")
-                finally:
-                    if current_process_holder is not None:
-                        current_process_holder[0] = None
-                    # Drain the queue to avoid leaving the thread hanging
-                    while not q.empty():
-                        q.get_nowait()
-                    yield "❌ Process Aborted.\n\n", None
-                    return
+                stop_command(process, abort_event)
+                if current_process_holder is not None:
+                    current_process_holder[0] = None
+                yield "❌ Process Aborted.\n\n", None
+                return
 
-            try:
-                line = q.get_nowait()
-                if line is None:
-                    break
-                yield f"{line}\n", None
-            except queue.Empty:
-                if process.poll() is not None:
-                    # Process ended, wait for remaining output
-                    time.sleep(0.1)
+            deadline = batcher.deadline()
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not abort_wakeup:
+                timeout = ABORT_POLL_INTERVAL if timeout is None else min(timeout, ABORT_POLL_INTERVAL)
+
+            for key, _ in selector.select(timeout):
+                if key.data != 'output':
                     continue
-                time.sleep(0.05)  # Small sleep to avoid busy loop
+                try:
+                    data = os.read(stdout_fd, READ_CHUNK_SIZE)
+                except BlockingIOError:
+                    continue
+                eof = not data
+                batcher.feed(data)
+
+            if eof or batcher.ready():
+                text = batcher.take()
+                if text:
+                    yield text, None
 
-        t.join(timeout=1.0)
+        process.stdout.close()
         return_code = process.wait()
 
         if current_process_holder is not None:
@@ -251,680 +2011,1342 @@ def run_command(command, abort_event, current_process_holder=None):
         if current_process_holder is not None:
             current_process_holder[0] = None
         yield f"❌ Error executing command: {str(e)}\n\n", None
+    finally:
+        if selector is not None:
+            selector.close()
+        if process is not None:
+            if process.poll() is None:
+                stop_command(process, abort_event)
+            process.stdout.close()
 
-def heartbeat(lock_key, stop_event, abort_key, abort_event):
-    """Periodically refresh the lock's expiration time and check for abort signal."""
-    while not stop_event.is_set():
-        r.expire(lock_key, LOCK_TIMEOUT)
-        if r.get(abort_key):
+# The lock a run takes and the keys that go with it. MarkLogic deploys and corb
+# jobs lock their environment (env_key), so different environments run
+# concurrently. With CORB_JOB_LOCKS a corb job instead takes a shared lock on
+# the environment: its own (environment, job) key plus a lease in readers_key,
+# which a deploy to that environment waits out. Runs that can execute at the
+# same time never share a workspace.
+LockScope = collections.namedtuple('LockScope', ['run_type', 'key', 'env_key', 'readers_key', 'abort_key', 'shared', 'workspace'])
+
+def lock_scope(run_type, args):
+    """The LockScope of a `run_type` run with request parameters `args`."""
+    if run_type == 'fr':
+        return LockScope('fr', 'deploy_fr_lock', 'deploy_fr_lock', 'deploy_fr_lock:jobs', 'abort_fr', False, ('fr',))
+    environment_type = args.get('environmentType')
+    environment = getEnvironmentName(environment_type) or environment_type
+    env_key = f"deploy_ml_cj_lock:{environment}"
+    job_name = args.get('job-name')
+    if run_type == 'cj' and CORB_JOB_LOCKS and job_name and not args.get('jobs'):
+        return LockScope('cj', f"{env_key}:job:{job_name}", env_key, f"{env_key}:jobs", f"abort_cj:{environment}:{job_name}",
+                         True, (environment, job_name))
+    return LockScope(run_type, env_key, env_key, f"{env_key}:jobs", f"abort_{run_type}:{environment}", False, (environment,))
+
+def lock_scopes_key(run_type):
+    """Hash of the abort key -> lock key of every `run_type` run holding a lock."""
+    return f"lock_scopes:{run_type}"
+
+def lock_script_args(scope, token):
+    """(keys, args) of the lock scripts for `scope`."""
+    keys = [scope.key, scope.abort_key, scope.env_key, scope.readers_key, lock_scopes_key(scope.run_type)]
+    args = [token, LOCK_TIMEOUT, '1' if scope.shared else '0', int(time.time() * 1000)]
+    return keys, args
+
+# Lock scripts: KEYS are those of lock_script_args (lock, abort key, environment lock,
+# shared holders, scope registry); ARGV[1] is the owner token, ARGV[2] the lease in
+# seconds, ARGV[3] '1' for a shared lock and ARGV[4] the current time in ms
+ACQUIRE_LOCK_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[4], '-inf', ARGV[4])
+if ARGV[3] == '1' then
+    if redis.call('EXISTS', KEYS[3]) == 1 then
+        return 0
+    end
+elseif redis.call('ZCARD', KEYS[4]) > 0 then
+    return 0
+end
+if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return 0
+end
+if ARGV[3] == '1' then
+    redis.call('ZADD', KEYS[4], tonumber(ARGV[4]) + tonumber(ARGV[2]) * 1000, ARGV[1])
+end
+redis.call('DEL', KEYS[2])
+redis.call('HSET', KEYS[5], KEYS[2], KEYS[1])
+return 1
+"""
+ACQUIRE_LOCK_SCRIPT = r.register_script(ACQUIRE_LOCK_LUA)
+RENEW_LOCK_LUA = """
+local renewed = 0
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    renewed = redis.call('EXPIRE', KEYS[1], ARGV[2])
+    if ARGV[3] == '1' then
+        redis.call('ZADD', KEYS[4], tonumber(ARGV[4]) + tonumber(ARGV[2]) * 1000, ARGV[1])
+    end
+end
+local aborted = redis.call('GET', KEYS[2]) and 1 or 0
+if aborted == 1 then
+    redis.call('DEL', KEYS[2])
+end
+return {renewed, aborted}
+"""
+RENEW_LOCK_SCRIPT = r.register_script(RENEW_LOCK_LUA)
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('ZREM', KEYS[4], ARGV[1])
+    redis.call('HDEL', KEYS[5], KEYS[2])
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+RELEASE_LOCK_SCRIPT = r.register_script(RELEASE_LOCK_LUA)
+
+def acquire_lock(scope):
+    """Atomically take the scope's lock and clear any stale abort request; return the owner token or None."""
+    start_server_heartbeat()
+    token = f"{SERVER_ID}:{uuid.uuid4()}"
+    keys, args = lock_script_args(scope, token)
+    if ACQUIRE_LOCK_SCRIPT(keys=keys, args=args):
+        return token
+    return None
+
+def release_lock(scope, token):
+    """Delete the lock only if it is still owned by `token`."""
+    keys, args = lock_script_args(scope, token)
+    RELEASE_LOCK_SCRIPT(keys=keys, args=args)
+
+def abort_targets(run_type, scopes, args):
+    """The abort keys of the running runs an abort request for `run_type` addresses.
+
+    `scopes` maps the abort key of every locked `run_type` run to its lock key.
+    Without environmentType every run of the type is addressed; with it, the
+    runs in that environment (for corb jobs, also narrowed by job-name when
+    locks are per job).
+    """
+    if run_type == 'fr' or not args.get('environmentType'):
+        return sorted(scopes)
+    abort_key = lock_scope(run_type, args).abort_key
+    return sorted(key for key in scopes if key == abort_key or key.startswith(abort_key + ':'))
+
+def send_aborts(run_type, args):
+    """Signal the runs addressed by an abort request; returns how many were signalled."""
+    scopes_key = lock_scopes_key(run_type)
+    scopes = {k.decode(): v.decode() for k, v in r.hgetall(scopes_key).items()}
+    sent = 0
+    pipe = r.pipeline()
+    for abort_key in abort_targets(run_type, scopes, args):
+        if not r.exists(scopes[abort_key]):
+            r.hdel(scopes_key, abort_key)
+            continue
+        pipe.set(abort_key, 'true', ex=ABORT_KEY_TTL)
+        pipe.publish(ABORT_CHANNEL, abort_key)
+        sent += 1
+    pipe.execute()
+    return sent
+
+abort_events = {}  # abort key -> set of threading.Event for runs on this server
+abort_events_lock = threading.Lock()
+abort_listener_thread = None
+
+def deliver_abort(abort_key):
+    with abort_events_lock:
+        events = list(abort_events.get(abort_key, ()))
+    for event in events:
+        event.set()
+    if events:
+        r.delete(abort_key)
+
+def abort_listener():
+    """Set the abort events of local runs as soon as an abort is published."""
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(ABORT_CHANNEL)
+            # Pick up aborts that were requested while we were not subscribed
+            with abort_events_lock:
+                pending = list(abort_events)
+            for abort_key in pending:
+                if r.get(abort_key):
+                    deliver_abort(abort_key)
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    deliver_abort(message['data'].decode())
+        except redis.RedisError as e:
+            print(f"Abort listener lost its Redis subscription: {str(e)}")
+            time.sleep(1)
+
+def register_abort_event(abort_key, abort_event):
+    global abort_listener_thread
+    with abort_events_lock:
+        abort_events.setdefault(abort_key, set()).add(abort_event)
+        if abort_listener_thread is None:
+            abort_listener_thread = threading.Thread(target=abort_listener, daemon=True)
+            abort_listener_thread.start()
+
+def unregister_abort_event(abort_key, abort_event):
+    with abort_events_lock:
+        events = abort_events.get(abort_key)
+        if events is not None:
+            events.discard(abort_event)
+            if not events:
+                del abort_events[abort_key]
+
+def heartbeat(scope, token, stop_event, abort_event):
+    """Renew the lock's lease on a slow cadence; also a fallback check for missed aborts."""
+    while not stop_event.wait(LOCK_RENEW_INTERVAL):
+        keys, args = lock_script_args(scope, token)
+        try:
+            renewed, aborted = RENEW_LOCK_SCRIPT(keys=keys, args=args)
+        except redis.RedisError as e:
+            print(f"Error renewing {scope.key}: {str(e)}")
+            continue
+        if not renewed:
+            print(f"Lease on {scope.key} was lost")
+        if aborted:
             abort_event.set()
-            r.delete(abort_key)
-        time.sleep(HEARTBEAT_INTERVAL)
 
-def cleanup_stale_locks():
-    """Check and clean up stale locks and abort keys on server startup."""
-    for lock_key in ['deploy_fr_lock', 'deploy_ml_cj_lock']:
-        if r.exists(lock_key):
-            if r.ttl(lock_key) <= 0:
-                r.delete(lock_key)
-    for abort_key in ['abort_fr', 'abort_ml', 'abort_cj']:
-        if r.exists(abort_key):
-            r.delete(abort_key)
+def server_alive_key(server_id):
+    return f"server_alive:{server_id}"
 
-@app.route('/')
-def home():
-    """Return API documentation."""
-    return jsonify({
-        "message": "Documentation",
-        "endpoints": {
-            "/": "Displays this doc",
-            "/api/v1/deploy/fr": "Deploy UI and MIDDLEWARE in DEV-FULL",
-            "/api/v1/deploy/ml": "Deploy MARKLOGIC with specified branch and environment",
-            "/api/v1/run/cj": "Run corb job with specified job name, branch, and environment",
-            "/api/v1/history/fr": "Get history for FR deployments (last 10 or specific buildId)",
-            "/api/v1/history/ml": "Get history for ML deployments (last 10 or specific buildId)",
-            "/api/v1/history/cj": "Get history for corb job runs (last 10 or specific buildId)",
-            "/api/v1/abort/fr": "Abort ongoing frontend deployment",
-            "/api/v1/abort/ml": "Abort ongoing MarkLogic deployment",
-            "/api/v1/abort/cj": "Abort ongoing corb job run",
-            "/health": "Health check"
-        },
-        "guide": {
-            "deploy_ui_and_middleware": "/api/v1/deploy/fr?fr_version=x.y.z-SNAPSHOT&structure_search_version=x.y.z-SNAPSHOT",
-            "deploy_marklogic": "/api/v1/deploy/ml?branchName=develop&environmentType=ls-dev-full-ml",
-            "run_corb_job": "/api/v1/run/cj?job-name=somename&branchName=develop&environmentType=ls-dev-full-ml",
-            "history_fr": "/api/v1/history/fr or /api/v1/history/fr?buildId=1234",
-            "history_ml": "/api/v1/history/ml or /api/v1/history/ml?buildId=1234",
-            "history_cj": "/api/v1/history/cj or /api/v1/history/cj?buildId=1234"
-        }
-    })
+def lock_owner_alive(lock_key):
+    """Whether `lock_key` is held by a server that is still running.
 
-@app.route('/api/v1/deploy/fr')
-def deploy_frontend():
-    """Deploy UI and Middleware with provided versions using the deployment script."""
-    fr_version = request.args.get('fr-version')
-    structure_search_version = request.args.get('structure-search-version')
-    params = 0
-    if fr_version is None:
-        params = 1
-    if structure_search_version is None:
-        params = 2
-    if fr_version is None and structure_search_version is None:
-        params = 3
-    params_def = {
-        1: "fr-version is missing in the query string",
-        2: "structure-search-version is missing in the query string",
-        3: "fr-version and structure-search-version is missing in the query string"
-    }
-    if params != 0:
-        return jsonify({
-            "success": "false",
-            "error": "Missing required parameter",
-            "message": params_def[params],
-            "required_parameters": ["fr-version", "structure-search-version"],
-            "status_code": 400
-        }), 400
-
-    lock_key = 'deploy_fr_lock'
-    if not r.set(lock_key, SERVER_ID, nx=True, ex=LOCK_TIMEOUT):
-        return jsonify({"error": "Deployment is going on for the frontend application."}), 409
+    Lock tokens start with the owner's SERVER_ID; a server is alive while it
+    keeps renewing its liveness key (see server_heartbeat).
+    """
+    token = r.get(lock_key)
+    if token is None:
+        return False
+    owner = token.decode().split(':', 1)[0]
+    return owner == SERVER_ID or bool(r.exists(server_alive_key(owner)))
 
-    stop_heartbeat = threading.Event()
-    abort_event = threading.Event()
-    current_process_holder = [None]
-    abort_key = 'abort_fr'
-    heartbeat_thread = threading.Thread(target=heartbeat, args=(lock_key, stop_heartbeat, abort_key, abort_event))
-    heartbeat_thread.start()
+def cleanup_stale_locks():
+    """Free the locks of dead servers, and forget the abort keys of locks that are no longer held."""
+    for run_type in RUN_TYPES:
+        scopes_key = lock_scopes_key(run_type)
+        for abort_key, lock_key in r.hgetall(scopes_key).items():
+            abort_key, lock_key = abort_key.decode(), lock_key.decode()
+            if lock_owner_alive(lock_key):
+                continue
+            token = r.get(lock_key)
+            if token is not None:
+                # Only this token's lock is deleted, so a lock taken meanwhile is kept
+                env_key = lock_key.split(':job:')[0]
+                RELEASE_LOCK_SCRIPT(keys=[lock_key, abort_key, env_key, f"{env_key}:jobs", scopes_key], args=[token])
+            r.hdel(scopes_key, abort_key)
+            r.delete(abort_key)
 
-    def generate():
-        try:
-            build_id = get_next_fr_build_id()
-            dt = datetime.datetime.now()
-            log = ''
-            status = True
+def mark_interrupted_runs():
+    """Close out history rows and queue entries left running by a server that died mid-run.
+
+    A run is interrupted when the lock of its scope is no longer held by a live
+    server. Its active_runs entry is dropped and its output stream ended.
+    """
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        for run_type, (table, fields) in HISTORY_TABLES.items():
+            columns = ', '.join(field[0] for field in fields)
+            cur.execute(f"SELECT build_id, {columns} FROM {table} WHERE run_state = 'running'")
+            interrupted = []
+            for row in cur.fetchall():
+                args = {field[2]: value for field, value in zip(fields, row[1:])}
+                if not lock_owner_alive(lock_scope(run_type, args).key):
+                    interrupted.append(row[0])
+            if not interrupted:
+                continue
+            cur.execute(f"UPDATE {table} SET status = FALSE, run_state = 'interrupted' WHERE build_id = ANY(%s)", (interrupted,))
+            cur.execute("UPDATE deploy_run_steps SET finished_at = now(), outcome = 'interrupted' "
+                        "WHERE run_type = %s AND build_id = ANY(%s) AND outcome = 'running'", (run_type, interrupted))
+            r.hdel(f"active_runs:{run_type}", *interrupted)
+            for build_id in interrupted:
+                close_interrupted_stream(run_type, build_id)
+            bump_history_version(run_type)
+        # Queue entries started by a dead server; queued runs stay queued for the workers
+        cur.execute("SELECT run_id, run_type, params FROM deploy_queue WHERE state = 'running'")
+        interrupted = [(run_id, run_type) for run_id, run_type, args in cur.fetchall()
+                       if not lock_owner_alive(lock_scope(run_type, args).key)]
+        if interrupted:
+            cur.execute("UPDATE deploy_queue SET state = 'interrupted' WHERE run_id = ANY(%s)",
+                        ([run_id for run_id, _ in interrupted],))
+        conn.commit()
+        cur.close()
+    for run_id, run_type in interrupted:
+        close_interrupted_stream(run_type, batch_stream_id(run_id))
 
-            if abort_event.is_set():
-                status = False
-                msg = "❌ Deployment Aborted.\n\n"
-                yield msg
-                log += msg
-                insert_fr_log(build_id, dt, log, status, fr_version, structure_search_version, True)
-                return
+def prune_queue():
+    """Delete queue entries that ended (finished, cancelled or interrupted) more than QUEUE_RETENTION_DAYS ago."""
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        while True:
+            cur.execute(QUEUE_PRUNE_SQL, (QUEUE_RETENTION_DAYS, QUEUE_PRUNE_BATCH))
+            deleted = cur.rowcount
+            conn.commit()
+            if deleted < QUEUE_PRUNE_BATCH:
+                break
+        cur.close()
 
-            msg = "Proceeding to deploy FRONTEND in DEV-FULL\n\n"
-            yield msg
-            log += msg
+server_heartbeat_thread = None
+server_heartbeat_lock = threading.Lock()
 
-            if abort_event.is_set():
-                status = False
-                msg = "❌ Deployment Aborted.\n\n"
-                yield msg
-                log += msg
-                insert_fr_log(build_id, dt, log, status, fr_version, structure_search_version, True)
-                return
+def server_heartbeat():
+    """Keep this server's liveness key alive, close out the runs of dead servers every REAP_INTERVAL
+    and prune the queue every QUEUE_PRUNE_INTERVAL."""
+    last_reap = last_prune = time.monotonic()
+    while True:
+        time.sleep(SERVER_HEARTBEAT_INTERVAL)
+        try:
+            r.set(server_alive_key(SERVER_ID), '1', ex=SERVER_HEARTBEAT_TTL)
+        except redis.RedisError as e:
+            print(f"Error renewing the liveness of server {SERVER_ID}: {str(e)}")
+        if time.monotonic() - last_reap >= REAP_INTERVAL:
+            last_reap = time.monotonic()
+            try:
+                cleanup_stale_locks()
+                mark_interrupted_runs()
+            except Exception as e:
+                print(f"Error closing out the runs of dead servers: {str(e)}")
+        if time.monotonic() - last_prune >= QUEUE_PRUNE_INTERVAL:
+            last_prune = time.monotonic()
+            try:
+                prune_queue()
+            except Exception as e:
+                print(f"Error pruning the queue: {str(e)}")
+
+def start_server_heartbeat():
+    """Mark this server alive and start server_heartbeat, once; called before this server takes any lock."""
+    global server_heartbeat_thread
+    with server_heartbeat_lock:
+        if server_heartbeat_thread is not None:
+            return
+        r.set(server_alive_key(SERVER_ID), '1', ex=SERVER_HEARTBEAT_TTL)
+        server_heartbeat_thread = threading.Thread(target=server_heartbeat, name='server-heartbeat', daemon=True)
+        server_heartbeat_thread.start()
+
+def record_step_start(run_type, build_id, seq, step):
+    """Insert the timing row of a step that is starting; returns its start time."""
+    started_at = datetime.datetime.now()
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(INSERT_STEP_SQL, (run_type, build_id, seq, step.name, step.command, started_at))
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        print(f"Error recording step {step.name} of {run_type} build {build_id}: {str(e)}")
+    return started_at
 
-            msg = f"UI VERSION --> {fr_version}\n"
+def record_step_end(run_type, build_id, seq, started_at, exit_code, output_bytes, outcome, timing=(None, None), abort_exit_ms=None):
+    """Store the end of a step; returns its duration in ms."""
+    finished_at = datetime.datetime.now()
+    duration_ms = int((finished_at - started_at).total_seconds() * 1000)
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(FINISH_STEP_SQL, (finished_at, duration_ms, exit_code, output_bytes, outcome, *timing, abort_exit_ms,
+                                          run_type, build_id, seq))
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        print(f"Error recording the end of step {seq} of {run_type} build {build_id}: {str(e)}")
+    bump_history_version(run_type)
+    return duration_ms
+
+def record_reused_build(run_type, build_id, reused_build_id):
+    """Store that a run deployed nothing because build `reused_build_id` had deployed its versions."""
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(record_reused_build_sql(run_type), (reused_build_id, build_id))
+        conn.commit()
+        cur.close()
+    bump_history_version(run_type)
+
+def record_run_commit(run_type, build_id, output):
+    """Store the commit a workspace step resolved, taken from its "Resolved commit" line."""
+    match = RESOLVED_COMMIT_RE.search(output)
+    if not match:
+        return
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(record_commit_sql(run_type), (match.group(1), build_id))
+        conn.commit()
+        cur.close()
+    bump_history_version(run_type)
+
+def run_pipeline(run_type, build_id, steps, sink, abort_event, current_process_holder, first_seq=0):
+    """Run a pipeline's steps in order, yielding their output and writing it to `sink`.
+
+    Each named step is timed in deploy_run_steps, numbered from `first_seq`. The
+    run stops at the first failing step or on abort, and its outcome is stored
+    with finish_run and returned ('succeeded', 'failed' or 'aborted').
+    """
+    noun = RUN_NOUNS[run_type]
+    aborted = False
+    seq = first_seq
+    for step in steps:
+        if abort_event.is_set():
+            aborted = True
+            break
+        if step.message:
+            yield step.message
+            sink.write(step.message)
+        if step.command is None:
+            continue
+        started_at = record_step_start(run_type, build_id, seq, step)
+        exit_code = None
+        output_bytes = 0
+        markers = []
+        outcome = 'interrupted'
+        abort_exit_ms = None
+        try:
+            with closing(run_command(step.command, abort_event, current_process_holder)) as command:
+                for output, return_code in command:
+                    if abort_event.is_set():
+                        aborted = True
+                        break
+                    if return_code is None:
+                        if output:
+                            output_bytes += len(output.encode('utf-8'))
+                            markers += step_markers(step, output)
+                            yield output
+                            sink.write(output)
+                    else:
+                        exit_code = return_code
+            if aborted:
+                outcome = 'aborted'
+                abort_exit_ms = getattr(abort_event, 'exit_ms', None)
+            elif exit_code:
+                outcome = 'failed'
+            else:
+                outcome = 'succeeded'
+        finally:
+            timing = gradle_timing('\n'.join(markers), started_at) if step.gradle else (None, None)
+            duration_ms = record_step_end(run_type, build_id, seq, started_at, exit_code, output_bytes, outcome, timing,
+                                          abort_exit_ms)
+            STEP_DURATION.labels(run_type, step.name, outcome).observe(duration_ms / 1000)
+        seq += 1
+        if timing[0] is not None:
+            msg = format_gradle_timing(*timing)
             yield msg
-            log += msg
-
-            if abort_event.is_set():
-                status = False
-                msg = "❌ Deployment Aborted.\n\n"
-                yield msg
-                log += msg
-                insert_fr_log(build_id, dt, log, status, fr_version, structure_search_version, True)
-                return
-
-            msg = f"MIDDLEWARE VERSION --> {fr_version}\n"
+            sink.write(msg)
+        if abort_exit_ms is not None:
+            ABORT_EXIT.labels(run_type).observe(abort_exit_ms / 1000)
+            msg = format_abort_exit(abort_exit_ms)
             yield msg
-            log += msg
-
-            if abort_event.is_set():
-                status = False
-                msg = "❌ Deployment Aborted.\n\n"
-                yield msg
-                log += msg
-                insert_fr_log(build_id, dt, log, status, fr_version, structure_search_version, True)
-                return
-
-            msg = f"STRUCTURE SEARCH VERSION --> {structure_search_version}\n\n"
+            sink.write(msg)
+        if step.records_commit and outcome == 'succeeded':
+            record_run_commit(run_type, build_id, '\n'.join(markers))
+        if aborted:
+            break
+        if exit_code:
+            msg = f"❌ {noun} Failed {exit_code}\n\n"
             yield msg
-            log += msg
+            sink.write(msg)
+            finish_run(run_type, build_id, sink, False, False)
+            return 'failed'
 
+    if aborted:
+        msg = f"❌ {noun} Aborted.\n\n"
+    else:
+        msg = f"✅ {noun} Successful.\n\n"
+    yield msg
+    sink.write(msg)
+    finish_run(run_type, build_id, sink, not aborted, aborted)
+    return 'aborted' if aborted else 'succeeded'
+
+def run_shared_steps(run_type, runs, steps, abort_event, current_process_holder):
+    """Run steps once on behalf of several runs, yielding their output and writing it to every run's sink.
+
+    `runs` maps a name to (build_id, sink); each named step is timed for every
+    run. Stops at the first failing step or on abort and returns
+    (outcome, exit code, next step seq). The runs are not finished.
+    """
+    seq = 0
+    for step in steps:
+        if abort_event.is_set():
+            return 'aborted', None, seq
+        if step.message:
+            yield step.message
+            for _, sink in runs.values():
+                sink.write(step.message)
+        if step.command is None:
+            continue
+        started = {name: record_step_start(run_type, build_id, seq, step) for name, (build_id, _) in runs.items()}
+        exit_code = None
+        output_bytes = 0
+        markers = []
+        outcome = 'interrupted'
+        abort_exit_ms = None
+        try:
+            with closing(run_command(step.command, abort_event, current_process_holder)) as command:
+                for output, return_code in command:
+                    if abort_event.is_set():
+                        break
+                    if return_code is None:
+                        if output:
+                            output_bytes += len(output.encode('utf-8'))
+                            markers += step_markers(step, output)
+                            yield output
+                            for _, sink in runs.values():
+                                sink.write(output)
+                    else:
+                        exit_code = return_code
             if abort_event.is_set():
-                status = False
-                msg = "❌ Deployment Aborted.\n\n"
-                yield msg
-                log += msg
-                insert_fr_log(build_id, dt, log, status, fr_version, structure_search_version, True)
-                return
+                outcome = 'aborted'
+                abort_exit_ms = getattr(abort_event, 'exit_ms', None)
+            elif exit_code:
+                outcome = 'failed'
+            else:
+                outcome = 'succeeded'
+        finally:
+            durations = [record_step_end(run_type, build_id, seq, started[name], exit_code, output_bytes, outcome,
+                                         abort_exit_ms=abort_exit_ms)
+                         for name, (build_id, _) in runs.items()]
+            STEP_DURATION.labels(run_type, step.name, outcome).observe(max(durations, default=0) / 1000)
+        seq += 1
+        if outcome != 'succeeded':
+            return outcome, exit_code, seq
+        if step.records_commit:
+            for build_id, _ in runs.values():
+                record_run_commit(run_type, build_id, '\n'.join(markers))
+    return 'succeeded', None, seq
+
+def previous_run(run_type, args):
+    query = previous_run_query(run_type, args)
+    if query is None:
+        return None
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(*query)
+        row = cur.fetchone()
+        cur.close()
+    return row[0] if row else None
+
+def queue_waiting(scope):
+    """Whether runs are queued for the scope's environment; a new run then queues behind them."""
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(QUEUE_WAITING_SQL, (scope.env_key,))
+        waiting = cur.fetchone()[0]
+        cur.close()
+    return waiting
+
+def enqueue_run(run_type, args, scope, priority, running=False):
+    """Add a run to deploy_queue and return its run ID."""
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(ENQUEUE_SQL, enqueue_params(run_type, args, scope, priority, running))
+        run_id = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+    return run_id
 
-            for output, return_code in run_command(f'./script.sh {fr_version} {structure_search_version}', abort_event, current_process_holder):
-                if abort_event.is_set():
-                    status = False
-                    msg = "❌ Deployment Aborted.\n\n"
-                    yield msg
-                    log += msg
-                    insert_fr_log(build_id, dt, log, status, fr_version, structure_search_version, True)
-                    return
-                if return_code is None:
-                    if output:
-                        yield output
-                        log += output
-                else:
-                    if return_code != 0:
-                        status = False
-                        msg = f"❌ Deployment Failed {return_code}\n\n"
-                        yield msg
-                        log += msg
-                        insert_fr_log(build_id, dt, log, status, fr_version, structure_search_version, False)
-                        return
-
-            msg = "✅ Deployment Successful.\n\n"
-            yield msg
-            log += msg
-            insert_fr_log(build_id, dt, log, status, fr_version, structure_search_version, False)
+def queue_entry(run_id):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(QUEUE_RUN_SQL, (run_id,))
+        row = cur.fetchone()
+        cur.close()
+    return format_queue_entry(row) if row else None
 
-        finally:
-            stop_heartbeat.set()
-            heartbeat_thread.join(timeout=0.5)
-            if r.get(lock_key) == SERVER_ID.encode():
-                r.delete(lock_key)
+def update_queue(sql, run_id, *params):
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql, (*params, run_id))
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        print(f"Error updating queued run {run_id}: {str(e)}")
 
-    return Response(generate(), mimetype='text/event-stream', headers={'X-Accel-Buffering': 'no'})
+queue_wakeup = threading.Event()  # set when a run is queued or a lock is released
+run_start_events = {}  # run ID -> threading.Event set once the run's output stream exists (runs started by open_run)
+run_threads = set()  # threads executing a run right now
 
-@app.route('/api/v1/deploy/ml')
-def deploy_marklogic():
-    """Deploy MarkLogic with specified branch and environment."""
-    branch_name = request.args.get('branchName')
-    environment_type = request.args.get('environmentType')
-    params = 0
-    if branch_name is None:
-        params = 1
-    if environment_type is None:
-        params = 2
-    if branch_name is None and environment_type is None:
-        params = 3
-    params_def = {
-        1: "branchName is missing in the query string",
-        2: "environmentType is missing in the query string",
-        3: "branchName and environmentType are missing in the query string"
-    }
-    if params != 0:
-        return jsonify({
-            "success": "false",
-            "error": "Missing required parameter",
-            "message": params_def[params],
-            "required_parameters": ["branchName", "environmentType"],
-            "status_code": 400
-        }), 400
+def announce_run_start(run_id):
+    """Wake the client following `run_id` now that its output stream exists (or the run ended)."""
+    event = run_start_events.pop(run_id, None)
+    if event is not None:
+        event.set()
 
-    EnvironmentName = getEnvironmentName(environment_type)
-    
-    lock_key = 'deploy_ml_cj_lock'
-    if not r.set(lock_key, SERVER_ID, nx=True, ex=LOCK_TIMEOUT):
-        return jsonify({"error": "Deployment is going on for the MarkLogic application or a corb job is running."}), 409
-    
+def watch_lock(scope, lock_token):
+    """Start renewing a held lock and listening for aborts of its scope; returns (abort_event, stop_heartbeat)."""
     stop_heartbeat = threading.Event()
-    abort_event = threading.Event()
-    current_process_holder = [None]
-    abort_key = 'abort_ml'
-    heartbeat_thread = threading.Thread(target=heartbeat, args=(lock_key, stop_heartbeat, abort_key, abort_event))
+    abort_event = AbortEvent()
+    register_abort_event(scope.abort_key, abort_event)
+    heartbeat_thread = threading.Thread(target=heartbeat, args=(scope, lock_token, stop_heartbeat, abort_event), daemon=True)
     heartbeat_thread.start()
+    return abort_event, stop_heartbeat
+
+def end_run(scope, lock_token, run_id, abort_event, stop_heartbeat):
+    """Undo watch_lock, release the lock and finish the run's queue entry."""
+    stop_heartbeat.set()
+    announce_run_start(run_id)
+    unregister_abort_event(scope.abort_key, abort_event)
+    abort_event.close()
+    # Finished before the lock is released, so the entry never looks interrupted
+    update_queue(QUEUE_FINISH_SQL, run_id)
+    release_lock(scope, lock_token)
+    queue_wakeup.set()
+
+def run_environment(run_type, args):
+    """Environment label of a run's metrics; frontend deploys always go to DEV-FULL."""
+    return 'DEV-FULL' if run_type == 'fr' else args.get('environmentType') or 'unknown'
+
+def count_run_start(run_type, environment):
+    RUNS_STARTED.labels(run_type, environment).inc()
+    RUNS_IN_PROGRESS.labels(run_type).inc()
+
+def count_run_end(run_type, environment, outcome, seconds):
+    RUNS_FINISHED.labels(run_type, environment, outcome).inc()
+    RUN_DURATION.labels(run_type, environment, outcome).observe(seconds)
+    RUNS_IN_PROGRESS.labels(run_type).dec()
+
+def start_run(run_type, args, scope, lock_token, run_id):
+    """Execute a run whose lock is held, as a generator of its output.
+
+    The lease is renewed while the run executes and released when it ends;
+    the run's queue entry records the build ID and is finished.
+    """
+    values = run_values(run_type, args)
+    current_process_holder = [None]
+    abort_event, stop_heartbeat = watch_lock(scope, lock_token)
 
     def generate():
+        sink = None
+        environment = run_environment(run_type, args)
+        started = time.monotonic()
+        outcome = 'interrupted'
+        count_run_start(run_type, environment)
         try:
-            build_id = get_next_ml_build_id()
-            dt = datetime.datetime.now()
-            log = ''
-            status = True
+            try:
+                previous = previous_run(run_type, args)
+                steps = PIPELINES[run_type](args, previous)
+            except Exception as e:
+                # The run is still recorded, as failed, so history and its client say why
+                print(f"Error preparing run {run_id}: {str(e)}")
+                previous, steps, setup_error = None, None, f"the run could not be prepared: {str(e)}"
+            build_id = insert_run(run_type, datetime.datetime.now(), *values)
+            if run_type == 'fr' and previous is not None:
+                record_reused_build(run_type, build_id, previous)
+            sink = LogSink(run_type, build_id, RunStream(run_type, build_id))
+            update_queue(QUEUE_BUILD_SQL, run_id, build_id)
+            announce_run_start(run_id)
+            if steps is None:
+                yield fail_run(run_type, build_id, sink, setup_error)
+                outcome = 'failed'
+            else:
+                outcome = yield from run_pipeline(run_type, build_id, steps, sink, abort_event, current_process_holder)
+        except Exception as e:
+            # Before end_run finishes the queue entry, so a waiting client reads the error
+            update_queue(QUEUE_ERROR_SQL, run_id, str(e))
+            if sink is not None and outcome == 'interrupted':
+                outcome = 'failed'
+                try:
+                    fail_run(run_type, sink.build_id, sink, str(e))
+                except Exception as finish_error:
+                    print(f"Error recording the failure of run {run_id}: {str(finish_error)}")
+            raise
+        finally:
+            if sink is not None:
+                sink.close()
+            end_run(scope, lock_token, run_id, abort_event, stop_heartbeat)
+            count_run_end(run_type, environment, outcome, time.monotonic() - started)
+
+    return generate()
+
+def start_corb_batch(run_type, args, scope, lock_token, run_id):
+    """Execute a corb job batch whose lock is held, as a generator of its combined output.
+
+    Every job is its own cj run with its own history row and log. The checkout
+    runs once and its output goes to every job's log; then the jobs run, up to
+    `concurrency` at a time, in list order, each worker in its own worktree
+    with its own Gradle daemon (see corb_batch_pipeline). A failing job does not stop the
+    others. Combined output lines carry their job name, and are also published
+    as the batch's RunStream, which clients follow.
+    """
+    job_names, concurrency = batch_params(args)
+    params = {key: args.get(key) for key in args}
+    abort_event, stop_heartbeat = watch_lock(scope, lock_token)
 
-            if abort_event.is_set():
-                status = False
-                msg = "❌ Deployment Aborted.\n\n"
-                yield msg
-                log += msg
-                insert_ml_log(build_id, dt, log, status, branch_name, environment_type, True)
-                return
+    def generate():
+        stream = RunStream(run_type, batch_stream_id(run_id), register=False)
+        environment = run_environment(run_type, args)
+        started = time.monotonic()
+        runs = {}
+        outcomes = {}
+        workers = []
 
-            msg = f"Proceeding to deploy MARKLOGIC in {environment_type}\n\n"
-            yield msg
-            log += msg
+        def emit(text):
+            stream.publish(text)
+            return text
 
-            if abort_event.is_set():
-                status = False
-                msg = "❌ Deployment Aborted.\n\n"
-                yield msg
-                log += msg
-                insert_ml_log(build_id, dt, log, status, branch_name, environment_type, True)
+        try:
+            shared_steps, job_steps = corb_batch_pipeline(args, job_names, min(concurrency, len(job_names)))
+            for job in job_names:
+                build_id = insert_run(run_type, datetime.datetime.now(), *run_values(run_type, {**params, 'job-name': job}))
+                runs[job] = (build_id, LogSink(run_type, build_id, RunStream(run_type, build_id)))
+                count_run_start(run_type, environment)
+            yield emit(''.join(f"Corb job {job} runs as build {runs[job][0]}\n" for job in job_names) + "\n")
+            announce_run_start(run_id)
+            gen = run_shared_steps(run_type, runs, shared_steps, abort_event, [None])
+            try:
+                while True:
+                    yield emit(next(gen))
+            except StopIteration as done:
+                outcome, exit_code, first_seq = done.value
+            if outcome != 'succeeded':
+                aborted = outcome == 'aborted'
+                msg = f"❌ {RUN_NOUNS[run_type]} Aborted.\n\n" if aborted else f"❌ {RUN_NOUNS[run_type]} Failed {exit_code}\n\n"
+                yield emit(msg)
+                for job, (build_id, sink) in runs.items():
+                    sink.write(msg)
+                    finish_run(run_type, build_id, sink, False, aborted)
+                    outcomes[job] = outcome
+                    count_run_end(run_type, environment, outcome, time.monotonic() - started)
                 return
 
-            msg = f"Changing current directory to {repo_name} and checking out to {branch_name} branch\n"
-            yield msg
-            log += msg
-
-            for output, return_code in run_command(f'cd $(pwd)/{repo_name}/ && git checkout {branch_name}', abort_event, current_process_holder):
-                if abort_event.is_set():
-                    status = False
-                    msg = "❌ Deployment Aborted.\n\n"
-                    yield msg
-                    log += msg
-                    insert_ml_log(build_id, dt, log, status, branch_name, environment_type, True)
-                    return
-                if return_code is None:
-                    if output:
-                        yield output
-                        log += output
-                else:
-                    if return_code != 0:
-                        status = False
-                        msg = f"❌ Deployment Failed {return_code}\n\n"
-                        yield msg
-                        log += msg
-                        insert_ml_log(build_id, dt, log, status, branch_name, environment_type, False)
-                        return
-
-            msg = f"\nTaking pull from {branch_name} branch\n"
-            yield msg
-            log += msg
-
-            for output, return_code in run_command(f'cd $(pwd)/{repo_name}/ && git pull', abort_event, current_process_holder):
-                if abort_event.is_set():
-                    status = False
-                    msg = "❌ Deployment Aborted.\n\n"
-                    yield msg
-                    log += msg
-                    insert_ml_log(build_id, dt, log, status, branch_name, environment_type, True)
-                    return
-                if return_code is None:
-                    if output:
-                        yield output
-                        log += output
+            pending = collections.deque(job_names)
+            pending_lock = threading.Lock()
+            output = queue.Queue()
+
+            def work(slot):
+                while True:
+                    with pending_lock:
+                        if not pending:
+                            break
+                        job = pending.popleft()
+                    build_id, sink = runs[job]
+                    job_started = time.monotonic()
+                    job_run = run_pipeline(run_type, build_id, job_steps(job, slot), sink, abort_event, [None], first_seq)
+                    try:
+                        while True:
+                            output.put((job, next(job_run)))
+                    except StopIteration as done:
+                        outcomes[job] = done.value
+                    except Exception as e:
+                        print(f"Error running corb job {job} of batch run {run_id}: {str(e)}")
+                        outcomes[job] = 'failed'
+                        output.put((job, f"❌ Error executing corb job {job}: {str(e)}\n\n"))
+                    count_run_end(run_type, environment, outcomes[job], time.monotonic() - job_started)
+                output.put(None)
+
+            workers.extend(threading.Thread(target=work, args=(slot,), daemon=True) for slot in range(min(concurrency, len(job_names))))
+            for worker in workers:
+                worker.start()
+            running = len(workers)
+            while running:
+                item = output.get()
+                if item is None:
+                    running -= 1
                 else:
-                    if return_code != 0:
-                        status = False
-                        msg = f"❌ Deployment Failed {return_code}\n\n"
-                        yield msg
-                        log += msg
-                        insert_ml_log(build_id, dt, log, status, branch_name, environment_type, False)
-                        return
-
-            msg = "\nDeploying code\n"
-            yield msg
-            log += msg
-
-            for output, return_code in run_command(f'cd $(pwd)/{marklogic_path} && ./gradlew mlDeploy -PenvironmentName={EnvironmentName}', abort_event, current_process_holder):
-                if abort_event.is_set():
-                    status = False
-                    msg = "❌ Deployment Aborted.\n\n"
-                    yield msg
-                    log += msg
-                    insert_ml_log(build_id, dt, log, status, branch_name, environment_type, True)
-                    return
-                if return_code is None:
-                    if output:
-                        yield output
-                        log += output
-                else:
-                    if return_code != 0:
-                        status = False
-                        msg = f"❌ Deployment Failed {return_code}\n\n"
-                        yield msg
-                        log += msg
-                        insert_ml_log(build_id, dt, log, status, branch_name, environment_type, False)
-                        return
-
-            msg = "\nReloading modules\n"
-            yield msg
-            log += msg
-
-            for output, return_code in run_command(f'cd $(pwd)/{marklogic_path} && ./gradlew mlDeploy -PenvironmentName={EnvironmentName}', abort_event, current_process_holder):
-                if abort_event.is_set():
-                    status = False
-                    msg = "❌ Deployment Aborted.\n\n"
-                    yield msg
-                    log += msg
-                    insert_ml_log(build_id, dt, log, status, branch_name, environment_type, True)
-                    return
-                if return_code is None:
-                    if output:
-                        yield output
-                        log += output
-                else:
-                    if return_code != 0:
-                        status = False
-                        msg = f"❌ Deployment Failed {return_code}\n\n"
-                        yield msg
-                        log += msg
-                        insert_ml_log(build_id, dt, log, status, branch_name, environment_type, False)
-                        return
-
-            msg = "✅ Deployment Successful.\n\n"
-            yield msg
-            log += msg
-            insert_ml_log(build_id, dt, log, status, branch_name, environment_type, False)
+                    yield emit(prefix_lines(*item))
 
+            failed = [job for job in job_names if outcomes.get(job) != 'succeeded']
+            if abort_event.is_set():
+                msg = f"❌ Batch aborted: {len(job_names) - len(failed)} of {len(job_names)} corb jobs succeeded\n\n"
+            elif failed:
+                msg = f"❌ {len(failed)} of {len(job_names)} corb jobs failed: {', '.join(failed)}\n\n"
+            else:
+                msg = f"✅ All {len(job_names)} corb jobs succeeded\n\n"
+            yield emit(msg)
+        except Exception as e:
+            update_queue(QUEUE_ERROR_SQL, run_id, str(e))
+            stream.publish(f"❌ Batch failed: {str(e)}\n\n")
+            raise
         finally:
-            stop_heartbeat.set()
-            heartbeat_thread.join(timeout=0.5)
-            if r.get(lock_key) == SERVER_ID.encode():
-                r.delete(lock_key)
-
-    return Response(generate(), mimetype='text/event-stream', headers={'X-Accel-Buffering': 'no'})
-
-@app.route('/api/v1/run/cj')
-def run_corb_job():
-    """Run corb job with specified job name, branch, and environment."""
-    job_name = request.args.get('job-name')
-    branch_name = request.args.get('branchName')
-    environment_type = request.args.get('environmentType')
-    params = 0
-    if job_name is None:
-        params = 1
-    if branch_name is None:
-        params = 2
-    if environment_type is None:
-        params = 3
-    if job_name is None and branch_name is None:
-        params = 4
-    if job_name is None and environment_type is None:
-        params = 5
-    if branch_name is None and environment_type is None:
-        params = 6
-    if job_name is None and branch_name is None and environment_type is None:
-        params = 7
-    params_def = {
-        1: "job-name is missing in the query string",
-        2: "branchName is missing in the query string",
-        3: "environmentType is missing in the query string",
-        4: "job-name and branchName are missing in the query string",
-        5: "job-name and environmentType are missing in the query string",
-        6: "branchName and environmentType are missing in the query string",
-        7: "job-name, branchName, and environmentType are missing in the query string"
-    }
-    if params != 0:
-        return jsonify({
-            "success": "false",
-            "error": "Missing required parameter",
-            "message": params_def[params],
-            "required_parameters": ["job-name", "branchName", "environmentType"],
-            "status_code": 400
-        }), 400
-    EnvironmentName = getEnvironmentName(environment_type)
-    lock_key = 'deploy_ml_cj_lock'
-    if not r.set(lock_key, SERVER_ID, nx=True, ex=LOCK_TIMEOUT):
-        return jsonify({"error": "corb job is already running or a MarkLogic deployment is in progress."}), 409
-
-    stop_heartbeat = threading.Event()
-    abort_event = threading.Event()
-    current_process_holder = [None]
-    abort_key = 'abort_cj'
-    heartbeat_thread = threading.Thread(target=heartbeat, args=(lock_key, stop_heartbeat, abort_key, abort_event))
-    heartbeat_thread.start()
+            # A batch that fails or is stopped aborts the jobs still running
+            if any(worker.is_alive() for worker in workers):
+                abort_event.set()
+                for worker in workers:
+                    worker.join()
+            for job, (build_id, sink) in runs.items():
+                sink.close()
+                if job not in outcomes:
+                    count_run_end(run_type, environment, 'interrupted', time.monotonic() - started)
+            stream.finish()
+            end_run(scope, lock_token, run_id, abort_event, stop_heartbeat)
+
+    return generate()
+
+def run_executor(run_type, args):
+    """The function executing a run of `run_type` with request parameters `args` (start_run or start_corb_batch)."""
+    return start_corb_batch if run_type == 'cj' and args.get('jobs') else start_run
+
+def ended_before_start_message(entry):
+    """What the client following a run is told when the run ended without output to follow."""
+    if entry['error']:
+        return f"❌ Run {entry['runId']} failed before it started: {entry['error']}\n\n"
+    return f"❌ Queued run {entry['runId']} ended before it started ({entry['state']}).\n\n"
+
+def follow_queued_run(run_type, run_id, queued=True):
+    """Stream a queued run's position until a worker starts it, then its live output.
+
+    Runs that started right away (queued=False) stream their output only.
+    """
+    started = run_start_events.get(run_id)
+    position = None
+    while True:
+        entry = queue_entry(run_id)
+        if entry is None or entry['state'] == 'cancelled':
+            yield f"❌ Queued run {run_id} was cancelled.\n\n"
+            return
+        stream_id = entry['buildId']
+        if entry['params'].get('jobs') and r.exists(run_stream_key(run_type, batch_stream_id(run_id))):
+            stream_id = batch_stream_id(run_id)
+        if stream_id is not None:
+            break
+        if entry['state'] not in ('queued', 'running'):
+            yield ended_before_start_message(entry)
+            return
+        if entry['position'] is not None and entry['position'] != position:
+            position = entry['position']
+            if queued:
+                yield f"⏳ Run {run_id} is queued at position {position}\n\n"
+        if started is not None:
+            started.wait(QUEUE_POLL_INTERVAL)
+        else:
+            time.sleep(QUEUE_POLL_INTERVAL)
+    if queued:
+        build = f" as build {entry['buildId']}" if entry['buildId'] is not None else ""
+        yield f"▶ Run {run_id} started{build} after {entry['waitMs'] / 1000:.1f}s in the queue\n\n"
+    yield from tail_run_stream(run_type, stream_id)
+
+def execute_run(run_id, output):
+    """Drive a run's output generator to its end; clients read the output from its RunStream."""
+    run_threads.add(threading.current_thread())
+    try:
+        for _ in output:
+            pass
+    except Exception as e:
+        print(f"Error executing run {run_id}: {str(e)}")
+    finally:
+        run_threads.discard(threading.current_thread())
+
+def abort_local_runs():
+    """Abort the runs executing in this process and wait for their commands to stop, so none outlives it."""
+    with abort_events_lock:
+        events = [event for events in abort_events.values() for event in events]
+    for event in events:
+        event.set()
+    deadline = time.monotonic() + sum(grace for _, grace in TERMINATE_STAGES)
+    for thread in list(run_threads):
+        thread.join(max(0, deadline - time.monotonic()))
+
+atexit.register(abort_local_runs)
+
+def open_run(run_type, args, priority, use_queue):
+    """Start a run right away when its lock scope is free, otherwise queue it.
+
+    A run waits behind runs already queued for its environment. Started runs
+    execute in a thread of their own and publish their output to a RunStream,
+    so they run at full speed and to completion whatever the client does.
+    Both serving modes start runs here. Returns (run_id, queued), with clients
+    following the run through follow_queued_run, or (None, False) when the lock
+    scope is busy and use_queue is false.
+    """
+    requested = time.monotonic()
+    scope = lock_scope(run_type, args)
+    lock_token = None if queue_waiting(scope) else acquire_lock(scope)
+    if lock_token is None:
+        if not use_queue:
+            return None, False
+        run_id = enqueue_run(run_type, args, scope, priority)
+        queue_wakeup.set()
+        return run_id, True
+    try:
+        run_id = enqueue_run(run_type, args, scope, priority, running=True)
+    except Exception:
+        release_lock(scope, lock_token)
+        raise
+    LOCK_WAIT.labels(run_type).observe(time.monotonic() - requested)
+    output = run_executor(run_type, args)(run_type, args, scope, lock_token, run_id)
+    run_start_events[run_id] = threading.Event()
+    threading.Thread(target=execute_run, args=(run_id, output), name=f"run-{run_id}", daemon=True).start()
+    return run_id, False
+
+def stream_pipeline(run_type, args):
+    """Stream a run, or its place in the queue until it starts; the response carries the run ID in X-Run-Id.
+
+    With queue=false a busy lock scope is a 409 instead.
+    """
+    try:
+        priority, use_queue = queue_params(args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    run_id, queued = open_run(run_type, args, priority, use_queue)
+    if run_id is None:
+        return jsonify({"error": LOCK_CONFLICT_MESSAGES[run_type].format(environment=args.get('environmentType'))}), 409
+    return Response(tracked_stream('deploy', follow_queued_run(run_type, run_id, queued)), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no', 'X-Run-Id': str(run_id)})
+
+def claim_queued_run():
+    """Take the lock of the first queued run whose scope is free and mark it running.
+
+    Runs are tried by priority, then age. Once a run cannot take its lock, later
+    runs for the same environment are passed over too, so they keep their order.
+    Returns (run_id, run_type, args, scope, lock_token), or None.
+    """
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(QUEUE_CANDIDATES_SQL)
+        blocked = set()
+        for run_id, run_type, args, scope_key, waited in cur.fetchall():
+            if scope_key in blocked:
+                continue
+            scope = lock_scope(run_type, args)
+            lock_token = acquire_lock(scope)
+            if lock_token is None:
+                blocked.add(scope_key)
+                continue
+            try:
+                cur.execute(QUEUE_START_SQL, (run_id,))
+                conn.commit()
+            except Exception:
+                release_lock(scope, lock_token)
+                raise
+            cur.close()
+            LOCK_WAIT.labels(run_type).observe(float(waited))
+            return run_id, run_type, args, scope, lock_token
+        conn.rollback()
+        cur.close()
+    return None
 
-    def generate():
+def queue_worker():
+    """Execute queued runs one at a time, each as soon as its lock scope frees up."""
+    while True:
         try:
-            build_id = get_next_cj_build_id()
-            dt = datetime.datetime.now()
-            log = ''
-            status = True
-
-            if abort_event.is_set():
-                status = False
-                msg = "❌ Job Run Aborted.\n\n"
-                yield msg
-                log += msg
-                insert_cj_log(build_id, dt, log, status, job_name, branch_name, environment_type, True)
-                return
-
-            msg = f"Proceeding to run corb job {job_name} in {environment_type}\n\n"
-            yield msg
-            log += msg
+            claimed = claim_queued_run()
+        except Exception as e:
+            print(f"Error claiming a queued run: {str(e)}")
+            claimed = None
+        if claimed is None:
+            queue_wakeup.wait(QUEUE_POLL_INTERVAL)
+            queue_wakeup.clear()
+            continue
+        run_id, run_type, args, scope, lock_token = claimed
+        print(f"Starting queued run {run_id} ({RUN_TYPES[run_type]})")
+        execute_run(run_id, run_executor(run_type, args)(run_type, args, scope, lock_token, run_id))
+
+def start_queue_workers():
+    for i in range(QUEUE_WORKERS):
+        threading.Thread(target=queue_worker, name=f"queue-worker-{i}", daemon=True).start()
+
+def rechunk_log(cur, run_type, build_id, text):
+    """Replace a build's stored log with line-aligned compressed chunks of `text`."""
+    cur.execute("DELETE FROM deploy_log_chunks WHERE run_type = %s AND build_id = %s", (run_type, build_id))
+    for seq, (line_start, piece) in enumerate(split_log_chunks(text)):
+        cur.execute(INSERT_LOG_CHUNK_SQL, log_chunk_params(run_type, build_id, seq, line_start, piece))
+
+def migrate_log_storage():
+    """Compress and index logs stored before chunk compression, a batch of builds per transaction.
+
+    Covers plain-text chunks and the output_log column of runs recorded before
+    chunked logs; output_log is cleared once the log lives in deploy_log_chunks.
+    Compressed chunks without a search vector get one.
+    """
+    if not r.set('log_migration_lock', SERVER_ID, nx=True, ex=LOCK_TIMEOUT):
+        return
+    migrated = 0
+    try:
+        for run_type, (table, _) in HISTORY_TABLES.items():
+            while True:
+                with db_pool.connection() as conn:
+                    cur = conn.cursor()
+                    cur.execute(f"""
+                        SELECT h.build_id FROM {table} h
+                        WHERE h.run_state <> 'running' AND (h.output_log IS NOT NULL OR EXISTS (
+                            SELECT 1 FROM deploy_log_chunks c
+                            WHERE c.run_type = %s AND c.build_id = h.build_id AND c.content_z IS NULL))
+                        LIMIT %s FOR UPDATE SKIP LOCKED
+                    """, (run_type, LOG_MIGRATION_BATCH))
+                    build_ids = [row[0] for row in cur.fetchall()]
+                    for build_id in build_ids:
+                        cur.execute(LOG_CHUNKS_SQL, (run_type, build_id))
+                        chunks = cur.fetchall()
+                        cur.execute(f"SELECT output_log FROM {table} WHERE build_id = %s", (build_id,))
+                        rechunk_log(cur, run_type, build_id, assemble_log(chunks, cur.fetchone()[0]) or '')
+                        cur.execute(f"UPDATE {table} SET output_log = NULL WHERE build_id = %s", (build_id,))
+                    conn.commit()
+                    cur.close()
+                r.expire('log_migration_lock', LOCK_TIMEOUT)
+                migrated += len(build_ids)
+                if len(build_ids) < LOG_MIGRATION_BATCH:
+                    break
+        # Chunks compressed before search indexing only lack their search vector
+        while True:
+            with db_pool.connection() as conn:
+                cur = conn.cursor()
+                cur.execute("""
+                    SELECT run_type, build_id, seq, codec, content_z FROM deploy_log_chunks
+                    WHERE search_vector IS NULL AND content_z IS NOT NULL
+                    LIMIT %s FOR UPDATE SKIP LOCKED
+                """, (LOG_MIGRATION_BATCH,))
+                rows = cur.fetchall()
+                for run_type, build_id, seq, codec, data in rows:
+                    cur.execute(f"UPDATE deploy_log_chunks SET search_vector = to_tsvector('{SEARCH_CONFIG}', %s) "
+                                "WHERE run_type = %s AND build_id = %s AND seq = %s",
+                                (search_text(decompress_log(codec, data)), run_type, build_id, seq))
+                conn.commit()
+                cur.close()
+            r.expire('log_migration_lock', LOCK_TIMEOUT)
+            migrated += len(rows)
+            if len(rows) < LOG_MIGRATION_BATCH:
+                break
+    except Exception as e:
+        print(f"Error migrating log storage: {str(e)}")
+    finally:
+        r.delete('log_migration_lock')
+    if migrated:
+        print(f"Compressed or indexed the stored logs of {migrated} runs and chunks")
+
+API_DOC = {
+    "message": "Documentation",
+    "endpoints": {
+        "/": "Displays this doc",
+        "/api/v1/deploy/fr": "Deploy UI and MIDDLEWARE in DEV-FULL",
+        "/api/v1/deploy/ml": "Deploy MARKLOGIC with specified branch and environment",
+        "/api/v1/run/cj": "Run corb job with specified job name, branch, and environment",
+        "/api/v1/run/cj/batch": "Run a list of corb jobs on one checkout, in parallel up to a concurrency limit, each recorded as its own run",
+        "/api/v1/history/fr": "Get history for FR deployments with per-step timings (paginated and filterable, or specific buildId)",
+        "/api/v1/history/ml": "Get history for ML deployments with per-step timings (paginated and filterable, or specific buildId)",
+        "/api/v1/history/cj": "Get history for corb job runs with per-step timings (paginated and filterable, or specific buildId)",
+        "/api/v1/attach/<fr|ml|cj>": "Tail the live output of an ongoing run (optional buildId and character offset)",
+        "/api/v1/logs/<fr|ml|cj>/<buildId>": "Stream a run's stored log as text, optionally a line range (start, end) or the last N lines (tail)",
+        "/api/v1/search": "Full-text search over stored run logs, ranked, with matching lines (q, optional type and limit)",
+        "/api/v1/queue": "Queued and running runs with their queue positions, and queue-wait statistics",
+        "/api/v1/queue/<runId>": "Queue state, position and wait of one run",
+        "/api/v1/queue/<runId>/cancel": "Cancel a run that is still queued",
+        "/api/v1/abort/fr": "Abort ongoing frontend deployment",
+        "/api/v1/abort/ml": "Abort ongoing MarkLogic deployments (optionally only in environmentType)",
+        "/api/v1/abort/cj": "Abort ongoing corb job runs (optionally only in environmentType, and job-name)",
+        "/metrics": "Prometheus metrics: runs, step and run durations, lock waits, streams, Redis and database latency",
+        "/health": "Health check"
+    },
+    "guide": {
+        "deploy_ui_and_middleware": "/api/v1/deploy/fr?fr_version=x.y.z-SNAPSHOT&structure_search_version=x.y.z-SNAPSHOT (add &force=true to redeploy versions that are already live)",
+        "deploy_marklogic": "/api/v1/deploy/ml?branchName=develop&environmentType=DEV-FULL (add &fullDeploy=true to skip change detection)",
+        "run_corb_job": "/api/v1/run/cj?job-name=somename&branchName=develop&environmentType=DEV-FULL",
+        "run_corb_job_batch": "/api/v1/run/cj/batch?jobs=jobA,jobB,jobC&branchName=develop&environmentType=TEST&concurrency=2",
+        "history_fr": "/api/v1/history/fr or /api/v1/history/fr?buildId=1234",
+        "history_ml": "/api/v1/history/ml or /api/v1/history/ml?buildId=1234",
+        "history_cj": "/api/v1/history/cj or /api/v1/history/cj?buildId=1234",
+        "attach": "/api/v1/attach/ml or /api/v1/attach/ml?buildId=1234&offset=0",
+        "search": "/api/v1/search?q=\"Execution failed\" mlLoadModules&type=ml,cj&limit=20",
+        "logs": "/api/v1/logs/ml/1234, /api/v1/logs/ml/1234?start=100&end=200 or /api/v1/logs/ml/1234?tail=500",
+        "queue": "Deploys wait in the queue while their environment is busy; add &priority=10 to run sooner or &queue=false to get a 409 instead",
+        "abort": "/api/v1/abort/ml?environmentType=TEST or /api/v1/abort/cj?environmentType=TEST&job-name=somename",
+        "history_filters": "/api/v1/history/ml?limit=50&status=false&branchName=develop&environmentType=TEST&from=2025-01-01&to=2025-02-01; follow the X-Next-Cursor header with &cursor=..."
+    }
+}
 
-            if abort_event.is_set():
-                status = False
-                msg = "❌ Job Run Aborted.\n\n"
-                yield msg
-                log += msg
-                insert_cj_log(build_id, dt, log, status, job_name, branch_name, environment_type, True)
-                return
+@app.route('/')
+def home():
+    """Return API documentation."""
+    return jsonify(API_DOC)
 
-            msg = f"Changing current directory to {repo_name} and checking out to {branch_name} branch\n"
-            yield msg
-            log += msg
-
-            for output, return_code in run_command(f'cd $(pwd)/{repo_name}/ && git checkout {branch_name}', abort_event, current_process_holder):
-                if abort_event.is_set():
-                    status = False
-                    msg = "❌ Job Run Aborted.\n\n"
-                    yield msg
-                    log += msg
-                    insert_cj_log(build_id, dt, log, status, job_name, branch_name, environment_type, True)
-                    return
-                if return_code is None:
-                    if output:
-                        yield output
-                        log += output
-                else:
-                    if return_code != 0:
-                        status = False
-                        msg = f"❌ Job Run Failed {return_code}\n\n"
-                        yield msg
-                        log += msg
-                        insert_cj_log(build_id, dt, log, status, job_name, branch_name, environment_type, False)
-                        return
-
-            msg = f"\nTaking pull from {branch_name} branch\n"
-            yield msg
-            log += msg
-
-            for output, return_code in run_command(f'cd $(pwd)/{repo_name}/ && git pull', abort_event, current_process_holder):
-                if abort_event.is_set():
-                    status = False
-                    msg = "❌ Job Run Aborted.\n\n"
-                    yield msg
-                    log += msg
-                    insert_cj_log(build_id, dt, log, status, job_name, branch_name, environment_type, True)
-                    return
-                if return_code is None:
-                    if output:
-                        yield output
-                        log += output
-                else:
-                    if return_code != 0:
-                        status = False
-                        msg = f"❌ Job Run Failed {return_code}\n\n"
-                        yield msg
-                        log += msg
-                        insert_cj_log(build_id, dt, log, status, job_name, branch_name, environment_type, False)
-                        return
-
-            msg = "\nDeploying code\n"
-            yield msg
-            log += msg
-
-            for output, return_code in run_command(f'cd $(pwd)/{marklogic_path} && ./gradlew {job_name} -PenvironmentName={EnvironmentName}', abort_event, current_process_holder):
-                if abort_event.is_set():
-                    status = False
-                    msg = "❌ Job Run Aborted.\n\n"
-                    yield msg
-                    log += msg
-                    insert_cj_log(build_id, dt, log, status, job_name, branch_name, environment_type, True)
-                    return
-                if return_code is None:
-                    if output:
-                        yield output
-                        log += output
-                else:
-                    if return_code != 0:
-                        status = False
-                        msg = f"❌ Job Run Failed {return_code}\n\n"
-                        yield msg
-                        log += msg
-                        insert_cj_log(build_id, dt, log, status, job_name, branch_name, environment_type, False)
-                        return
-
-            msg = "✅ Job Run Successful.\n\n"
-            yield msg
-            log += msg
-            insert_cj_log(build_id, dt, log, status, job_name, branch_name, environment_type, False)
+@app.route('/api/v1/deploy/fr')
+def deploy_frontend():
+    """Deploy UI and Middleware with provided versions using the deployment script."""
+    error = missing_params_error('fr', request.args)
+    if error:
+        return jsonify(error), 400
+    try:
+        check_run_params('fr', request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return stream_pipeline('fr', request.args)
 
-        finally:
-            stop_heartbeat.set()
-            heartbeat_thread.join(timeout=0.5)
-            if r.get(lock_key) == SERVER_ID.encode():
-                r.delete(lock_key)
+@app.route('/api/v1/deploy/ml')
+def deploy_marklogic():
+    """Deploy MarkLogic with specified branch and environment."""
+    error = missing_params_error('ml', request.args)
+    if error:
+        return jsonify(error), 400
+    try:
+        check_run_params('ml', request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return stream_pipeline('ml', request.args)
 
-    return Response(generate(), mimetype='text/event-stream', headers={'X-Accel-Buffering': 'no'})
+@app.route('/api/v1/run/cj')
+def run_corb_job():
+    """Run corb job with specified job name, branch, and environment."""
+    error = missing_params_error('cj', request.args)
+    if error:
+        return jsonify(error), 400
+    try:
+        check_run_params('cj', request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return stream_pipeline('cj', request.args)
+
+@app.route('/api/v1/run/cj/batch')
+def run_corb_batch():
+    """Run several corb jobs on one checkout of a branch, up to `concurrency` at a time."""
+    error = missing_params_error('cj_batch', request.args)
+    if error:
+        return jsonify(error), 400
+    try:
+        check_run_params('cj_batch', request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return stream_pipeline('cj', request.args)
+
+@app.route('/api/v1/attach/<run_type>')
+def attach_run(run_type):
+    """Tail the live output of a running (or recently finished) run from the start or an offset."""
+    if run_type not in RUN_TYPES:
+        return jsonify({"error": f"Unknown run type '{run_type}'", "allowed": list(RUN_TYPES)}), 400
+    build_id = request.args.get('buildId')
+    offset = request.args.get('offset', '0')
+    try:
+        offset = int(offset)
+        if build_id:
+            build_id = int(build_id)
+    except ValueError:
+        return jsonify({'error': 'buildId and offset must be integers'}), 400
+    if not build_id:
+        active = [int(b) for b in r.hkeys(f"active_runs:{run_type}")]
+        if not active:
+            return jsonify({"error": f"No ongoing {RUN_TYPES[run_type]} to attach to."}), 404
+        build_id = max(active)
+    elif not r.exists(run_stream_key(run_type, build_id)) and not r.hexists(f"active_runs:{run_type}", build_id):
+        return jsonify({"error": f"Build {build_id} has no live output; use /api/v1/history/{run_type}?buildId={build_id}"}), 404
+
+    return Response(tracked_stream('attach', tail_run_stream(run_type, build_id, offset)), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no', 'X-Build-Id': str(build_id)})
 
 @app.route('/api/v1/abort/fr')
 def abort_frontend():
-    lock_key = 'deploy_fr_lock'
-    abort_key = 'abort_fr'
-    if r.exists(lock_key):
-        r.set(abort_key, 'true', ex=30)
+    if send_aborts('fr', request.args):
         return jsonify({"message": "Abort signal sent for frontend deployment."})
     else:
         return jsonify({"error": "No ongoing frontend deployment to abort."}), 404
 
 @app.route('/api/v1/abort/ml')
 def abort_marklogic():
-    lock_key = 'deploy_ml_cj_lock'
-    abort_key = 'abort_ml'
-    if r.exists(lock_key):
-        r.set(abort_key, 'true', ex=30)
+    """Abort MarkLogic deployments; environmentType limits the abort to one environment."""
+    if send_aborts('ml', request.args):
         return jsonify({"message": "Abort signal sent for MarkLogic deployment."})
     else:
         return jsonify({"error": "No ongoing MarkLogic deployment to abort."}), 404
 
 @app.route('/api/v1/abort/cj')
 def abort_corb_job():
-    lock_key = 'deploy_ml_cj_lock'
-    abort_key = 'abort_cj'
-    if r.exists(lock_key):
-        r.set(abort_key, 'true', ex=30)
+    """Abort corb job runs; environmentType (and job-name) limit the abort to matching runs."""
+    if send_aborts('cj', request.args):
         return jsonify({"message": "Abort signal sent for corb job run."})
     else:
         return jsonify({"error": "No ongoing corb job run to abort."}), 404
 
-@app.route('/api/v1/history/fr')
-def history_fr():
-    """Get frontend deployment history (last 10 or specific buildId)."""
-    build_id = request.args.get('buildId')
-    conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS)
-    cur = conn.cursor()
-    if build_id:
+@app.route('/api/v1/queue')
+def list_queue():
+    """Queued and running runs, queued ones with their position, plus queue-wait statistics."""
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(QUEUE_LIST_SQL)
+        entries = [format_queue_entry(row) for row in cur.fetchall()]
+        cur.execute(QUEUE_WAIT_STATS_SQL, (QUEUE_STATS_WINDOW,))
+        stats = format_queue_wait_stats(cur.fetchone())
+        cur.close()
+    return jsonify({'workers': QUEUE_WORKERS, 'queued': sum(e['state'] == 'queued' for e in entries),
+                    'runs': entries, 'wait': stats})
+
+@app.route('/api/v1/queue/<int:run_id>')
+def queued_run(run_id):
+    entry = queue_entry(run_id)
+    if entry is None:
+        return jsonify({"error": f"No run {run_id} in the queue."}), 404
+    return jsonify(entry)
+
+@app.route('/api/v1/queue/<int:run_id>/cancel')
+def cancel_queued_run(run_id):
+    """Cancel a run that is still waiting in the queue; running runs are stopped with /api/v1/abort."""
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(QUEUE_CANCEL_SQL, (run_id,))
+        cancelled = cur.fetchone() is not None
+        conn.commit()
+        cur.close()
+    if cancelled:
+        return jsonify({"message": f"Queued run {run_id} cancelled."})
+    entry = queue_entry(run_id)
+    if entry is None:
+        return jsonify({"error": f"No run {run_id} in the queue."}), 404
+    return jsonify({"error": f"Run {run_id} is {entry['state']} and can no longer be cancelled.", "state": entry['state']}), 409
+
+@app.route('/api/v1/search')
+def search_logs():
+    """Rank runs whose stored logs match a full-text query (q), with the matching lines as snippets."""
+    try:
+        query, run_types, limit = search_params(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    terms = search_terms(query)
+    history_rows = {}
+    snippets = {}
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(SEARCH_BUILDS_SQL, (query, run_types, limit))
+        hits = cur.fetchall()
+        for run_type in run_types:
+            build_ids = [build_id for t, build_id, _ in hits if t == run_type]
+            if not build_ids:
+                continue
+            cur.execute(history_rows_sql(run_type), (build_ids,))
+            history_rows.update(((run_type, row[0]), row) for row in cur.fetchall())
+            cur.execute(SEARCH_CHUNKS_SQL, (query, run_type, build_ids))
+            add_search_snippets(snippets, run_type, cur.fetchall(), terms)
+        cur.close()
+    return jsonify([format_search_hit(t, build_id, rank, history_rows.get((t, build_id)), snippets.get((t, build_id), []))
+                    for t, build_id, rank in hits])
+
+def log_range_params(args):
+    """Parse the optional start/end/tail parameters of the log endpoint."""
+    values = []
+    for name in ('start', 'end', 'tail'):
+        value = args.get(name)
+        if value is None or value == '':
+            values.append(None)
+            continue
         try:
-            build_id = int(build_id)
-            cur.execute("SELECT deploy_datetime, output_log, status, fr_version, structure_search_version, aborted FROM deploy_fr_history WHERE build_id = %s", (build_id,))
-            row = cur.fetchone()
-            cur.close()
-            conn.close()
-            if row:
-                return jsonify({
-                    'buildId': str(build_id),
-                    'datetime': row[0].isoformat(),
-                    'output_log': row[1],
-                    'status': row[2],
-                    'fr-version': row[3],
-                    'structure-search-version': row[4],
-                    'aborted': row[5]
-                })
-            else:
-                return jsonify({'error': 'Build ID not found'}), 404
+            value = int(value)
         except ValueError:
+            raise ValueError(f"{name} must be an integer")
+        if value < 0:
+            raise ValueError(f"{name} must not be negative")
+        values.append(value)
+    return values
+
+@app.route('/api/v1/logs/<run_type>/<int:build_id>')
+def run_log(run_type, build_id):
+    """Stream the stored log of a run, or only lines [start, end) or the last `tail` lines of it."""
+    if run_type not in RUN_TYPES:
+        return jsonify({'error': f"Unknown run type '{run_type}'"}), 404
+    try:
+        start, end, tail = log_range_params(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    table = HISTORY_TABLES[run_type][0]
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT output_log FROM {table} WHERE build_id = %s", (build_id,))
+        row = cur.fetchone()
+        if row is None:
             cur.close()
-            conn.close()
-            return jsonify({'error': 'Build ID must be an integer'}), 400
-    else:
-        cur.execute("SELECT build_id, deploy_datetime, status, fr_version, structure_search_version, aborted FROM deploy_fr_history ORDER BY deploy_datetime DESC LIMIT 10")
-        rows = cur.fetchall()
+            return jsonify({'error': 'Build ID not found'}), 404
+        cur.execute(LOG_STATS_SQL, (run_type, build_id))
+        total, chunk_count, legacy_chunks = cur.fetchone()
+        legacy = None
+        if legacy_chunks or not chunk_count:
+            # Not migrated yet: slice the whole log in memory
+            cur.execute(LOG_CHUNKS_SQL, (run_type, build_id))
+            legacy = assemble_log(cur.fetchall(), row[0]) or ''
+            total = count_log_lines(legacy)
         cur.close()
-        conn.close()
-        history = [{'buildId': str(row[0]), 'datetime': row[1].isoformat(), 'status': row[2], 'fr-version': row[3], 'structure-search-version': row[4], 'aborted': row[5]} for row in rows]
-        return jsonify(history)
+    start, end = resolve_log_range(total, start, end, tail)
+    headers = {'X-Total-Lines': str(total), 'X-Start-Line': str(start)}
+    if legacy is not None:
+        return Response(tracked_stream('logs', [slice_log_lines(0, legacy, start, end)]), mimetype='text/plain',
+                        headers=headers)
 
-@app.route('/api/v1/history/ml')
-def history_ml():
-    """Get MarkLogic deployment history (last 10 or specific buildId)."""
+    def generate():
+        for line_start, codec, data, content in log_chunks(run_type, build_id, (start, end)):
+            yield slice_log_lines(line_start, decompress_log(codec, data, content), start, end)
+    return Response(tracked_stream('logs', generate()), mimetype='text/plain', headers=headers)
+
+def history_response(run_type):
+    """Return a page of `run_type` runs (newest first, filterable), or one run with its log when buildId is given."""
     build_id = request.args.get('buildId')
-    conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS)
-    cur = conn.cursor()
     if build_id:
         try:
             build_id = int(build_id)
-            cur.execute("SELECT deploy_datetime, output_log, status, branch_name, environment_type, aborted FROM deploy_ml_history WHERE build_id = %s", (build_id,))
+        except ValueError:
+            return jsonify({'error': 'Build ID must be an integer'}), 400
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(history_detail_sql(run_type), (build_id,))
             row = cur.fetchone()
-            cur.close()
-            conn.close()
             if row:
-                return jsonify({
-                    'buildId': str(build_id),
-                    'datetime': row[0].isoformat(),
-                    'output_log': row[1],
-                    'status': row[2],
-                    'branchName': row[3],
-                    'environmentType': row[4],
-                    'aborted': row[5]
-                })
-            else:
-                return jsonify({'error': 'Build ID not found'}), 404
-        except ValueError:
+                cur.execute(LOG_STATS_SQL, (run_type, build_id))
+                chunk_count = cur.fetchone()[1]
+                cur.execute(RUN_STEPS_SQL, (run_type, [build_id]))
+                steps = cur.fetchall()
             cur.close()
-            conn.close()
-            return jsonify({'error': 'Build ID must be an integer'}), 400
+        if not row:
+            return jsonify({'error': 'Build ID not found'}), 404
+        item = add_run_steps([format_history_detail(run_type, build_id, row)], steps)[0]
+        if not chunk_count:
+            return jsonify(item)
+        head, tail = history_detail_json(item)
+
+        def generate():
+            yield head
+            for _, codec, data, content in log_chunks(run_type, build_id):
+                yield json.dumps(decompress_log(codec, data, content))[1:-1]
+            yield tail
+        return Response(tracked_stream('logs', generate()), mimetype='application/json')
     else:
-        cur.execute("SELECT build_id, deploy_datetime, status, branch_name, environment_type, aborted FROM deploy_ml_history ORDER BY deploy_datetime DESC LIMIT 10")
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        history = [{'buildId': str(row[0]), 'datetime': row[1].isoformat(), 'status': row[2], 'branchName': row[3], 'environmentType': row[4], 'aborted': row[5]} for row in rows]
-        return jsonify(history)
+        try:
+            sql, params, limit = history_list_query(run_type, request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        cache_key, digest = history_cache_key(run_type, request.args)
+        version, cached = read_history_cache(run_type, cache_key)
+        cache_headers = {'Cache-Control': 'no-cache'}
+        if version is not None:
+            cache_headers['ETag'] = history_etag(run_type, version, digest)
+            if etag_matches(request.headers.get('If-None-Match'), cache_headers['ETag']):
+                return Response(status=304, headers=cache_headers)
+            if cached:
+                cached = json.loads(cached)
+                if cached['v'] == version:
+                    return jsonify(cached['items']), 200, {**cached['headers'], **cache_headers}
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+            items, headers = history_page(run_type, rows, limit, request.path, request.args)
+            cur.execute(RUN_STEPS_SQL, (run_type, [int(item['buildId']) for item in items]))
+            add_run_steps(items, cur.fetchall())
+            cur.close()
+        if version is not None:
+            try:
+                r.set(cache_key, json.dumps({'v': version, 'items': items, 'headers': headers}), ex=HISTORY_CACHE_TTL)
+            except redis.RedisError as e:
+                print(f"Error writing {run_type} history cache: {str(e)}")
+        return jsonify(items), 200, {**headers, **cache_headers}
+
+@app.route('/api/v1/history/fr')
+def history_fr():
+    """Get frontend deployment history (paginated or specific buildId)."""
+    return history_response('fr')
+
+@app.route('/api/v1/history/ml')
+def history_ml():
+    """Get MarkLogic deployment history (paginated or specific buildId)."""
+    return history_response('ml')
 
 @app.route('/api/v1/history/cj')
 def history_cj():
-    """Get corb job run history (last 10 or specific buildId)."""
-    build_id = request.args.get('buildId')
-    conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS)
-    cur = conn.cursor()
-    if build_id:
-        try:
-            build_id = int(build_id)
-            cur.execute("SELECT deploy_datetime, output_log, status, job_name, branch_name, environment_type, aborted FROM deploy_cj_history WHERE build_id = %s", (build_id,))
-            row = cur.fetchone()
-            cur.close()
-            conn.close()
-            if row:
-                return jsonify({
-                    'buildId': str(build_id),
-                    'datetime': row[0].isoformat(),
-                    'output_log': row[1],
-                    'status': row[2],
-                    'job-name': row[3],
-                    'branchName': row[4],
-                    'environmentType': row[5],
-                    'aborted': row[6]
-                })
-            else:
-                return jsonify({'error': 'Build ID not found'}), 404
-        except ValueError:
-            cur.close()
-            conn.close()
-            return jsonify({'error': 'Build ID must be an integer'}), 400
-    else:
-        cur.execute("SELECT build_id, deploy_datetime, status, job_name, branch_name, environment_type, aborted FROM deploy_cj_history ORDER BY deploy_datetime DESC LIMIT 10")
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        history = [{'buildId': str(row[0]), 'datetime': row[1].isoformat(), 'status': row[2], 'jobName': row[3], 'branchName': row[4], 'environmentType': row[5], 'aborted': row[6]} for row in rows]
-        return jsonify(history)
+    """Get corb job run history (paginated or specific buildId)."""
+    return history_response('cj')
 
 @app.route('/api/v1/health')
 def health_check():
     """Check the health of the API service."""
-    return jsonify({"status": "healthy", "service": "simple-command-api"})
+    return jsonify({"status": "healthy", "service": "simple-command-api", "db_pool": db_pool.stats(),
+                    "gradle_daemons": gradle_daemons.stats()})
+
+@app.route('/metrics')
+def metrics():
+    """Expose the Prometheus metrics of this process."""
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
 
 if __name__ == '__main__':
     cleanup_stale_locks()
     create_tables()
+    mark_interrupted_runs()
+    prune_queue()
+    start_server_heartbeat()
+    threading.Thread(target=migrate_log_storage, daemon=True).start()
+    threading.Thread(target=gradle_daemons.maintain, daemon=True).start()
+    start_queue_workers()
     app.run(host='0.0.0.0', port=8080, debug=False)
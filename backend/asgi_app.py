@@ -0,0 +1,545 @@
+"""Asyncio (ASGI) serving mode for the deployment dashboard API.
+
+Serves the same /api/v1 contract as app.py, but every deploy stream, attach stream
+and history request is a coroutine on one event loop instead of a thread:
+Redis through redis.asyncio and PostgreSQL through a psycopg async connection
+pool. Runs themselves execute on app's engine (app.open_run), in a thread per
+running run as in the synchronous mode, and clients follow their RunStream here.
+
+Run with:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 8080
+"""
+import asyncio
+import contextlib
+import json
+import threading
+import time
+
+import redis.asyncio as aioredis
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from psycopg import AsyncCursor
+from psycopg_pool import AsyncConnectionPool
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import app as sync_app
+from app import (
+    ABORT_CHANNEL, ABORT_KEY_TTL, HISTORY_CACHE_TTL, API_DOC, ATTACH_BLOCK_MS, ATTACH_READ_COUNT, STREAM_LAG_POLICY, DB_HOST, DB_NAME,
+    DB_PASS, DB_POOL_MAX, DB_POOL_MIN, DB_POOL_TIMEOUT, DB_USER, HISTORY_TABLES,
+    LOG_CHUNKS_SQL, LOG_STATS_SQL, SEARCH_BUILDS_SQL, SEARCH_CHUNKS_SQL,
+    LOCK_CONFLICT_MESSAGES, QUEUE_CANCEL_SQL, QUEUE_LIST_SQL,
+    QUEUE_POLL_INTERVAL, QUEUE_RUN_SQL, QUEUE_STATS_WINDOW, QUEUE_WAIT_STATS_SQL, QUEUE_WORKERS, RUN_STEPS_SQL,
+    REDIS_DB, REDIS_HOST, REDIS_PORT, RUN_TYPES,
+    assemble_log, count_log_lines, decompress_log, format_history_detail,
+    etag_matches, history_cache_key, history_detail_sql, history_etag, history_version_key, history_list_query, history_page, new_history_version, stale_history_versions,
+    LOG_PAGE_CHUNKS, log_page_query, log_range_params, ended_before_start_message, missing_params_error, check_run_params, resolve_log_range, batch_stream_id,
+    abort_targets, add_run_steps, format_queue_entry, format_queue_wait_stats, queue_params, add_search_snippets, format_search_hit, gradle_daemons, history_rows_sql, lock_scopes_key, run_stream_key, search_params, search_terms,
+    slice_log_lines, ACTIVE_STREAMS, DB_LATENCY, REDIS_LATENCY, STREAMED_BYTES,
+    dropped_viewer_message, lag_resume_entry, skipped_output_message, stream_entry_offset, sql_operation, tracked_stream, history_detail_json,
+)
+
+class TimedAsyncPipeline(aioredis.client.Pipeline):
+    async def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_LATENCY.labels('PIPELINE').observe(time.perf_counter() - start)
+
+class TimedAsyncRedis(aioredis.Redis):
+    """Async counterpart of app.TimedRedis."""
+
+    async def execute_command(self, *args, **options):
+        if 'BLOCK' in args:
+            return await super().execute_command(*args, **options)
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_LATENCY.labels(str(args[0]).upper()).observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TimedAsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class TimedAsyncCursor(AsyncCursor):
+    """Async counterpart of app.TimedCursor."""
+
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            DB_LATENCY.labels(sql_operation(query)).observe(time.perf_counter() - start)
+
+async def configure_connection(conn):
+    conn.cursor_factory = TimedAsyncCursor
+
+async def tracked_async_stream(stream, output):
+    """Async counterpart of app.tracked_stream."""
+    ACTIVE_STREAMS.labels(stream).inc()
+    try:
+        async for text in output:
+            STREAMED_BYTES.labels(stream).inc(len(text.encode('utf-8')))
+            yield text
+    finally:
+        ACTIVE_STREAMS.labels(stream).dec()
+
+ar = TimedAsyncRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+db = AsyncConnectionPool(
+    f"host={DB_HOST} dbname={DB_NAME} user={DB_USER} password={DB_PASS}",
+    min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+    check=AsyncConnectionPool.check_connection, configure=configure_connection, open=False,
+)
+
+def json_error(body, status_code):
+    return JSONResponse(body, status_code=status_code)
+
+async def queue_entry(run_id):
+    async with db.connection() as conn:
+        cur = await conn.execute(QUEUE_RUN_SQL, (run_id,))
+        row = await cur.fetchone()
+    return format_queue_entry(row) if row else None
+
+async def follow_queued_run(run_type, run_id, queued=True):
+    """Async counterpart of app.follow_queued_run."""
+    # Runs started by app.open_run set this threading.Event once their output stream exists
+    started = sync_app.run_start_events.get(run_id)
+    position = None
+    while True:
+        entry = await queue_entry(run_id)
+        if entry is None or entry['state'] == 'cancelled':
+            yield f"❌ Queued run {run_id} was cancelled.\n\n"
+            return
+        stream_id = entry['buildId']
+        if entry['params'].get('jobs') and await ar.exists(run_stream_key(run_type, batch_stream_id(run_id))):
+            stream_id = batch_stream_id(run_id)
+        if stream_id is not None:
+            break
+        if entry['state'] not in ('queued', 'running'):
+            yield ended_before_start_message(entry)
+            return
+        if entry['position'] is not None and entry['position'] != position:
+            position = entry['position']
+            if queued:
+                yield f"⏳ Run {run_id} is queued at position {position}\n\n"
+        if started is not None:
+            await asyncio.to_thread(started.wait, QUEUE_POLL_INTERVAL)
+        else:
+            await asyncio.sleep(QUEUE_POLL_INTERVAL)
+    if queued:
+        build = f" as build {entry['buildId']}" if entry['buildId'] is not None else ""
+        yield f"▶ Run {run_id} started{build} after {entry['waitMs'] / 1000:.1f}s in the queue\n\n"
+    async for text in tail_run_stream(run_type, stream_id):
+        yield text
+
+async def stream_run(run_type, args):
+    """Start a run, or queue it, and stream its output.
+
+    Runs execute on app's engine exactly as in the synchronous mode: app.open_run
+    takes the lock scope and drives the pipeline (or corb job batch) in a thread
+    of its own, or queues the run for app's queue workers. Only following the
+    run's RunStream is a coroutine here. Returns a StreamingResponse, or an error response.
+    """
+    try:
+        priority, use_queue = queue_params(args)
+    except ValueError as e:
+        return json_error({'error': str(e)}, 400)
+    run_id, queued = await asyncio.to_thread(sync_app.open_run, run_type, args, priority, use_queue)
+    if run_id is None:
+        return json_error({"error": LOCK_CONFLICT_MESSAGES[run_type].format(environment=args.get('environmentType'))}, 409)
+    return StreamingResponse(tracked_async_stream('deploy', follow_queued_run(run_type, run_id, queued)),
+                             media_type='text/event-stream', headers={'X-Accel-Buffering': 'no', 'X-Run-Id': str(run_id)})
+
+async def home(request):
+    """Return API documentation."""
+    return JSONResponse(API_DOC)
+
+async def deploy_frontend(request):
+    """Deploy UI and Middleware with provided versions using the deployment script."""
+    error = missing_params_error('fr', request.query_params)
+    if error:
+        return json_error(error, 400)
+    try:
+        check_run_params('fr', request.query_params)
+    except ValueError as e:
+        return json_error({'error': str(e)}, 400)
+    return await stream_run('fr', request.query_params)
+
+async def deploy_marklogic(request):
+    """Deploy MarkLogic with specified branch and environment."""
+    error = missing_params_error('ml', request.query_params)
+    if error:
+        return json_error(error, 400)
+    try:
+        check_run_params('ml', request.query_params)
+    except ValueError as e:
+        return json_error({'error': str(e)}, 400)
+    return await stream_run('ml', request.query_params)
+
+async def run_corb_job(request):
+    """Run corb job with specified job name, branch, and environment."""
+    error = missing_params_error('cj', request.query_params)
+    if error:
+        return json_error(error, 400)
+    try:
+        check_run_params('cj', request.query_params)
+    except ValueError as e:
+        return json_error({'error': str(e)}, 400)
+    return await stream_run('cj', request.query_params)
+
+async def abort_run(request):
+    run_type = request.path_params['run_type']
+    if run_type not in RUN_TYPES:
+        return json_error({"error": f"Unknown run type '{run_type}'", "allowed": list(RUN_TYPES)}, 400)
+    scopes_key = lock_scopes_key(run_type)
+    scopes = {k.decode(): v.decode() for k, v in (await ar.hgetall(scopes_key)).items()}
+    sent = 0
+    async with ar.pipeline() as pipe:
+        for abort_key in abort_targets(run_type, scopes, request.query_params):
+            if not await ar.exists(scopes[abort_key]):
+                await ar.hdel(scopes_key, abort_key)
+                continue
+            pipe.set(abort_key, 'true', ex=ABORT_KEY_TTL)
+            pipe.publish(ABORT_CHANNEL, abort_key)
+            sent += 1
+        await pipe.execute()
+    if sent:
+        return JSONResponse({"message": f"Abort signal sent for {RUN_TYPES[run_type]}."})
+    return json_error({"error": f"No ongoing {RUN_TYPES[run_type]} to abort."}, 404)
+
+async def log_chunks(run_type, build_id, lines=None):
+    """Async counterpart of app.log_chunks."""
+    last_seq = -1
+    while True:
+        sql, params = log_page_query(run_type, build_id, last_seq, lines)
+        async with db.connection() as conn:
+            cur = await conn.execute(sql, params)
+            rows = await cur.fetchall()
+        for row in rows:
+            yield row[1:]
+        if len(rows) < LOG_PAGE_CHUNKS:
+            return
+        last_seq = rows[-1][0]
+
+async def stored_output(run_type, build_id, start, end):
+    """Async counterpart of app.stored_output."""
+    if not str(build_id).isdigit():
+        return
+    offset = 0
+    async for _, codec, data, content in log_chunks(run_type, build_id):
+        if offset >= end:
+            break
+        text = decompress_log(codec, data, content)
+        if offset + len(text) > start:
+            yield text[max(start - offset, 0):end - offset]
+        offset += len(text)
+
+async def tail_run_stream(run_type, build_id, offset=0):
+    """Async counterpart of app.tail_run_stream."""
+    key = run_stream_key(run_type, build_id)
+    last_id = '0'
+    position = 0 if offset == 0 else None
+    if offset > 0:
+        entries = await ar.xrevrange(key, max=f"{offset}-1", min='-', count=1)
+        if entries:
+            entry_id, fields = entries[0]
+            start = stream_entry_offset(entry_id)
+            if b'd' in fields:
+                text = fields[b'd'].decode()
+                position = start + len(text)
+                yield text[offset - start:]
+            elif b'end' in fields:
+                return
+            last_id = entry_id
+        else:
+            position = offset
+    while True:
+        result = await ar.xread({key: last_id}, count=ATTACH_READ_COUNT, block=ATTACH_BLOCK_MS)
+        if not result:
+            if not await ar.exists(key) and not await ar.hexists(f"active_runs:{run_type}", build_id):
+                return
+            continue
+        entries = result[0][1]
+        lagging = False
+        if len(entries) == ATTACH_READ_COUNT and position is not None:
+            resume = lag_resume_entry(position, await ar.xrevrange(key, count=2))
+            if resume is not None:
+                if STREAM_LAG_POLICY == 'drop':
+                    yield dropped_viewer_message(run_type, build_id, position)
+                    return
+                entries = [resume]
+                lagging = True
+        for entry_id, fields in entries:
+            last_id = entry_id
+            start = stream_entry_offset(entry_id)
+            if position is not None and start > position and not lagging:
+                async for text in stored_output(run_type, build_id, position, start):
+                    position += len(text)
+                    yield text
+            if position is not None and start > position:
+                yield skipped_output_message(start - position, start)
+            if b'end' in fields:
+                return
+            text = fields[b'd'].decode()
+            position = start + len(text)
+            yield text
+
+async def run_corb_batch(request):
+    """Run several corb jobs on one checkout of a branch, up to `concurrency` at a time."""
+    args = request.query_params
+    error = missing_params_error('cj_batch', args)
+    if error:
+        return json_error(error, 400)
+    try:
+        check_run_params('cj_batch', args)
+    except ValueError as e:
+        return json_error({'error': str(e)}, 400)
+    return await stream_run('cj', args)
+
+async def attach_run(request):
+    """Tail the live output of a running (or recently finished) run from the start or an offset."""
+    run_type = request.path_params['run_type']
+    if run_type not in RUN_TYPES:
+        return json_error({"error": f"Unknown run type '{run_type}'", "allowed": list(RUN_TYPES)}, 400)
+    build_id = request.query_params.get('buildId')
+    try:
+        offset = int(request.query_params.get('offset', '0'))
+        if build_id:
+            build_id = int(build_id)
+    except ValueError:
+        return json_error({'error': 'buildId and offset must be integers'}, 400)
+    if not build_id:
+        active = [int(b) for b in await ar.hkeys(f"active_runs:{run_type}")]
+        if not active:
+            return json_error({"error": f"No ongoing {RUN_TYPES[run_type]} to attach to."}, 404)
+        build_id = max(active)
+    elif not await ar.exists(run_stream_key(run_type, build_id)) and not await ar.hexists(f"active_runs:{run_type}", build_id):
+        return json_error({"error": f"Build {build_id} has no live output; use /api/v1/history/{run_type}?buildId={build_id}"}, 404)
+    return StreamingResponse(tracked_async_stream('attach', tail_run_stream(run_type, build_id, offset)), media_type='text/event-stream',
+                             headers={'X-Accel-Buffering': 'no', 'X-Build-Id': str(build_id)})
+
+async def read_history_cache(run_type, cache_key):
+    """Async counterpart of app.read_history_cache."""
+    if run_type in stale_history_versions:
+        await asyncio.to_thread(sync_app.bump_history_version, run_type)
+        if run_type in stale_history_versions:
+            return None, None
+    key = history_version_key(run_type)
+    try:
+        version, cached = await ar.mget(key, cache_key)
+        if version is None:
+            await ar.set(key, new_history_version(), nx=True)
+            version, cached = await ar.get(key), None
+    except aioredis.RedisError as e:
+        print(f"Error reading {run_type} history cache: {str(e)}")
+        return None, None
+    return int(version), cached
+
+async def history(request):
+    """Get run history (paginated or specific buildId) for fr, ml or cj."""
+    run_type = request.path_params['run_type']
+    if run_type not in RUN_TYPES:
+        return json_error({"error": f"Unknown run type '{run_type}'", "allowed": list(RUN_TYPES)}, 400)
+    build_id = request.query_params.get('buildId')
+    if build_id:
+        try:
+            build_id = int(build_id)
+        except ValueError:
+            return json_error({'error': 'Build ID must be an integer'}, 400)
+        async with db.connection() as conn:
+            cur = await conn.execute(history_detail_sql(run_type), (build_id,))
+            row = await cur.fetchone()
+            if row:
+                cur = await conn.execute(LOG_STATS_SQL, (run_type, build_id))
+                chunk_count = (await cur.fetchone())[1]
+                cur = await conn.execute(RUN_STEPS_SQL, (run_type, [build_id]))
+                steps = await cur.fetchall()
+        if not row:
+            return json_error({'error': 'Build ID not found'}, 404)
+        item = add_run_steps([format_history_detail(run_type, build_id, row)], steps)[0]
+        if not chunk_count:
+            return JSONResponse(item)
+        head, tail = history_detail_json(item)
+
+        async def generate():
+            yield head
+            async for _, codec, data, content in log_chunks(run_type, build_id):
+                yield json.dumps(decompress_log(codec, data, content))[1:-1]
+            yield tail
+        return StreamingResponse(tracked_async_stream('logs', generate()), media_type='application/json')
+    try:
+        sql, params, limit = history_list_query(run_type, request.query_params)
+    except ValueError as e:
+        return json_error({'error': str(e)}, 400)
+    cache_key, digest = history_cache_key(run_type, request.query_params)
+    version, cached = await read_history_cache(run_type, cache_key)
+    cache_headers = {'Cache-Control': 'no-cache'}
+    if version is not None:
+        cache_headers['ETag'] = history_etag(run_type, version, digest)
+        if etag_matches(request.headers.get('If-None-Match'), cache_headers['ETag']):
+            return Response(status_code=304, headers=cache_headers)
+        if cached:
+            cached = json.loads(cached)
+            if cached['v'] == version:
+                return JSONResponse(cached['items'], headers={**cached['headers'], **cache_headers})
+    async with db.connection() as conn:
+        cur = await conn.execute(sql, params)
+        rows = await cur.fetchall()
+        items, headers = history_page(run_type, rows, limit, request.url.path, request.query_params)
+        cur = await conn.execute(RUN_STEPS_SQL, (run_type, [int(item['buildId']) for item in items]))
+        add_run_steps(items, await cur.fetchall())
+    if version is not None:
+        try:
+            await ar.set(cache_key, json.dumps({'v': version, 'items': items, 'headers': headers}), ex=HISTORY_CACHE_TTL)
+        except aioredis.RedisError as e:
+            print(f"Error writing {run_type} history cache: {str(e)}")
+    return JSONResponse(items, headers={**headers, **cache_headers})
+
+async def search_logs(request):
+    """Rank runs whose stored logs match a full-text query (q), with the matching lines as snippets."""
+    try:
+        query, run_types, limit = search_params(request.query_params)
+    except ValueError as e:
+        return json_error({'error': str(e)}, 400)
+    terms = search_terms(query)
+    history_rows = {}
+    snippets = {}
+    async with db.connection() as conn:
+        cur = await conn.execute(SEARCH_BUILDS_SQL, (query, run_types, limit))
+        hits = await cur.fetchall()
+        for run_type in run_types:
+            build_ids = [build_id for t, build_id, _ in hits if t == run_type]
+            if not build_ids:
+                continue
+            cur = await conn.execute(history_rows_sql(run_type), (build_ids,))
+            history_rows.update(((run_type, row[0]), row) for row in await cur.fetchall())
+            cur = await conn.execute(SEARCH_CHUNKS_SQL, (query, run_type, build_ids))
+            add_search_snippets(snippets, run_type, await cur.fetchall(), terms)
+    return JSONResponse([format_search_hit(t, build_id, rank, history_rows.get((t, build_id)), snippets.get((t, build_id), []))
+                         for t, build_id, rank in hits])
+
+async def run_log(request):
+    """Stream the stored log of a run, or only lines [start, end) or the last `tail` lines of it."""
+    run_type = request.path_params['run_type']
+    build_id = request.path_params['build_id']
+    if run_type not in RUN_TYPES:
+        return json_error({'error': f"Unknown run type '{run_type}'"}, 404)
+    try:
+        start, end, tail = log_range_params(request.query_params)
+    except ValueError as e:
+        return json_error({'error': str(e)}, 400)
+    table = HISTORY_TABLES[run_type][0]
+    async with db.connection() as conn:
+        cur = await conn.execute(f"SELECT output_log FROM {table} WHERE build_id = %s", (build_id,))
+        row = await cur.fetchone()
+        if row is None:
+            return json_error({'error': 'Build ID not found'}, 404)
+        cur = await conn.execute(LOG_STATS_SQL, (run_type, build_id))
+        total, chunk_count, legacy_chunks = await cur.fetchone()
+        legacy = None
+        if legacy_chunks or not chunk_count:
+            cur = await conn.execute(LOG_CHUNKS_SQL, (run_type, build_id))
+            legacy = assemble_log(await cur.fetchall(), row[0]) or ''
+            total = count_log_lines(legacy)
+    start, end = resolve_log_range(total, start, end, tail)
+    headers = {'X-Total-Lines': str(total), 'X-Start-Line': str(start)}
+    if legacy is not None:
+        return StreamingResponse(tracked_stream('logs', [slice_log_lines(0, legacy, start, end)]), media_type='text/plain',
+                                 headers=headers)
+
+    async def generate():
+        async for line_start, codec, data, content in log_chunks(run_type, build_id, (start, end)):
+            yield slice_log_lines(line_start, decompress_log(codec, data, content), start, end)
+    return StreamingResponse(tracked_async_stream('logs', generate()), media_type='text/plain', headers=headers)
+
+async def list_queue(request):
+    """Queued and running runs, queued ones with their position, plus queue-wait statistics."""
+    async with db.connection() as conn:
+        cur = await conn.execute(QUEUE_LIST_SQL)
+        entries = [format_queue_entry(row) for row in await cur.fetchall()]
+        cur = await conn.execute(QUEUE_WAIT_STATS_SQL, (QUEUE_STATS_WINDOW,))
+        stats = format_queue_wait_stats(await cur.fetchone())
+    return JSONResponse({'workers': QUEUE_WORKERS, 'queued': sum(e['state'] == 'queued' for e in entries),
+                         'runs': entries, 'wait': stats})
+
+async def queued_run(request):
+    run_id = request.path_params['run_id']
+    entry = await queue_entry(run_id)
+    if entry is None:
+        return json_error({"error": f"No run {run_id} in the queue."}, 404)
+    return JSONResponse(entry)
+
+async def cancel_queued_run(request):
+    """Cancel a run that is still waiting in the queue; running runs are stopped with /api/v1/abort."""
+    run_id = request.path_params['run_id']
+    async with db.connection() as conn:
+        cur = await conn.execute(QUEUE_CANCEL_SQL, (run_id,))
+        cancelled = await cur.fetchone() is not None
+    if cancelled:
+        return JSONResponse({"message": f"Queued run {run_id} cancelled."})
+    entry = await queue_entry(run_id)
+    if entry is None:
+        return json_error({"error": f"No run {run_id} in the queue."}, 404)
+    return json_error({"error": f"Run {run_id} is {entry['state']} and can no longer be cancelled.", "state": entry['state']}, 409)
+
+async def health_check(request):
+    """Check the health of the API service."""
+    return JSONResponse({"status": "healthy", "service": "simple-command-api", "mode": "asgi", "db_pool": db.get_stats(),
+                         "gradle_daemons": gradle_daemons.stats()})
+
+async def metrics(request):
+    """Expose the Prometheus metrics of this process."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # One-off schema migration and lock cleanup reuse the synchronous helpers
+    await asyncio.to_thread(sync_app.cleanup_stale_locks)
+    await asyncio.to_thread(sync_app.create_tables)
+    await asyncio.to_thread(sync_app.mark_interrupted_runs)
+    await asyncio.to_thread(sync_app.prune_queue)
+    # Runs of servers that die later are closed out by the heartbeat's periodic sweep
+    await asyncio.to_thread(sync_app.start_server_heartbeat)
+    migration = asyncio.create_task(asyncio.to_thread(sync_app.migrate_log_storage))
+    # Daemon health checks block on gradlew, so they keep their own thread
+    threading.Thread(target=gradle_daemons.maintain, daemon=True).start()
+    # Queued runs are executed by app's worker threads, like the synchronous mode
+    sync_app.start_queue_workers()
+    await db.open()
+    try:
+        yield
+    finally:
+        await asyncio.to_thread(sync_app.abort_local_runs)
+        migration.cancel()
+        await db.close()
+        await ar.aclose()
+
+app = Starlette(
+    routes=[
+        Route('/', home),
+        Route('/api/v1/deploy/fr', deploy_frontend),
+        Route('/api/v1/deploy/ml', deploy_marklogic),
+        Route('/api/v1/run/cj', run_corb_job),
+        Route('/api/v1/run/cj/batch', run_corb_batch),
+        Route('/api/v1/attach/{run_type}', attach_run),
+        Route('/api/v1/abort/{run_type}', abort_run),
+        Route('/api/v1/history/{run_type}', history),
+        Route('/api/v1/logs/{run_type}/{build_id:int}', run_log),
+        Route('/api/v1/queue', list_queue),
+        Route('/api/v1/queue/{run_id:int}', queued_run),
+        Route('/api/v1/queue/{run_id:int}/cancel', cancel_queued_run),
+        Route('/api/v1/search', search_logs),
+        Route('/api/v1/health', health_check),
+        Route('/metrics', metrics),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+                          expose_headers=['X-Next-Cursor', 'Link', 'X-Build-Id', 'X-Total-Lines', 'X-Start-Line', 'X-Run-Id'])],
+    lifespan=lifespan,
+)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=8080)
@@ -0,0 +1,493 @@
+"""Offline benchmark and load test for the deployment dashboard backend.
+
+Runs backend/app.py (or asgi_app.py) in a subprocess against local stand-ins:
+fakeredis (or the Redis at REDIS_HOST), an ephemeral PostgreSQL from the
+pgserver package (or the one at DB_HOST), and fake_build.py as script.sh and
+gradlew, which prints a configurable volume of output at a configurable rate.
+The runs then go through three phases:
+
+- **calibration:** one run alone, for the DB round trips and Redis commands per run;
+- **load:** concurrent deploy, attach and history clients;
+- **aborts:** concurrent runs that are aborted once their output flows (up to
+  one per environment for ML deploys, one for frontend deploys).
+
+Usage:
+    python bench/bench.py --type ml --deploys 8 --attach 2 --history 4 --aborts 4 --lines 20000
+    python bench/bench.py --json after.json --baseline before.json
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'backend')
+ENVIRONMENTS = ['TEST', 'INGESTION', 'DEV-SMALL', 'DEV-FULL']  # the environment types the API maps to MarkLogic
+BRANCH = 'develop'
+ABORT_BRANCH = 'bench-abort'  # fake_build.py prints until killed in worktrees of this branch
+READ_SIZE = 65536
+STARTUP_TIMEOUT = 60  # seconds for the server to answer /api/v1/health
+RSS_SAMPLE_INTERVAL = 0.05
+ABORT_AFTER_LINES = 50  # output lines (past the workspace step) that show a run to abort is executing
+LINE_END_RE = re.compile(rb'[^\n]\n')
+IDLE_WINDOW = 2  # seconds of idle traffic (queue polling) measured before the calibration run
+# Metrics compared against --baseline, and whether a higher value is better
+COMPARED = {
+    'calibration.db_round_trips': False,
+    'calibration.redis_commands': False,
+    'load.lines_per_sec': True,
+    'load.ttfb_p95_ms': False,
+    'load.attach_ttfb_p95_ms': False,
+    'load.history_p95_ms': False,
+    'aborts.latency_p95_ms': False,
+    'server.peak_rss_mb': False,
+}
+
+def serve(server, port):
+    """Run the API in this process (the benchmark's server subprocess)."""
+    sys.path.insert(0, BACKEND_DIR)
+    if not os.environ.get('REDIS_HOST'):
+        import fakeredis
+        import redis
+        import redis.asyncio
+
+        fake_server = fakeredis.FakeServer()
+
+        class FakeRedis(fakeredis.FakeRedis):
+            def __init__(self, *args, **kwargs):
+                super().__init__(server=fake_server, db=kwargs.get('db', 0))
+
+        class FakeAsyncRedis(fakeredis.FakeAsyncRedis):
+            def __init__(self, *args, **kwargs):
+                super().__init__(server=fake_server, db=kwargs.get('db', 0))
+
+        redis.Redis = FakeRedis
+        redis.asyncio.Redis = FakeAsyncRedis
+    if server == 'asgi':
+        import uvicorn
+        import asgi_app
+        uvicorn.run(asgi_app.app, host='127.0.0.1', port=port, log_level='warning')
+        return
+    import app
+    app.cleanup_stale_locks()
+    app.create_tables()
+    app.mark_interrupted_runs()
+    threading.Thread(target=app.gradle_daemons.maintain, daemon=True).start()
+    app.start_queue_workers()
+    app.app.run(host='127.0.0.1', port=port, debug=False, threaded=True)
+
+def git(*args, cwd):
+    subprocess.run(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', *args], cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def create_fixtures(workdir):
+    """script.sh and an ls-prime clone whose marklogic/gradlew is fake_build.py, with its origin."""
+    fake = os.path.join(BENCH_DIR, 'fake_build.py')
+    shutil.copy(fake, os.path.join(workdir, 'script.sh'))
+    seed = os.path.join(workdir, 'seed')
+    os.makedirs(os.path.join(seed, 'marklogic', 'src', 'main', 'ml-modules'))
+    shutil.copy(fake, os.path.join(seed, 'marklogic', 'gradlew'))
+    with open(os.path.join(seed, 'marklogic', 'src', 'main', 'ml-modules', 'bench.sjs'), 'w') as f:
+        f.write('"bench";\n')
+    git('init', '-q', '-b', BRANCH, cwd=seed)
+    git('add', '.', cwd=seed)
+    git('commit', '-q', '-m', 'bench fixture', cwd=seed)
+    git('init', '-q', '--bare', 'origin.git', cwd=workdir)
+    git('branch', ABORT_BRANCH, cwd=seed)
+    git('push', '-q', os.path.join(workdir, 'origin.git'), BRANCH, ABORT_BRANCH, cwd=seed)
+    git('clone', '-q', '-b', BRANCH, 'origin.git', 'ls-prime', cwd=workdir)
+
+def start_postgres(workdir):
+    """Start an ephemeral PostgreSQL unless DB_HOST is set; returns (server or None, env)."""
+    if os.environ.get('DB_HOST'):
+        return None, {}
+    try:
+        import pgserver
+    except ImportError:
+        sys.exit("Set DB_HOST (and DB_NAME, DB_USER, DB_PASS) or install pgserver for an ephemeral PostgreSQL")
+    pgdata = os.path.join(workdir, 'pg')
+    return pgserver.get_server(pgdata), {'DB_HOST': pgdata, 'DB_NAME': 'postgres', 'DB_USER': 'postgres', 'DB_PASS': ''}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def request(port, path, timeout=30):
+    """GET `path`; returns (status, headers, body)."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request('GET', path)
+        resp = conn.getresponse()
+        return resp.status, dict(resp.getheaders()), resp.read()
+    finally:
+        conn.close()
+
+def count_lines(data, previous):
+    """Output lines ended in `data`, skipping the blank lines between them; `previous` is the byte before it."""
+    ended = len(LINE_END_RE.findall(data))
+    if data[:1] == b'\n' and previous not in (b'', b'\n'):
+        ended += 1
+    return ended
+
+def stream(port, path, on_headers=None, timeout=600):
+    """GET a streaming `path` and read it to the end.
+
+    Returns a dict with the status, time to first body byte, duration, bytes and
+    lines received, and the monotonic time the stream ended.
+    """
+    sent = time.monotonic()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request('GET', path)
+        resp = conn.getresponse()
+        if on_headers is not None:
+            on_headers(resp)
+        first = None
+        size = lines = 0
+        last = b''
+        while True:
+            data = resp.read1(READ_SIZE)
+            if not data:
+                break
+            if first is None:
+                first = time.monotonic()
+            size += len(data)
+            lines += count_lines(data, last)
+            last = data[-1:]
+        ended = time.monotonic()
+    finally:
+        conn.close()
+    return {'status': resp.status, 'ttfb': (first or ended) - sent, 'duration': ended - sent,
+            'bytes': size, 'lines': lines, 'ended': ended}
+
+def metric_total(text, name):
+    """Sum of every sample of `name` in a Prometheus text exposition."""
+    pattern = re.compile(rf'^{re.escape(name)}(?:{{[^}}]*}})? (\S+)$', re.MULTILINE)
+    return sum(float(v) for v in pattern.findall(text))
+
+def scrape(port):
+    text = request(port, '/metrics')[2].decode()
+    return {'db': metric_total(text, 'deploy_db_query_seconds_count'),
+            'redis': metric_total(text, 'deploy_redis_command_seconds_count')}
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+class RssSampler(threading.Thread):
+    """Track the peak RSS of the server process."""
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.process = psutil.Process(pid)
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(RSS_SAMPLE_INTERVAL):
+            try:
+                self.peak = max(self.peak, self.process.memory_info().rss)
+            except psutil.NoSuchProcess:
+                return
+
+class Handoff:
+    """A single value handed from a deploy client to its attach clients."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._value = None
+
+    def put(self, value):
+        self._value = value
+        self._event.set()
+
+    def get(self, timeout=None):
+        self._event.wait(timeout)
+        return self._value
+
+class Bench:
+    def __init__(self, options, port):
+        self.options = options
+        self.port = port
+        self.run_type = options.type
+
+    def deploy_path(self, i, abort=False):
+        """Run `i` of a phase: ML deploys cycle through ENVIRONMENTS, corb jobs are per-job locked in one."""
+        environment = ENVIRONMENTS[i % len(ENVIRONMENTS)]
+        if self.run_type == 'fr':
+            version = 'abort' if abort else '1.0.0'
+            # force: repeated deploys of one version would otherwise find it live and deploy nothing
+            return f'/api/v1/deploy/fr?fr-version={version}&structure-search-version={version}&force=true'
+        branch = ABORT_BRANCH if abort else BRANCH
+        if self.run_type == 'ml':
+            return f'/api/v1/deploy/ml?branchName={branch}&environmentType={environment}'
+        return f'/api/v1/run/cj?job-name={self.job_name(i, abort)}&branchName={branch}&environmentType={ENVIRONMENTS[0]}'
+
+    def job_name(self, i, abort=False):
+        return f"bench{'Abort' if abort else ''}Job{i}"
+
+    def abort_path(self, i):
+        if self.run_type == 'fr':
+            return '/api/v1/abort/fr'
+        if self.run_type == 'ml':
+            return f'/api/v1/abort/ml?environmentType={ENVIRONMENTS[i % len(ENVIRONMENTS)]}'
+        return f'/api/v1/abort/cj?environmentType={ENVIRONMENTS[0]}&job-name={self.job_name(i, True)}'
+
+    def build_id(self, run_id, deadline):
+        """Poll the queue until run `run_id` has a build ID."""
+        while time.monotonic() < deadline:
+            status, _, body = request(self.port, f'/api/v1/queue/{run_id}')
+            if status == 200 and json.loads(body)['buildId'] is not None:
+                return json.loads(body)['buildId']
+            time.sleep(0.02)
+        return None
+
+    def calibrate(self):
+        """One run on an idle server; the idle rate of queries (queue polling) is subtracted from its round trips."""
+        idle = scrape(self.port)
+        time.sleep(IDLE_WINDOW)
+        before = scrape(self.port)
+        idle = {k: (before[k] - idle[k]) / IDLE_WINDOW for k in idle}
+        result = stream(self.port, self.deploy_path(0))
+        after = scrape(self.port)
+        return {'ttfb_ms': ms(result['ttfb']), 'duration_ms': ms(result['duration']), 'lines': result['lines'],
+                'lines_per_sec': round(result['lines'] / result['duration']),
+                'db_round_trips': round(after['db'] - before['db'] - idle['db'] * result['duration']),
+                'redis_commands': round(after['redis'] - before['redis'] - idle['redis'] * result['duration'])}
+
+    def attach(self, run_ids, index, results):
+        run_id = run_ids[index].get(timeout=60)
+        build_id = self.build_id(run_id, time.monotonic() + 60)
+        if build_id is not None:
+            results.append(stream(self.port, f'/api/v1/attach/{self.run_type}?buildId={build_id}'))
+
+    def history(self, done, latencies, build_ids):
+        paths = [f'/api/v1/history/{self.run_type}?limit=20']
+        while not done.is_set():
+            if build_ids:
+                build_id = random.choice(build_ids)
+                paths = [f'/api/v1/history/{self.run_type}?limit=20', f'/api/v1/history/{self.run_type}?buildId={build_id}',
+                         f'/api/v1/logs/{self.run_type}/{build_id}?tail=200']
+            for path in paths:
+                start = time.monotonic()
+                request(self.port, path)
+                latencies.append(time.monotonic() - start)
+
+    def load(self):
+        """Concurrent deploys, each tailed by --attach attach clients, while --history clients read history."""
+        count = self.options.deploys
+        deploys = [None] * count
+        attaches = []
+        history_latencies = []
+        run_ids = [Handoff() for _ in range(count)]
+        _, _, body = request(self.port, f'/api/v1/history/{self.run_type}?limit=20')
+        build_ids = [item['buildId'] for item in json.loads(body)]
+        done = threading.Event()
+
+        def deploy(i):
+            deploys[i] = stream(self.port, self.deploy_path(i),
+                                on_headers=lambda resp: run_ids[i].put(resp.getheader('X-Run-Id')))
+
+        threads = [threading.Thread(target=deploy, args=(i,)) for i in range(count)]
+        threads += [threading.Thread(target=self.attach, args=(run_ids, i, attaches))
+                    for i in range(count) for _ in range(self.options.attach)]
+        readers = [threading.Thread(target=self.history, args=(done, history_latencies, build_ids), daemon=True)
+                   for _ in range(self.options.history)]
+        start = time.monotonic()
+        for t in threads + readers:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.monotonic() - start
+        done.set()
+        for t in readers:
+            t.join()
+        lines = sum(d['lines'] for d in deploys)
+        return {'runs': count, 'wall_ms': ms(wall), 'lines': lines, 'lines_per_sec': round(lines / wall),
+                'ttfb_p50_ms': ms(percentile([d['ttfb'] for d in deploys], 50)),
+                'ttfb_p95_ms': ms(percentile([d['ttfb'] for d in deploys], 95)),
+                'attach_clients': len(attaches),
+                'attach_ttfb_p95_ms': ms(percentile([a['ttfb'] for a in attaches], 95)),
+                'attach_lines_per_sec': round(sum(a['lines'] for a in attaches) / wall),
+                'history_requests': len(history_latencies),
+                'history_p50_ms': ms(percentile(history_latencies, 50)),
+                'history_p95_ms': ms(percentile(history_latencies, 95))}
+
+    def aborts(self):
+        """Runs that print until aborted; abort latency is abort request to end of their stream."""
+        count = self.options.aborts
+        if self.run_type != 'cj':
+            count = min(count, 1 if self.run_type == 'fr' else len(ENVIRONMENTS))
+        latencies = [None] * count
+
+        def run(i):
+            flowing = threading.Event()
+            result = {}
+
+            def consume():
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+                conn.request('GET', self.deploy_path(i, abort=True))
+                resp = conn.getresponse()
+                lines = 0
+                last = b''
+                while True:
+                    data = resp.read1(READ_SIZE)
+                    if not data:
+                        break
+                    lines += count_lines(data, last)
+                    last = data[-1:]
+                    if lines > ABORT_AFTER_LINES:
+                        flowing.set()
+                result['ended'] = time.monotonic()
+                conn.close()
+                flowing.set()
+
+            reader = threading.Thread(target=consume)
+            reader.start()
+            flowing.wait(120)
+            time.sleep(self.options.abort_after)
+            requested = time.monotonic()
+            request(self.port, self.abort_path(i))
+            reader.join()
+            latencies[i] = result['ended'] - requested
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return {'runs': count, 'latency_p50_ms': ms(percentile(latencies, 50)),
+                'latency_p95_ms': ms(percentile(latencies, 95)), 'latency_max_ms': ms(max(latencies))}
+
+def compare(results, baseline, tolerance):
+    """Print each COMPARED metric against the baseline; returns the names that regressed beyond tolerance."""
+    regressed = []
+    print(f"\n{'metric':32} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, higher_is_better in COMPARED.items():
+        section, key = name.split('.')
+        old, new = baseline.get(section, {}).get(key), results.get(section, {}).get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = '  REGRESSION' if worse > tolerance else ''
+        if flag:
+            regressed.append(name)
+        print(f"{name:32} {old:>12} {new:>12} {change:>+8.0%}{flag}")
+    return regressed
+
+def print_results(results):
+    for section, values in results.items():
+        print(f"\n[{section}]")
+        for key, value in values.items():
+            print(f"  {key:24} {value}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--server', choices=['sync', 'asgi'], default='sync', help='app.py (Flask) or asgi_app.py (uvicorn)')
+    parser.add_argument('--type', choices=['fr', 'ml', 'cj'], default='ml', help='run type to deploy')
+    parser.add_argument('--deploys', type=int, default=4, help='concurrent runs in the load phase')
+    parser.add_argument('--attach', type=int, default=1, help='attach clients per run')
+    parser.add_argument('--history', type=int, default=2, help='history/log clients during the load phase')
+    parser.add_argument('--aborts', type=int, default=2, help='concurrent aborted runs')
+    parser.add_argument('--abort-after', type=float, default=0.5, help='seconds of output before aborting')
+    parser.add_argument('--lines', type=int, default=5000, help='lines printed by each fake build')
+    parser.add_argument('--line-bytes', type=int, default=120, help='bytes per line')
+    parser.add_argument('--rate', type=float, default=0, help='lines per second of the fake builds (0: unthrottled)')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative change counted as a regression')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory (server log, worktrees)')
+    parser.add_argument('--serve', choices=['sync', 'asgi'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.serve:
+        serve(options.serve, options.port)
+        return
+    if options.type == 'fr' and options.deploys > 1:
+        print("Frontend deploys share one lock; the load phase runs them one after another through the queue")
+    if options.type == 'ml' and options.deploys > len(ENVIRONMENTS):
+        print(f"ML deploys lock their environment; runs beyond {len(ENVIRONMENTS)} wait in the queue")
+
+    workdir = tempfile.mkdtemp(prefix='dashboard-bench-')
+    create_fixtures(workdir)
+    postgres, env = start_postgres(workdir)
+    port = free_port()
+    # Per-job corb locks, so corb jobs of the load phase run concurrently in one environment
+    env = {**os.environ, **env, 'CORB_JOB_LOCKS': 'true', 'WORKTREE_ROOT': os.path.join(workdir, 'worktrees'),
+           'GRADLE_HOME_ROOT': os.path.join(workdir, 'gradle-homes'), 'BENCH_LINES': str(options.lines),
+           'BENCH_LINE_BYTES': str(options.line_bytes), 'BENCH_RATE': str(options.rate), 'PYTHONUNBUFFERED': '1'}
+    log_path = os.path.join(workdir, 'server.log')
+    with open(log_path, 'w') as log:
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', options.server, '--port', str(port)],
+                                  cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    sampler = None
+    try:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                if request(port, '/api/v1/health', timeout=5)[0] == 200:
+                    break
+            except OSError:
+                pass
+            if server.poll() is not None or time.monotonic() > deadline:
+                sys.exit(f"Server did not start, see {log_path}")
+            time.sleep(0.2)
+        sampler = RssSampler(server.pid)
+        sampler.start()
+        bench = Bench(options, port)
+        results = {'config': {k: getattr(options, k) for k in ('server', 'type', 'deploys', 'attach', 'history', 'aborts',
+                                                                  'lines', 'line_bytes', 'rate')}}
+        print("Calibration run...")
+        results['calibration'] = bench.calibrate()
+        print(f"Load: {options.deploys} runs, {options.attach} attach clients each, {options.history} history clients...")
+        results['load'] = bench.load()
+        if options.aborts:
+            print("Aborts...")
+            results['aborts'] = bench.aborts()
+        results['server'] = {'peak_rss_mb': round(sampler.peak / 2 ** 20, 1)}
+    finally:
+        if sampler is not None:
+            sampler.stopped.set()
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        if postgres is not None:
+            postgres.cleanup()
+        if options.keep:
+            print(f"Work directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressed = compare(results, json.load(f), options.tolerance)
+        if regressed:
+            sys.exit(f"\nRegressed beyond {options.tolerance:.0%}: {', '.join(regressed)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""Stand-in for script.sh and marklogic/gradlew used by bench.py.
+
+Prints BENCH_LINES lines of BENCH_LINE_BYTES bytes at BENCH_RATE lines per
+second (0: as fast as the pipe takes them). When an argument or the working
+directory mentions abort (the version, job or branch of an abort run) it
+prints until it is killed.
+Gradle daemon housekeeping (--status, --stop, warm-up builds) succeeds at once.
+"""
+import os
+import sys
+import time
+
+args = sys.argv[1:]
+if args[:1] in (['--status'], ['--stop']) or 'help' in args:
+    sys.exit(0)
+
+lines = int(os.environ.get('BENCH_LINES', '1000'))
+line_bytes = max(10, int(os.environ.get('BENCH_LINE_BYTES', '120')))
+rate = float(os.environ.get('BENCH_RATE', '0'))
+endless = any('abort' in arg.lower() for arg in args) or 'bench-abort' in os.getcwd().split(os.sep)
+# Gradle builds print the markers of the dashboard's init script, so startup vs execution is reported
+home = os.environ.get('GRADLE_USER_HOME')
+gradle = bool(home) and os.path.isdir(os.path.join(home, 'init.d'))
+
+out = sys.stdout.buffer
+padding = b'x' * (line_bytes - 10) + b'\n'
+if gradle:
+    out.write(f"[gradle-timing] start={int(time.time() * 1000)}\n".encode())
+start = time.monotonic()
+i = 0
+while endless or i < lines:
+    out.write(b'%9d ' % i + padding)
+    i += 1
+    if rate:
+        delay = start + i / rate - time.monotonic()
+        if delay > 0:
+            out.flush()
+            time.sleep(delay)
+if gradle:
+    out.write(f"[gradle-timing] finished={int(time.time() * 1000)}\n".encode())
+out.flush()